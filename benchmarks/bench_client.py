@@ -0,0 +1,192 @@
+"""
+End-to-end client benchmarks against an in-process `MockSolrServer`, so
+that performance changes to the client can be measured without a live Solr.
+
+    python benchmarks/bench_client.py --docs 5000 --latency 0.001 --output client.json
+    python benchmarks/bench_client.py --scenario search --scenario paginate
+
+Scenarios:
+
+    search      `Solr.search` throughput and latency percentiles
+    group       grouped searches
+    mlt         more_like_this
+    tvrh        term_vectors
+    paginate    docs/s exported through `SolrResultsPaginator`
+    batch_add   docs/s indexed through `SolrBatchAdder`
+    decode      `Results` construction cost per page, and its memory peak
+
+Results are printed on stderr and written as JSON to `--output` (stdout by
+default) for regression tracking.
+"""
+import os
+import sys
+import time
+import platform
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pythonsolr.pysolr import Solr, Results, json
+from pythonsolr.pythonsolr import SolrResultsPaginator, SolrBatchAdder
+from pythonsolr.mocksolr import MockSolrServer, make_docs
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100.0))
+    return sorted_values[index]
+
+def timed_calls(func, count):
+    """Calls `func` `count` times, returning throughput and latency percentiles."""
+    latencies = []
+    started = time.time()
+    for i in xrange(count):
+        start = time.time()
+        func(i)
+        latencies.append(time.time() - start)
+    elapsed = time.time() - started
+    latencies.sort()
+    return {
+        'ops': count,
+        'seconds': elapsed,
+        'ops_per_second': count / elapsed if elapsed else None,
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+    }
+
+def peak_memory(func):
+    """
+    Runs `func` in a forked child and returns how much its peak resident
+    set size grew, in kilobytes (None where fork or resource aren't available).
+    """
+    try:
+        import resource
+        fork = os.fork
+    except (ImportError, AttributeError):
+        return None
+    read_fd, write_fd = os.pipe()
+    pid = fork()
+    if pid == 0:
+        try:
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            func()
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(write_fd, str(after - before))
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    output = os.read(read_fd, 64)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return int(output) if output else None
+
+def bench_search(server, options):
+    solr = Solr(server.url)
+    return timed_calls(lambda i: solr.search('*:*', rows=options.rows), options.requests)
+
+def bench_group(server, options):
+    solr = Solr(server.url)
+    params = {'group.field': 'publisher', 'group.limit': 3, 'rows': options.rows}
+    return timed_calls(lambda i: solr.group('*:*', **params), options.requests)
+
+def bench_mlt(server, options):
+    solr = Solr(server.url)
+    return timed_calls(lambda i: solr.more_like_this('id:article-%d' % i, 'text', rows=options.rows),
+                       options.requests)
+
+def bench_tvrh(server, options):
+    solr = Solr(server.url)
+    return timed_calls(lambda i: solr.term_vectors('*:*', 'text', rows=options.rows), options.requests)
+
+def bench_paginate(server, options):
+    solr = Solr(server.url)
+    paginator = SolrResultsPaginator(solr, '*:*', {'rows': options.rows})
+    started = time.time()
+    count = 0
+    for doc in paginator:
+        count += 1
+    elapsed = time.time() - started
+    return {'docs': count, 'seconds': elapsed, 'docs_per_second': count / elapsed,
+            'requests': server.requests.get('select', 0)}
+
+def bench_batch_add(server, options):
+    solr = Solr(server.url)
+    docs = make_docs(options.docs)
+    adder = SolrBatchAdder(solr, batch_size=options.batch_size, auto_commit=False)
+    started = time.time()
+    adder.add_multi(docs)
+    adder.flush()
+    elapsed = time.time() - started
+    return {'docs': len(docs), 'seconds': elapsed, 'docs_per_second': len(docs) / elapsed,
+            'indexed': server.docs_added}
+
+def bench_decode(server, options):
+    response = json.dumps({
+        'responseHeader': {'status': 0, 'QTime': 1},
+        'response': {'numFound': options.docs, 'start': 0, 'docs': make_docs(options.rows)},
+    })
+    result = timed_calls(lambda i: Results(response), options.requests)
+    result['response_bytes'] = len(response)
+    result['peak_rss_kb'] = peak_memory(lambda: [Results(response) for i in xrange(10)])
+    return result
+
+SCENARIOS = (
+    ('search', bench_search),
+    ('group', bench_group),
+    ('mlt', bench_mlt),
+    ('tvrh', bench_tvrh),
+    ('paginate', bench_paginate),
+    ('batch_add', bench_batch_add),
+    ('decode', bench_decode),
+)
+
+def run(options):
+    selected = options.scenario or [name for name, func in SCENARIOS]
+    results = []
+    for name, func in SCENARIOS:
+        if name not in selected:
+            continue
+        # a fresh server per scenario keeps the request counters separate
+        server = MockSolrServer(num_docs=options.docs, doc_words=options.doc_words,
+                                latency=options.latency).start()
+        try:
+            result = func(server, options)
+        finally:
+            server.stop()
+        result['scenario'] = name
+        results.append(result)
+        sys.stderr.write("%-10s %s\n" % (name, ', '.join(
+            '%s=%.4g' % (key, value) for key, value in sorted(result.items())
+            if isinstance(value, (int, long, float)))))
+    return results
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--scenario", action="append", help="scenario to run, can be repeated (default all)")
+    parser.add_option("--docs", type="int", default=2000, help="documents in the mock index")
+    parser.add_option("--doc-words", dest="doc_words", type="int", default=120, help="words of text per document")
+    parser.add_option("--rows", type="int", default=100, help="rows per request")
+    parser.add_option("--requests", type="int", default=200, help="requests per throughput scenario")
+    parser.add_option("--batch-size", dest="batch_size", type="int", default=100, help="SolrBatchAdder batch size")
+    parser.add_option("--latency", type="float", default=0.0, help="seconds added by the mock server to every request")
+    parser.add_option("--output", default=None, help="file for the JSON results (default stdout)")
+    options, args = parser.parse_args(argv)
+
+    output = json.dumps({
+        'benchmark': 'client',
+        'python': platform.python_version(),
+        'options': {'docs': options.docs, 'doc_words': options.doc_words, 'rows': options.rows,
+                    'requests': options.requests, 'batch_size': options.batch_size,
+                    'latency': options.latency},
+        'results': run(options),
+    }, indent=2)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(output)
+        f.close()
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Compares the response formats the client can ask Solr for: bytes on the
+wire (plain, gzip and deflate) and decode time for `wt=json` and
+`wt=javabin`, on a synthetic result page.
+
+    python benchmarks/bench_formats.py --rows 1000 --repeat 20 --output formats.json
+
+Results are printed as a table on stderr and written as JSON to `--output`
+(stdout by default) so they can be tracked between runs.
+"""
+import os
+import sys
+import zlib
+import gzip
+import timeit
+from cStringIO import StringIO
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pythonsolr.pysolr import json, Results
+from pythonsolr.javabin import JavaBinEncoder, JavaBinDecoder
+from pythonsolr.mocksolr import make_docs
+
+def make_response(rows):
+    """A select response holding a page of `rows` article-like documents."""
+    return {
+        'responseHeader': {'status': 0, 'QTime': 12, 'params': {'q': u'*:*', 'rows': unicode(rows)}},
+        'response': {'numFound': rows * 100, 'start': 0, 'maxScore': 1.0, 'docs': make_docs(rows)},
+    }
+
+def gzip_bytes(data):
+    out = StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb')
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+def gunzip_bytes(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+def best_of(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+def run(rows, repeat):
+    response = make_response(rows)
+    bodies = {
+        'json': (json.dumps(response), json.JSONDecoder()),
+        'javabin': (JavaBinEncoder().encode(response), JavaBinDecoder()),
+    }
+    results = []
+    for name, (body, decoder) in sorted(bodies.items()):
+        gzipped = gzip_bytes(body)
+        deflated = zlib.compress(body)
+        results.append({
+            'format': name,
+            'rows': rows,
+            'bytes': len(body),
+            'gzip_bytes': len(gzipped),
+            'deflate_bytes': len(deflated),
+            'decode_seconds': best_of(lambda: decoder.decode(body), repeat),
+            'gunzip_decode_seconds': best_of(lambda: decoder.decode(gunzip_bytes(gzipped)), repeat),
+            'results_seconds': best_of(lambda: Results(body, decoder=decoder), repeat),
+        })
+    return results
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--rows", type="int", default=1000, help="documents per result page")
+    parser.add_option("--repeat", type="int", default=10, help="timing repetitions, the best one is kept")
+    parser.add_option("--output", default=None, help="file for the JSON results (default stdout)")
+    options, args = parser.parse_args(argv)
+
+    results = run(options.rows, options.repeat)
+    for r in results:
+        sys.stderr.write("%(format)-8s %(bytes)10d bytes  gzip %(gzip_bytes)9d  deflate %(deflate_bytes)9d  "
+                         "decode %(decode_seconds).4fs  gunzip+decode %(gunzip_decode_seconds).4fs\n" % r)
+    output = json.dumps({'benchmark': 'formats', 'results': results}, indent=2)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(output)
+        f.close()
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
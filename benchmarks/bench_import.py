@@ -0,0 +1,82 @@
+"""
+Measures how long `import pythonsolr` takes in a fresh interpreter, and which
+of the optional heavy modules (httplib2, ElementTree, multiprocessing, JSON
+backends...) it pulls in. None of them should be imported until a client
+needs them; the doctest of `pythonsolr/__init__.py` checks that.
+
+    python benchmarks/bench_import.py --repeat 20 --output import.json
+
+Results are printed on stderr and written as JSON to `--output` (stdout by
+default).
+"""
+import os
+import subprocess
+import sys
+from optparse import OptionParser
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, ROOT)
+
+from pythonsolr.pysolr import json
+
+# modules that should only be imported on first use
+DEFERRED = ('httplib2', 'xml.etree.ElementTree', 'xml.etree.cElementTree', 'lxml', 'multiprocessing',
+            'orjson', 'ujson', 'simplejson', 'pythonsolr.javabin', 'pythonsolr.cache')
+
+PROBE = """
+import sys, time, json
+before = set(sys.modules)
+start = time.time()
+import %(module)s
+elapsed = time.time() - start
+loaded = [name for name in set(sys.modules) - before if sys.modules[name] is not None]
+sys.stdout.write(json.dumps({'seconds': elapsed, 'modules': sorted(loaded)}))
+"""
+
+def probe(module):
+    """Imports `module` in a new interpreter, returns the time and modules loaded."""
+    process = subprocess.Popen([sys.executable, '-c', PROBE % {'module': module}],
+                               cwd=ROOT, stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise RuntimeError("importing %s failed" % module)
+    return json.loads(output)
+
+def run(module, repeat):
+    timings = []
+    for i in range(repeat):
+        result = probe(module)
+        timings.append(result['seconds'])
+    timings.sort()
+    deferred = [name for name in DEFERRED if name in result['modules']]
+    return {
+        'module': module,
+        'best_seconds': timings[0],
+        'median_seconds': timings[len(timings) // 2],
+        'modules_loaded': len(result['modules']),
+        'deferred_modules_loaded': deferred,
+    }
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--module", action="append", default=None,
+                      help="module to import (default pythonsolr, repeatable)")
+    parser.add_option("--repeat", type="int", default=10, help="fresh interpreters per module")
+    parser.add_option("--output", default=None, help="file for the JSON results (default stdout)")
+    options, args = parser.parse_args(argv)
+
+    results = [run(module, options.repeat) for module in options.module or ['pythonsolr']]
+    for r in results:
+        sys.stderr.write("%(module)-24s best %(best_seconds).4fs  median %(median_seconds).4fs  "
+                         "%(modules_loaded)d modules  deferred loaded: %(deferred_modules_loaded)s\n" % r)
+    output = json.dumps({'benchmark': 'import', 'results': results}, indent=2)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(output)
+        f.close()
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
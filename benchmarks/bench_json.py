@@ -0,0 +1,81 @@
+"""
+Compares the JSON backends `jsoncodec` can use (orjson, ujson, simplejson,
+json), decoding realistic Solr responses (a plain result page, a faceted
+page and a grouped page) and encoding update batches.
+
+    python benchmarks/bench_json.py --rows 1000 --repeat 20 --output json.json
+
+Only the backends installed are measured. Results are printed as a table on
+stderr and written as JSON to `--output` (stdout by default).
+"""
+import os
+import sys
+import timeit
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pythonsolr.pysolr import json
+from pythonsolr.jsoncodec import available_codecs
+from pythonsolr.mocksolr import MockSolrServer, make_docs
+
+def make_payloads(rows):
+    """Response bodies as the mock server writes them, and an update batch."""
+    server = MockSolrServer(num_docs=rows * 10)
+    server.httpd.server_close()
+    def respond(params):
+        params = dict((key, [value]) for key, value in params.items())
+        return json.dumps(server.handle_select(params, ''))
+    payloads = {
+        'select': respond({'q': '*:*', 'rows': rows}),
+        'facets': respond({'q': '*:*', 'rows': rows, 'facet': 'true', 'facet.field': 'tags',
+                           'facet.pivot': 'publisher,tags'}),
+        'group': respond({'q': '*:*', 'rows': rows, 'group': 'true', 'group.field': 'publisher',
+                          'group.limit': rows // 5}),
+    }
+    return payloads, make_docs(rows, seed=7)
+
+def best_of(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+def run(rows, repeat):
+    payloads, batch = make_payloads(rows)
+    results = []
+    for codec in available_codecs():
+        for name, body in sorted(payloads.items()):
+            results.append({
+                'backend': codec.name,
+                'operation': 'decode',
+                'payload': name,
+                'bytes': len(body),
+                'seconds': best_of(lambda: codec.decode(body), repeat),
+            })
+        results.append({
+            'backend': codec.name,
+            'operation': 'encode',
+            'payload': 'update',
+            'bytes': len(codec.encode(batch)),
+            'seconds': best_of(lambda: codec.encode(batch), repeat),
+        })
+    return results
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--rows", type="int", default=1000, help="documents per response and per update")
+    parser.add_option("--repeat", type="int", default=10, help="timing repetitions, the best one is kept")
+    parser.add_option("--output", default=None, help="file for the JSON results (default stdout)")
+    options, args = parser.parse_args(argv)
+
+    results = run(options.rows, options.repeat)
+    for r in results:
+        sys.stderr.write("%(backend)-10s %(operation)-6s %(payload)-7s %(bytes)10d bytes  %(seconds).4fs\n" % r)
+    output = json.dumps({'benchmark': 'json', 'results': results}, indent=2)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(output)
+        f.close()
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,14 @@
+"""
+Importing the package doesn't import the optional or heavy modules; they
+are loaded when a client first needs them:
+
+>>> import os, subprocess, sys
+>>> deferred = ('httplib2', 'xml.etree.ElementTree', 'xml.etree.cElementTree', 'lxml', 'multiprocessing',
+...             'pythonsolr.javabin', 'pythonsolr.cache', 'orjson', 'ujson', 'simplejson')
+>>> probe = 'import sys, pythonsolr; print sorted(name for name in %r if name in sys.modules)' % (deferred,)
+>>> root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+>>> print subprocess.Popen([sys.executable, '-c', probe], cwd=root, stdout=subprocess.PIPE).communicate()[0],
+[]
+"""
 from pythonsolr import *
 from pysolr import *
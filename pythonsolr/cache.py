@@ -0,0 +1,264 @@
+"""
+An in-process cache of documents keyed by id, in front of `Solr.get`::
+
+    solr = Solr(url, document_cache=DocumentCache(maxsize=50000))
+    solr.get(ids)   # only the ids that are not cached are fetched
+
+Ids missing from the cache are fetched together (one batch of real-time get
+requests) and merged back in the order asked for. Adding or deleting
+documents through the same client drops them from the cache; a delete by
+query clears it. Changes made by other clients are not seen until entries
+are evicted, so pair it with short-lived data or a bounded `maxsize`.
+
+Documents fetched with a list of fields are cached with only those fields,
+and only answer later lookups for a subset of them. Cached documents are
+shared: treat them as read-only.
+
+`policy` picks what is evicted once `maxsize` documents are cached: 'lru'
+(least recently used) or 'lfu' (least frequently used, better at keeping
+the head of a skewed popularity distribution).
+
+`AdmissionFileCache` is the HTTP response cache used by `Solr(use_cache=True)`.
+"""
+
+from collections import OrderedDict
+import os
+import re
+import threading
+import time
+
+try:
+    from httplib2 import FileCache
+except ImportError:
+    FileCache = None
+
+__all__ = ['DocumentCache', 'LRUCache', 'LFUCache', 'AdmissionFileCache']
+
+class LRUCache(object):
+    """
+    >>> cache = LRUCache(2)
+    >>> cache.put('a', 1); cache.put('b', 2); cache.get('a'); cache.put('c', 3)
+    1
+    >>> cache.get('b') is None, cache.get('a'), cache.get('c')
+    (True, 1, 3)
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        value = self.items.pop(key, None)
+        if value is not None:
+            self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def discard(self, key):
+        self.items.pop(key, None)
+
+    def clear(self):
+        self.items.clear()
+
+class LFUCache(object):
+    """
+    Evicts the least frequently used key, the least recently used one among
+    equally frequent keys. Every operation is O(1).
+
+    >>> cache = LFUCache(2)
+    >>> cache.put('a', 1); cache.put('b', 2); cache.get('a'); cache.put('c', 3)
+    1
+    >>> cache.get('b') is None, cache.get('a'), cache.get('c')
+    (True, 1, 3)
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = {}       # key -> (value, frequency)
+        self.frequencies = {} # frequency -> keys in order of use
+        self.min_frequency = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def _touch(self, key, value, frequency):
+        keys = self.frequencies[frequency]
+        del keys[key]
+        if not keys:
+            del self.frequencies[frequency]
+            if self.min_frequency == frequency:
+                self.min_frequency = frequency + 1
+        self.frequencies.setdefault(frequency + 1, OrderedDict())[key] = None
+        self.items[key] = (value, frequency + 1)
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        self._touch(key, item[0], item[1])
+        return item[0]
+
+    def put(self, key, value):
+        item = self.items.get(key)
+        if item is not None:
+            self._touch(key, value, item[1])
+            return
+        if len(self.items) >= self.maxsize:
+            keys = self.frequencies[self.min_frequency]
+            evicted, none = keys.popitem(last=False)
+            if not keys:
+                del self.frequencies[self.min_frequency]
+            del self.items[evicted]
+        self.items[key] = (value, 1)
+        self.frequencies.setdefault(1, OrderedDict())[key] = None
+        self.min_frequency = 1
+
+    def discard(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            keys = self.frequencies[item[1]]
+            del keys[key]
+            if not keys:
+                del self.frequencies[item[1]]
+        if not self.items:
+            self.min_frequency = 0
+
+    def clear(self):
+        self.items.clear()
+        self.frequencies.clear()
+        self.min_frequency = 0
+
+POLICIES = {'lru': LRUCache, 'lfu': LFUCache}
+
+class DocumentCache(object):
+    """
+    Documents by id (as unicode), with the fields they were fetched with
+    (None for all of them). `unique_key` is the field `Solr.add` reads the
+    ids of added documents from. `hits` and `misses` count lookups.
+    """
+    def __init__(self, maxsize=10000, policy='lru', unique_key='id'):
+        if policy not in POLICIES:
+            raise ValueError("Unknown cache policy %r, use one of %s" % (policy, ', '.join(sorted(POLICIES))))
+        self.store = POLICIES[policy](maxsize)
+        self.unique_key = unique_key
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.store)
+
+    def lookup(self, keys, fields=None):
+        """
+        Returns a dict of the cached documents among `keys` that have all of
+        `fields` (all fields when None).
+        """
+        found = {}
+        self.lock.acquire()
+        try:
+            for key in keys:
+                entry = self.store.get(key)
+                if entry is not None:
+                    doc, cached_fields = entry
+                    if cached_fields is None or (fields is not None and cached_fields.issuperset(fields)):
+                        found[key] = doc
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        finally:
+            self.lock.release()
+        return found
+
+    def store_docs(self, docs, fields=None):
+        """Caches `docs`, a dict of documents by key, fetched with `fields`."""
+        if fields is not None:
+            fields = frozenset(fields)
+        self.lock.acquire()
+        try:
+            for key, doc in docs.iteritems():
+                self.store.put(key, (doc, fields))
+        finally:
+            self.lock.release()
+
+    def invalidate(self, keys):
+        self.lock.acquire()
+        try:
+            for key in keys:
+                self.store.discard(unicode(key))
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.store.clear()
+        finally:
+            self.lock.release()
+
+_START = re.compile(r'[?&]start=(\d+)')
+_ZERO_HITS = re.compile(r'"numFound"\s*:\s*0\s*[,}]')
+
+if FileCache is not None:
+    class AdmissionFileCache(FileCache):
+        """
+        An httplib2 `FileCache` that only keeps the responses worth keeping:
+
+        * responses over `max_bytes` are not written (big pages would push
+          everything else out and cost more to write than to refetch),
+        * nor are pages beyond `max_start` (deep pages are rarely asked for
+          twice) or from the export handler,
+        * responses with no hits are only kept for `negative_ttl` seconds, so
+          documents added since show up quickly.
+        """
+        def __init__(self, cache, max_bytes=1024 * 1024, max_start=1000, negative_ttl=30, **kwargs):
+            FileCache.__init__(self, cache, **kwargs)
+            self.max_bytes = max_bytes
+            self.max_start = max_start
+            self.negative_ttl = negative_ttl
+            self.rejected = 0
+
+        def admit(self, key, value):
+            if self.max_bytes is not None and len(value) > self.max_bytes:
+                return False
+            if '/export' in key.split('?', 1)[0]:
+                return False
+            if self.max_start is not None:
+                start = _START.search(key)
+                if start and int(start.group(1)) > self.max_start:
+                    return False
+            if not self.negative_ttl and self._zero_hits(value):
+                return False
+            return True
+
+        def _zero_hits(self, value):
+            # only small responses can be empty, don't scan the big ones
+            return len(value) < 4096 and _ZERO_HITS.search(value) is not None
+
+        def set(self, key, value):
+            if not self.admit(key, value):
+                self.rejected += 1
+                # an older entry could still be served
+                self.delete(key)
+                return
+            FileCache.set(self, key, value)
+
+        def get(self, key):
+            path = os.path.join(self.cache, self.safe(key))
+            try:
+                f = open(path, 'rb')
+            except IOError:
+                return None
+            try:
+                stat = os.fstat(f.fileno())
+                value = f.read()
+            finally:
+                f.close()
+            if self.negative_ttl and time.time() - stat.st_mtime > self.negative_ttl and self._zero_hits(value):
+                self.delete(key)
+                return None
+            return value
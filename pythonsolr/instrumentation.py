@@ -0,0 +1,250 @@
+"""
+Client side instrumentation for `Solr`.
+
+Pass an `Instrumentation` to the client and it is told about every request::
+
+    metrics = MetricsCollector()
+    solr = Solr('http://127.0.0.1:8983/solr/', instrumentation=metrics)
+    solr.search('ipod')
+    metrics.snapshot()['select']['latency']['p99']
+
+Each request is described by a `SolrCall`. `request_started` and
+`request_finished` wrap the HTTP exchange (retries included), and
+`results_built` fires once the response has been decoded and turned into a
+result object. Comparing `wall_time`, `qtime` and `decode_time` tells network
+time, Solr time and Python time apart.
+
+`MetricsCollector` keeps per-handler (select, mlt, tvrh, update...) latency
+histograms and counters. Exporters can read `snapshot()` periodically
+(Prometheus) or register a listener that gets every observation as it
+happens (StatsD)::
+
+    metrics.add_listener(lambda metric, handler, value: statsd.timing('solr.%s.%s' % (handler, metric), value))
+"""
+
+import bisect
+import threading
+import time
+
+__all__ = ['SolrCall', 'Instrumentation', 'CompositeInstrumentation', 'Histogram', 'MetricsCollector']
+
+class SolrCall(object):
+    """
+    What is known about a single call to Solr. Times are in seconds,
+    `qtime` included (Solr reports it in milliseconds).
+    """
+    def __init__(self, handler, method, path, body=None):
+        self.handler = handler
+        self.method = method
+        self.path = path
+        self.body = body
+        self.started = time.time()
+        self.attempts = 0
+        self.status = None
+        self.error = None
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.wall_time = None
+        self.decode_time = None
+        self.build_time = None
+        self.qtime = None
+
+    def __repr__(self):
+        return "SolrCall(handler=%r, status=%r, wall_time=%r, qtime=%r)" % (
+            self.handler, self.status, self.wall_time, self.qtime)
+
+class Instrumentation(object):
+    """
+    Base class for instrumentation hooks; every hook does nothing by default.
+    """
+    def request_started(self, call):
+        pass
+
+    def request_finished(self, call):
+        """Called after the HTTP exchange, with `call.error` set if it failed."""
+        pass
+
+    def results_built(self, call):
+        """Called after the response was decoded into a result object."""
+        pass
+
+class CompositeInstrumentation(Instrumentation):
+    """Forwards every hook to several instrumentations."""
+    def __init__(self, *instrumentations):
+        self.instrumentations = list(instrumentations)
+
+    def request_started(self, call):
+        for instrumentation in self.instrumentations:
+            instrumentation.request_started(call)
+
+    def request_finished(self, call):
+        for instrumentation in self.instrumentations:
+            instrumentation.request_finished(call)
+
+    def results_built(self, call):
+        for instrumentation in self.instrumentations:
+            instrumentation.results_built(call)
+
+# upper bounds in seconds, from 1ms to a minute
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram(object):
+    """
+    A fixed-bucket histogram, cheap enough to update on every request.
+
+    >>> h = Histogram()
+    >>> for value in (0.002, 0.003, 0.02, 0.2):
+    ...     h.observe(value)
+    >>> h.count, h.percentile(50)
+    (4, 0.005)
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """
+        Upper bound of the bucket holding the `percent` percentile (the
+        largest observed value for the overflow bucket).
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if i < len(self.buckets):
+                    return self.buckets[i]
+                return self.max
+        return self.max
+
+    def snapshot(self):
+        cumulative = []
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            cumulative.append((bound, seen))
+        cumulative.append(('+Inf', self.count))
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': cumulative,
+        }
+
+class _HandlerMetrics(object):
+    TIMINGS = ('latency', 'qtime', 'decode', 'build')
+
+    def __init__(self, buckets):
+        self.requests = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.histograms = dict((name, Histogram(buckets)) for name in self.TIMINGS)
+
+    def snapshot(self):
+        result = {
+            'requests': self.requests,
+            'errors': self.errors,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+        }
+        for name, histogram in self.histograms.iteritems():
+            result[name] = histogram.snapshot()
+        return result
+
+class MetricsCollector(Instrumentation):
+    """
+    Aggregates calls per handler: request, error and byte counters, and
+    histograms of wall-clock latency, Solr `QTime`, decode time and result
+    construction time.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.handlers = {}
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def add_listener(self, listener):
+        """
+        `listener(metric, handler, value)` is called for every counter
+        increment ('requests', 'errors', 'bytes_in', 'bytes_out') and every
+        timing ('latency', 'qtime', 'decode', 'build', in seconds).
+        """
+        self.listeners.append(listener)
+
+    def _metrics(self, handler):
+        metrics = self.handlers.get(handler)
+        if metrics is None:
+            metrics = self.handlers[handler] = _HandlerMetrics(self.buckets)
+        return metrics
+
+    def _emit(self, handler, observations):
+        for listener in self.listeners:
+            for metric, value in observations:
+                listener(metric, handler, value)
+
+    def request_finished(self, call):
+        observations = [('requests', 1), ('bytes_out', call.bytes_out), ('bytes_in', call.bytes_in),
+                        ('latency', call.wall_time)]
+        if call.error is not None:
+            observations.append(('errors', 1))
+        self.lock.acquire()
+        try:
+            metrics = self._metrics(call.handler)
+            metrics.requests += 1
+            metrics.bytes_out += call.bytes_out
+            metrics.bytes_in += call.bytes_in
+            metrics.histograms['latency'].observe(call.wall_time)
+            if call.error is not None:
+                metrics.errors += 1
+        finally:
+            self.lock.release()
+        self._emit(call.handler, observations)
+
+    def results_built(self, call):
+        observations = []
+        for name, value in (('qtime', call.qtime), ('decode', call.decode_time), ('build', call.build_time)):
+            if value is not None:
+                observations.append((name, value))
+        self.lock.acquire()
+        try:
+            metrics = self._metrics(call.handler)
+            for name, value in observations:
+                metrics.histograms[name].observe(value)
+        finally:
+            self.lock.release()
+        self._emit(call.handler, observations)
+
+    def snapshot(self):
+        """Returns the current metrics as a dict keyed by handler."""
+        self.lock.acquire()
+        try:
+            return dict((handler, metrics.snapshot()) for handler, metrics in self.handlers.iteritems())
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.handlers = {}
+        finally:
+            self.lock.release()
@@ -0,0 +1,388 @@
+"""
+Reader and writer for Solr's binary response format (`wt=javabin`).
+
+Responses are decoded into the same structures Solr's JSON response writer
+produces with the default `json.nl=flat`: ordered maps become dicts, named
+lists become flat `[name, value, name, value...]` lists, document lists
+become `{'numFound': .., 'start': .., 'docs': [..]}` and dates become
+`'YYYY-MM-DDTHH:MM:SSZ'` strings. This way `Results`, `GroupedResults` and
+`TermVectorResult` work unchanged. Use it with `Solr(url, wt='javabin')`.
+
+Only version 2 of the format (Solr 3.1+) is supported.
+
+>>> data = JavaBinEncoder().encode({'response': {'numFound': 1, 'start': 0, 'docs': [{'id': u'1'}]}})
+>>> JavaBinDecoder().decode(data)['response']['docs']
+[{u'id': u'1'}]
+"""
+
+from base64 import b64encode
+from datetime import datetime, date, timedelta
+import struct
+
+__all__ = ['JavaBinDecoder', 'JavaBinEncoder', 'JavaBinError']
+
+VERSION = 2
+
+# simple tags
+NULL = 0
+BOOL_TRUE = 1
+BOOL_FALSE = 2
+BYTE = 3
+SHORT = 4
+DOUBLE = 5
+INT = 6
+LONG = 7
+FLOAT = 8
+DATE = 9
+MAP = 10
+SOLRDOC = 11
+SOLRDOCLST = 12
+BYTEARR = 13
+ITERATOR = 14
+END = 15
+SOLRINPUTDOC = 16
+MAP_ENTRY_ITER = 17
+ENUM_FIELD_VALUE = 18
+MAP_ENTRY = 19
+
+# tags that carry a size (or a small value) in their lower 5 bits
+STR = 1 << 5
+SINT = 2 << 5
+SLONG = 3 << 5
+ARR = 4 << 5
+ORDERED_MAP = 5 << 5
+NAMED_LST = 6 << 5
+EXTERN_STRING = 7 << 5
+
+EPOCH = datetime(1970, 1, 1)
+
+_unpack_byte = struct.Struct('>b').unpack_from
+_unpack_short = struct.Struct('>h').unpack_from
+_unpack_int = struct.Struct('>i').unpack_from
+_unpack_long = struct.Struct('>q').unpack_from
+_unpack_float = struct.Struct('>f').unpack_from
+_unpack_double = struct.Struct('>d').unpack_from
+
+class JavaBinError(ValueError):
+    pass
+
+class _End(object):
+    """Marks the end of an ITERATOR or MAP_ENTRY_ITER."""
+    pass
+
+_END = _End()
+
+class _Document(dict):
+    """A decoded SolrDocument, so child documents can be told apart from field names."""
+    pass
+
+def format_date(millis):
+    """
+    Formats milliseconds since the epoch the way Solr's JSON writer does.
+
+    >>> format_date(0)
+    '1970-01-01T00:00:00Z'
+    >>> format_date(1262304000120)
+    '2010-01-01T00:00:00.12Z'
+    """
+    value = EPOCH + timedelta(milliseconds=millis)
+    formatted = value.strftime('%Y-%m-%dT%H:%M:%S')
+    fraction = millis % 1000
+    if fraction:
+        formatted += ('.%03d' % fraction).rstrip('0')
+    return formatted + 'Z'
+
+class _Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.strings = []
+
+    def read(self):
+        version = self.read_byte()
+        if version != VERSION:
+            raise JavaBinError("Unsupported javabin version %s (expected %s)" % (version, VERSION))
+        return self.read_val()
+
+    def read_byte(self):
+        pos = self.pos
+        self.pos = pos + 1
+        return ord(self.data[pos])
+
+    def read_vint(self):
+        data = self.data
+        pos = self.pos
+        b = ord(data[pos])
+        pos += 1
+        result = b & 0x7f
+        shift = 7
+        while b & 0x80:
+            b = ord(data[pos])
+            pos += 1
+            result |= (b & 0x7f) << shift
+            shift += 7
+        self.pos = pos
+        return result
+
+    def read_size(self, tag):
+        size = tag & 0x1f
+        if size == 0x1f:
+            size += self.read_vint()
+        return size
+
+    def read_small(self, tag):
+        value = tag & 0x0f
+        if tag & 0x10:
+            value |= self.read_vint() << 4
+        return value
+
+    def read_struct(self, unpack, size):
+        pos = self.pos
+        self.pos = pos + size
+        return unpack(self.data, pos)[0]
+
+    def read_str(self, tag):
+        size = self.read_size(tag)
+        pos = self.pos
+        self.pos = pos + size
+        return self.data[pos:pos + size].decode('utf-8')
+
+    def read_val(self):
+        tag = self.read_byte()
+        kind = tag >> 5
+        if kind == 1:
+            return self.read_str(tag)
+        elif kind == 2 or kind == 3:
+            return self.read_small(tag)
+        elif kind == 4:
+            read_val = self.read_val
+            return [read_val() for i in xrange(self.read_size(tag))]
+        elif kind == 5:
+            read_val = self.read_val
+            result = {}
+            for i in xrange(self.read_size(tag)):
+                key = read_val()
+                result[key] = read_val()
+            return result
+        elif kind == 6:
+            read_val = self.read_val
+            result = []
+            for i in xrange(self.read_size(tag)):
+                result.append(read_val())
+                result.append(read_val())
+            return result
+        elif kind == 7:
+            index = self.read_size(tag)
+            if index:
+                return self.strings[index - 1]
+            value = self.read_val()
+            self.strings.append(value)
+            return value
+
+        if tag == NULL:
+            return None
+        elif tag == BOOL_TRUE:
+            return True
+        elif tag == BOOL_FALSE:
+            return False
+        elif tag == INT:
+            return self.read_struct(_unpack_int, 4)
+        elif tag == LONG:
+            return self.read_struct(_unpack_long, 8)
+        elif tag == FLOAT:
+            return self.read_struct(_unpack_float, 4)
+        elif tag == DOUBLE:
+            return self.read_struct(_unpack_double, 8)
+        elif tag == BYTE:
+            return self.read_struct(_unpack_byte, 1)
+        elif tag == SHORT:
+            return self.read_struct(_unpack_short, 2)
+        elif tag == DATE:
+            return format_date(self.read_struct(_unpack_long, 8))
+        elif tag == SOLRDOC:
+            return self.read_document()
+        elif tag == SOLRDOCLST:
+            return self.read_document_list()
+        elif tag == MAP:
+            result = {}
+            for i in xrange(self.read_vint()):
+                key = self.read_val()
+                result[key] = self.read_val()
+            return result
+        elif tag == BYTEARR:
+            size = self.read_vint()
+            pos = self.pos
+            self.pos = pos + size
+            # the JSON writer base64 encodes binary fields
+            return b64encode(self.data[pos:pos + size])
+        elif tag == ITERATOR:
+            result = []
+            while True:
+                value = self.read_val()
+                if value is _END:
+                    return result
+                result.append(value)
+        elif tag == END:
+            return _END
+        elif tag == MAP_ENTRY_ITER:
+            result = {}
+            while True:
+                key = self.read_val()
+                if key is _END:
+                    return result
+                result[key] = self.read_val()
+        elif tag == ENUM_FIELD_VALUE:
+            self.read_val() # the ordinal, JSON only shows the label
+            return self.read_val()
+        elif tag == MAP_ENTRY:
+            key = self.read_val()
+            return {key: self.read_val()}
+        raise JavaBinError("Unknown javabin tag %s at offset %s" % (tag, self.pos - 1))
+
+    def read_document(self):
+        read_val = self.read_val
+        doc = _Document()
+        for i in xrange(self.read_size(self.read_byte())):
+            key = read_val()
+            if isinstance(key, _Document):
+                doc.setdefault('_childDocuments_', []).append(key)
+            else:
+                doc[key] = read_val()
+        return doc
+
+    def read_document_list(self):
+        # [numFound, start, maxScore], and numFoundExact since Solr 8.6
+        header = self.read_val()
+        result = {'numFound': header[0], 'start': header[1], 'docs': self.read_val()}
+        if header[2] is not None:
+            result['maxScore'] = header[2]
+        if len(header) > 3:
+            result['numFoundExact'] = header[3]
+        return result
+
+class JavaBinDecoder(object):
+    """
+    Decodes javabin responses. Has the same `decode` method as
+    `json.JSONDecoder`, so it can be used as the `decoder` of `Solr` and of
+    the result classes.
+    """
+    def decode(self, data):
+        """
+        >>> data = JavaBinEncoder().encode({'numFound': 3, 'start': 0, 'numFoundExact': True, 'docs': []})
+        >>> sorted(JavaBinDecoder().decode(data).items())
+        [('docs', []), ('numFound', 3), ('numFoundExact', True), ('start', 0)]
+        >>> JavaBinDecoder().decode(data[:4])
+        Traceback (most recent call last):
+        ...
+        JavaBinError: Truncated javabin response
+        """
+        try:
+            return _Reader(data).read()
+        except JavaBinError:
+            raise
+        except (IndexError, struct.error):
+            raise JavaBinError("Truncated javabin response")
+        except (ValueError, TypeError), e:
+            raise JavaBinError("Invalid javabin response: %s" % e)
+
+class JavaBinEncoder(object):
+    """
+    Encodes python values as javabin. Dicts that look like a document list
+    (`numFound`, `start` and `docs` keys) are written as SolrDocumentLists.
+    This is mostly useful to build canned responses for tests and benchmarks.
+    """
+    def encode(self, obj):
+        self.strings = {}
+        out = [chr(VERSION)]
+        self.write_val(obj, out)
+        return ''.join(out)
+
+    def write_tag(self, tag, size, out):
+        if size < 0x1f:
+            out.append(chr(tag | size))
+        else:
+            out.append(chr(tag | 0x1f))
+            self.write_vint(size - 0x1f, out)
+
+    def write_vint(self, value, out):
+        while value & ~0x7f:
+            out.append(chr((value & 0x7f) | 0x80))
+            value >>= 7
+        out.append(chr(value))
+
+    def write_small(self, tag, value, out):
+        if value < 0x10:
+            out.append(chr(tag | value))
+        else:
+            out.append(chr(tag | 0x10 | (value & 0x0f)))
+            self.write_vint(value >> 4, out)
+
+    def write_str(self, value, out):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        self.write_tag(STR, len(value), out)
+        out.append(value)
+
+    def write_extern_str(self, value, out):
+        index = self.strings.get(value)
+        if index:
+            self.write_tag(EXTERN_STRING, index, out)
+        else:
+            self.write_tag(EXTERN_STRING, 0, out)
+            self.write_str(value, out)
+            self.strings[value] = len(self.strings) + 1
+
+    def write_val(self, value, out):
+        if value is None:
+            out.append(chr(NULL))
+        elif value is True:
+            out.append(chr(BOOL_TRUE))
+        elif value is False:
+            out.append(chr(BOOL_FALSE))
+        elif isinstance(value, (int, long)):
+            if 0 <= value < 2 ** 31:
+                self.write_small(SINT, value, out)
+            elif -2 ** 31 <= value < 2 ** 31:
+                out.append(chr(INT) + struct.pack('>i', value))
+            elif 0 <= value < 2 ** 63:
+                self.write_small(SLONG, value, out)
+            else:
+                out.append(chr(LONG) + struct.pack('>q', value))
+        elif isinstance(value, float):
+            out.append(chr(DOUBLE) + struct.pack('>d', value))
+        elif isinstance(value, basestring):
+            self.write_str(value, out)
+        elif isinstance(value, datetime):
+            millis = int((value - EPOCH).total_seconds() * 1000)
+            out.append(chr(DATE) + struct.pack('>q', millis))
+        elif isinstance(value, date):
+            self.write_val(datetime(value.year, value.month, value.day), out)
+        elif isinstance(value, dict):
+            if 'docs' in value and 'numFound' in value:
+                self.write_document_list(value, out)
+            else:
+                self.write_tag(ORDERED_MAP, len(value), out)
+                for key, item in value.iteritems():
+                    self.write_str(key, out)
+                    self.write_val(item, out)
+        elif isinstance(value, (list, tuple)):
+            self.write_tag(ARR, len(value), out)
+            for item in value:
+                self.write_val(item, out)
+        else:
+            raise JavaBinError("Can't encode %r as javabin" % (value,))
+
+    def write_document_list(self, value, out):
+        out.append(chr(SOLRDOCLST))
+        header = [value['numFound'], value.get('start', 0), value.get('maxScore')]
+        if 'numFoundExact' in value:
+            header.append(value['numFoundExact'])
+        self.write_val(header, out)
+        docs = value['docs']
+        self.write_tag(ARR, len(docs), out)
+        for doc in docs:
+            out.append(chr(SOLRDOC))
+            self.write_tag(ORDERED_MAP, len(doc), out)
+            for key, item in doc.iteritems():
+                self.write_extern_str(key, out)
+                self.write_val(item, out)
@@ -0,0 +1,175 @@
+"""
+JSON encoding and decoding through the fastest library available.
+
+The backends are tried in order: orjson, ujson, simplejson (only when its C
+speedups are compiled) and the standard library's json. `default_codec` is
+the first one that imports, looked for on first use, and is what `Solr`, the
+result classes and `SolrJson` updates use unless given another codec::
+
+    solr = Solr(url, json_codec='simplejson')
+
+Only backends that read and write floats exactly are picked by default.
+ujson 1.x rounds floats both ways (scores, prices and coordinates would
+change), so when the installed version can't be made exact it is only
+used when asked for by name.
+
+A codec has the `decode` method of `json.JSONDecoder`, so it can be passed
+wherever a `decoder` is expected, and an `encode` method returning a
+`str`. Responses are decoded straight from the bytes read off the socket:
+every backend parses UTF-8 input itself, there is no intermediate unicode
+copy of the body.
+
+>>> codec = get_codec('json')
+>>> codec.decode('{"response": {"numFound": 1}}')
+{u'response': {u'numFound': 1}}
+>>> codec.encode({'id': u'caf\\xe9'})
+'{"id": "caf\\\\u00e9"}'
+"""
+
+__all__ = ['JSONCodec', 'get_codec', 'best_codec', 'available_codecs', 'default_codec']
+
+class JSONCodec(object):
+    """`exact` is false for a backend that rounds floats."""
+    def __init__(self, name, decode, encode, exact=True):
+        self.name = name
+        self.decode = decode
+        self.encode = encode
+        self.exact = exact
+
+    def __repr__(self):
+        return "JSONCodec(%r)" % self.name
+
+def _orjson():
+    import orjson
+    return JSONCodec('orjson', orjson.loads, orjson.dumps)
+
+# floats that lose digits when parsed or printed with less than 17 digits
+_FLOATS = [0.1, 0.30000000000000004, 2.718281828459045, 123456.78901234567, 1.7976931348623157e308, 5e-324]
+
+def _round_trips(decode, encode):
+    try:
+        return (decode(repr(_FLOATS)) == _FLOATS and decode(encode(_FLOATS)) == _FLOATS)
+    except (TypeError, ValueError, OverflowError):
+        return False
+
+def _ujson():
+    import ujson
+    # the most precise options this version of ujson takes: ujson 1.x rounds
+    # floats unless told otherwise, and prints at most 15 digits anyway
+    loads_options = {}
+    try:
+        ujson.loads('0.1', precise_float=True)
+        loads_options['precise_float'] = True
+    except TypeError:
+        pass
+    dumps_options = {'ensure_ascii': True, 'escape_forward_slashes': False}
+    for digits in (17, 15):
+        try:
+            ujson.dumps(0.1, double_precision=digits)
+        except (TypeError, ValueError):
+            continue
+        dumps_options['double_precision'] = digits
+        break
+    def decode(data):
+        return ujson.loads(data, **loads_options)
+    def encode(obj):
+        # like the other backends: ascii only, '/' left alone
+        return ujson.dumps(obj, **dumps_options)
+    return JSONCodec('ujson', decode, encode, exact=_round_trips(decode, encode))
+
+def _simplejson():
+    import simplejson
+    try:
+        from simplejson import _speedups
+    except ImportError:
+        # pure python simplejson is much slower than the stdlib module
+        raise ImportError("simplejson was built without its C speedups")
+    return JSONCodec('simplejson', simplejson.JSONDecoder().decode, simplejson.JSONEncoder().encode)
+
+def _json():
+    import json
+    return JSONCodec('json', json.JSONDecoder().decode, json.JSONEncoder().encode)
+
+# fastest first
+BACKENDS = (('orjson', _orjson), ('ujson', _ujson), ('simplejson', _simplejson), ('json', _json))
+
+_codecs = {}
+
+def get_codec(name=None):
+    """
+    The codec of backend `name`, or the fastest one available when None. A
+    `JSONCodec` is returned as is. Raises ImportError if the backend can't
+    be loaded.
+    """
+    if isinstance(name, JSONCodec):
+        return name
+    if name is None:
+        return default_codec
+    codec = _codecs.get(name)
+    if codec is None:
+        factories = dict(BACKENDS)
+        if name not in factories:
+            raise ValueError("Unknown JSON backend %r, use one of %s" % (name, ', '.join(dict(BACKENDS))))
+        try:
+            codec = factories[name]()
+        except ImportError, e:
+            # don't search the path again for a missing backend
+            codec = e
+        _codecs[name] = codec
+    if isinstance(codec, ImportError):
+        raise codec
+    return codec
+
+def available_codecs():
+    """The codecs that can be loaded here, fastest first."""
+    codecs = []
+    for name, factory in BACKENDS:
+        try:
+            codecs.append(get_codec(name))
+        except ImportError:
+            pass
+    return codecs
+
+def best_codec():
+    """The fastest codec available that keeps floats exact."""
+    for name, factory in BACKENDS:
+        try:
+            codec = get_codec(name)
+        except ImportError:
+            continue
+        if codec.exact:
+            return codec
+
+class _DefaultCodec(JSONCodec):
+    """
+    Stands for `best_codec()`, which is only looked for when first used so
+    that importing this module doesn't try to import every backend. It then
+    takes the chosen codec's methods as its own.
+    """
+    def __init__(self):
+        pass
+
+    def _resolve(self):
+        codec = best_codec()
+        self.name = codec.name
+        self.decode = codec.decode
+        self.encode = codec.encode
+
+    def __getattr__(self, name):
+        if name != 'name':
+            raise AttributeError(name)
+        self._resolve()
+        return self.name
+
+    def decode(self, data):
+        self._resolve()
+        return self.decode(data)
+
+    def encode(self, obj):
+        self._resolve()
+        return self.encode(obj)
+
+    def __repr__(self):
+        return "JSONCodec(%r)" % self.name
+
+default_codec = _DefaultCodec()
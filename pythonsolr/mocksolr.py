@@ -0,0 +1,406 @@
+"""
+An in-process fake Solr server serving canned responses, for benchmarks and
+dry runs that must not depend on a live Solr::
+
+    server = MockSolrServer(num_docs=10000, latency=0.005).start()
+    solr = Solr(server.url)
+    solr.search('*:*', rows=100)
+    server.stop()
+
+The server answers the select (plain, grouped and faceted), mlt, tvrh,
+get, export, suggest, terms, update, luke and core admin handlers from a generated corpus of `num_docs` documents, in JSON or
+javabin depending on `wt`. Documents are shaped like articles; `doc_words`
+controls the size of their text. `latency` seconds are added to every
+request and `qtime` is reported as Solr's QTime. An optimize merges the
+index's `segments` down one at a time, taking `merge_time` seconds each.
+Only the `docvalues` fields can be exported (all of them when None). Responses are gzipped when
+the client accepts it and `compress` is true.
+
+Counters of requests per handler and of indexed documents are kept in
+`requests` and `docs_added`.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import gzip
+import random
+import threading
+import time
+import zlib
+from cStringIO import StringIO
+from urlparse import urlsplit, parse_qs
+
+from pysolr import json
+from javabin import JavaBinEncoder
+
+__all__ = ['MockSolrServer', 'make_docs']
+
+WORDS = ('solr', 'lucene', 'index', 'query', 'facet', 'shard', 'replica', 'segment',
+         'merge', 'commit', 'analyzer', 'token', 'stemmer', 'boost', 'score', 'field')
+
+PUBLISHERS = ('daily-planet', 'gotham-gazette', 'bugle', 'inquirer', 'sentinel')
+
+def make_docs(num_docs, doc_words=120, seed=42):
+    """Builds `num_docs` article-like documents, always the same for a given seed."""
+    rnd = random.Random(seed)
+    docs = []
+    for i in xrange(num_docs):
+        docs.append({
+            'id': u'article-%d' % i,
+            'title': u' '.join(rnd.choice(WORDS) for j in xrange(8)),
+            'text': u' '.join(rnd.choice(WORDS) for j in xrange(doc_words)),
+            'tags': [rnd.choice(WORDS) for j in xrange(5)],
+            'publisher': rnd.choice(PUBLISHERS),
+            'views': rnd.randint(0, 1000000),
+            'pub_date': u'2012-%02d-%02dT10:00:00Z' % (rnd.randint(1, 12), rnd.randint(1, 28)),
+        })
+    return docs
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # buffer the headers and send them with the body, otherwise Nagle's
+    # algorithm and delayed ACKs add ~40ms to every keep-alive request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';', 1)[0].strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = ''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('content-length') or 0))
+        if self.headers.get('content-encoding', '').lower() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def _handle(self):
+        server = self.server.mock
+        scheme, netloc, path, query, fragment = urlsplit(self.path)
+        body = self._read_body() if self.command == 'POST' else ''
+        params = parse_qs(query, keep_blank_values=True)
+        if self.headers.get('content-type', '').startswith('application/x-www-form-urlencoded'):
+            params.update(parse_qs(body, keep_blank_values=True))
+            body = ''
+
+        status, response, content_type = server.respond(path, params, body)
+        if server.compress and 'gzip' in self.headers.get('accept-encoding', ''):
+            out = StringIO()
+            f = gzip.GzipFile(fileobj=out, mode='wb', compresslevel=6)
+            f.write(response)
+            f.close()
+            response = out.getvalue()
+            encoding = 'gzip'
+        else:
+            encoding = None
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(response)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.end_headers()
+        self.wfile.write(response)
+
+    do_GET = do_POST = _handle
+
+class MockSolrServer(object):
+    def __init__(self, num_docs=1000, doc_words=120, latency=0.0, qtime=1, compress=True,
+                 host='127.0.0.1', port=0, core='core0', docs=None, segments=10, merge_time=0.05,
+                 docvalues=None):
+        self.docs = docs if docs is not None else make_docs(num_docs, doc_words)
+        self.latency = latency
+        self.qtime = qtime
+        self.compress = compress
+        self.core = core
+        self.cores = {core: {}}
+        self._by_id = None
+        self._titles = None
+        self.docvalues = docvalues
+        self.segments = segments
+        self.merge_time = merge_time
+        self.requests = {}
+        self.docs_added = 0
+        self.lock = threading.Lock()
+        self.httpd = _ThreadingHTTPServer((host, port), _RequestHandler)
+        self.httpd.mock = self
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%s/solr/' % (host, port)
+
+    @property
+    def url(self):
+        return self.base_url + self.core
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # Responses ##############################################################
+
+    def respond(self, path, params, body):
+        """Returns `(status, body, content_type)` for a request."""
+        handler = path.rstrip('/').rsplit('/', 1)[-1]
+        if handler == 'json' and path.rstrip('/').endswith('update/json'):
+            handler = 'update'
+        self.lock.acquire()
+        try:
+            self.requests[handler] = self.requests.get(handler, 0) + 1
+        finally:
+            self.lock.release()
+        if self.latency:
+            time.sleep(self.latency)
+
+        method = getattr(self, 'handle_%s' % handler, None)
+        if method is None:
+            return 404, '<html><pre>Unknown handler %s</pre></html>' % handler, 'text/html'
+        result = method(params, body)
+        result.setdefault('responseHeader', {'status': 0, 'QTime': self.qtime})
+        if params.get('wt', ['json'])[0] == 'javabin':
+            return 200, JavaBinEncoder().encode(result), 'application/octet-stream'
+        return 200, json.dumps(result), 'application/json'
+
+    def _page(self, params, docs=None):
+        docs = self.docs if docs is None else docs
+        start = int(params.get('start', [0])[0])
+        rows = int(params.get('rows', [10])[0])
+        return {'numFound': len(docs), 'start': start, 'docs': docs[start:start + rows]}
+
+    def _facet_values(self, field, docs=None):
+        counts = {}
+        for doc in self.docs if docs is None else docs:
+            values = doc.get(field)
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                counts[value] = counts.get(value, 0) + 1
+        return counts
+
+    def _facets(self, params):
+        facet_fields = {}
+        prefix = params.get('facet.prefix', [''])[0]
+        offset = int(params.get('facet.offset', [0])[0])
+        limit = int(params.get('facet.limit', [100])[0])
+        mincount = int(params.get('facet.mincount', [0])[0])
+        for field in params.get('facet.field', []):
+            counts = [(value, count) for value, count in self._facet_values(field).items()
+                      if count >= mincount and unicode(value).startswith(prefix)]
+            if params.get('facet.sort', ['count'])[0] == 'index':
+                counts.sort()
+            else:
+                counts.sort(key=lambda item: (-item[1], item[0]))
+            if limit >= 0:
+                counts = counts[offset:offset + limit]
+            flat = []
+            for value, count in counts:
+                flat.extend((value, count))
+            facet_fields[field] = flat
+        result = {'facet_queries': {}, 'facet_fields': facet_fields, 'facet_dates': {}}
+        if params.get('facet.pivot'):
+            result['facet_pivot'] = dict((pivot, self._pivot(pivot.split(','), self.docs))
+                                         for pivot in params['facet.pivot'])
+        return result
+
+    def _pivot(self, fields, docs):
+        field = fields[0]
+        nodes = []
+        for value, count in sorted(self._facet_values(field, docs).items(), key=lambda item: (-item[1], item[0])):
+            node = {'field': field, 'value': value, 'count': count}
+            if len(fields) > 1:
+                node['pivot'] = self._pivot(fields[1:], [doc for doc in docs if doc.get(field) == value
+                                                         or value in (doc.get(field) or ())])
+            nodes.append(node)
+        return nodes
+
+    def _sorted_docs(self, params):
+        docs = self.docs
+        for clause in reversed(params.get('sort', [''])[0].split(',')):
+            if clause.strip():
+                field, direction = (clause.split() + ['asc'])[:2]
+                docs = sorted(docs, key=lambda doc: doc.get(field), reverse=direction == 'desc')
+        return docs
+
+    def handle_select(self, params, body):
+        if params.get('group', [''])[0] == 'true':
+            return self.handle_group(params, body)
+        if 'cursorMark' in params:
+            # the mark is simply the offset of the next page
+            mark = params['cursorMark'][0]
+            start = 0 if mark == '*' else int(mark)
+            page = self._page(dict(params, start=[start]), self._sorted_docs(params))
+            return {'response': page, 'nextCursorMark': str(start + len(page['docs'])) if page['docs'] else mark}
+        result = {'response': self._page(params)}
+        if params.get('mlt', [''])[0] == 'true':
+            count = int(params.get('mlt.count', [5])[0])
+            similar = []
+            for i, doc in enumerate(result['response']['docs']):
+                similar.extend((doc['id'], {'numFound': len(self.docs) - 1, 'start': 0,
+                                            'docs': [other for other in self.docs[i + 1:i + 1 + count]]}))
+            result['moreLikeThis'] = similar
+        if params.get('facet', [''])[0] in ('on', 'true'):
+            result['facet_counts'] = self._facets(params)
+        return result
+
+    def handle_group(self, params, body):
+        start = int(params.get('start', [0])[0])
+        rows = int(params.get('rows', [10])[0])
+        group_limit = int(params.get('group.limit', [1])[0])
+        grouped = {}
+        for field in params.get('group.field', []):
+            groups = {}
+            order = []
+            for doc in self.docs:
+                value = doc.get(field)
+                if value not in groups:
+                    groups[value] = []
+                    order.append(value)
+                groups[value].append(doc)
+            grouped[field] = {
+                'matches': len(self.docs),
+                'ngroups': len(order),
+                'groups': [{'groupValue': value,
+                            'doclist': {'numFound': len(groups[value]), 'start': 0,
+                                        'docs': groups[value][:group_limit]}}
+                           for value in order[start:start + rows]],
+            }
+        return {'grouped': grouped}
+
+    def handle_mlt(self, params, body):
+        return {'match': {'numFound': 1, 'start': 0, 'docs': self.docs[:1]},
+                'response': self._page(params, self.docs[1:])}
+
+    def handle_tvrh(self, params, body):
+        page = self._page(params)
+        fields = params.get('tv.fl', ['text'])[0].split(',')
+        # the Solr 1.4/3.x layout: one 'doc-N' entry per document, then the uniqueKey field name
+        term_vectors = []
+        for i, doc in enumerate(page['docs']):
+            entry = ['uniqueKey', doc['id']]
+            for field in fields:
+                words = doc.get(field, u'').split()
+                terms = []
+                for word in sorted(set(words)):
+                    tf = words.count(word)
+                    terms.extend((word, ['tf', tf, 'df', len(self.docs), 'tf-idf', float(tf) / len(self.docs)]))
+                entry.extend((field, terms))
+            term_vectors.extend(('doc-%d' % i, entry))
+        term_vectors.extend(('uniqueKeyFieldName', 'id'))
+        return {'response': page, 'termVectors': term_vectors}
+
+    def handle_cores(self, params, body):
+        action = params.get('action', ['status'])[0].lower()
+        self.lock.acquire()
+        try:
+            if action == 'create':
+                self.cores.setdefault(params['name'][0], {})
+            elif action == 'unload':
+                self.cores.pop(params['core'][0], None)
+            if action != 'status':
+                return {}
+            names = params.get('core') or sorted(self.cores)
+            return {'status': dict((name, {'name': name, 'index': {'numDocs': len(self.docs)}} if name in self.cores else {})
+                                   for name in names)}
+        finally:
+            self.lock.release()
+
+    def handle_get(self, params, body):
+        if self._by_id is None:
+            self._by_id = dict((doc['id'], doc) for doc in self.docs)
+        ids = list(params.get('id', []))
+        for value in params.get('ids', []):
+            ids.extend(value.split(','))
+        docs = [self._by_id[id.decode('utf-8')] for id in ids if id.decode('utf-8') in self._by_id]
+        if 'fl' in params:
+            fields = params['fl'][0].split(',')
+            docs = [dict((field, doc[field]) for field in fields if field in doc) for doc in docs]
+        if len(ids) == 1 and 'ids' not in params:
+            return {'doc': docs[0] if docs else None}
+        return {'response': {'numFound': len(docs), 'start': 0, 'docs': docs}}
+
+    def handle_export(self, params, body):
+        fields = params['fl'][0].split(',')
+        if self.docvalues is not None:
+            for field in fields:
+                if field not in self.docvalues:
+                    return {'responseHeader': {'status': 400},
+                            'response': {'numFound': 0, 'docs': [
+                                {'EXCEPTION': 'field %s must have DocValues to use this feature.' % field}]}}
+        docs = [dict((field, doc[field]) for field in fields if field in doc) for doc in self._sorted_docs(params)]
+        return {'response': {'numFound': len(docs), 'docs': docs}}
+
+    def handle_suggest(self, params, body):
+        # SuggestComponent style, suggesting titles by views
+        prefix = params.get('suggest.q', params.get('q', ['']))[0].decode('utf-8').lower()
+        count = int(params.get('suggest.count', [10])[0])
+        if self._titles is None:
+            self._titles = sorted(((doc['views'], doc['title']) for doc in self.docs), reverse=True)
+        found = [{'term': title, 'weight': views, 'payload': ''}
+                 for views, title in self._titles if title.startswith(prefix)]
+        dictionary = params.get('suggest.dictionary', ['mock'])[0]
+        return {'suggest': {dictionary: {prefix: {'numFound': min(count, len(found)),
+                                                  'suggestions': found[:count]}}}}
+
+    def handle_terms(self, params, body):
+        prefix = params.get('terms.prefix', [''])[0].decode('utf-8')
+        limit = int(params.get('terms.limit', [10])[0])
+        terms = {}
+        for field in params.get('terms.fl', []):
+            counts = {}
+            for doc in self.docs:
+                values = doc.get(field)
+                for value in values.split() if isinstance(values, basestring) else values or ():
+                    if unicode(value).startswith(prefix):
+                        counts[value] = counts.get(value, 0) + 1
+            flat = []
+            for value, count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit]:
+                flat.extend((value, count))
+            terms[field] = flat
+        return {'terms': terms}
+
+    def handle_luke(self, params, body):
+        return {'index': {'numDocs': len(self.docs), 'maxDoc': len(self.docs), 'segmentCount': self.segments}}
+
+    def handle_update(self, params, body):
+        if params.get('optimize', [''])[0] == 'true':
+            target = int(params.get('maxSegments', [1])[0])
+            while self.segments > target:
+                time.sleep(self.merge_time)
+                self.segments -= 1
+        if body.startswith('['):
+            added = len(json.loads(body))
+        else:
+            added = body.count('<doc>')
+        self.lock.acquire()
+        try:
+            self.docs_added += added
+        finally:
+            self.lock.release()
+        return {}
@@ -0,0 +1,173 @@
+"""
+A log of the slow calls made by a `Solr` client, with what is needed to
+replay and diagnose them::
+
+    slow_log = SlowQueryLog(threshold=0.5)
+    solr = Solr(url, instrumentation=slow_log)
+    ...
+    for entry in slow_log.entries:
+        print entry['total_time'], entry['params'], entry['stack'][-1]
+
+A call is slow when the request plus the decoding and construction of the
+results took `threshold` seconds or more. Its entry has the handler, the
+method, the path and body as sent, the decoded request `params`, Solr's
+QTime, the size of the response, the time spent on the wire, decoding and
+building results, and the stack of the code that made the call.
+
+Only a `sample_rate` fraction of the calls is looked at. The others cost a
+random number; the sampled ones keep a reference to the calling frame,
+and the stack is only extracted for slow calls. Entries are also logged to
+the 'solr.slow' logger. An entry is logged as soon as the request itself
+crosses the threshold, and its decode and build times are filled in
+afterwards.
+
+To see where the time goes inside the client, profile the calls of a block
+with cProfile; the statistics are attached to the entries of its slow
+calls::
+
+    with slow_log.profiling():
+        solr.search('ipod', rows=1000)
+"""
+
+from collections import deque
+from contextlib import contextmanager
+from urlparse import parse_qs
+import logging
+import os
+import random
+import sys
+import threading
+import traceback
+
+from instrumentation import Instrumentation
+
+__all__ = ['SlowQueryLog']
+
+log = logging.getLogger('solr.slow')
+
+# frames of the client itself are left out of the recorded stacks
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# the handlers whose responses are turned into results
+_RESULT_HANDLERS = ('select', 'mlt', 'tvrh')
+
+class SlowQueryLog(Instrumentation):
+    """
+    Keeps the last `maxlen` calls that took at least `threshold` seconds,
+    out of a `sample_rate` fraction of all calls, in `entries`. Request
+    bodies are kept up to `max_body` bytes.
+    """
+    def __init__(self, threshold=1.0, sample_rate=1.0, maxlen=100, max_body=4096, stack_limit=20):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.max_body = max_body
+        self.stack_limit = stack_limit
+        self.entries = deque(maxlen=maxlen)
+        self.sampled = 0
+        self.slow = 0
+        self._local = threading.local()
+
+    def request_started(self, call):
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        self.sampled += 1
+        call.frame = sys._getframe(1)
+        call.slow_entry = None
+
+    def request_finished(self, call):
+        if getattr(call, 'frame', None) is None:
+            return
+        if call.wall_time >= self.threshold:
+            self._record(call)
+        if call.error is not None or call.handler not in _RESULT_HANDLERS:
+            # no results will be built for it
+            call.frame = None
+
+    def results_built(self, call):
+        if getattr(call, 'frame', None) is None:
+            return
+        entry = call.slow_entry
+        if entry is None:
+            total = call.wall_time + (call.decode_time or 0) + (call.build_time or 0)
+            if total < self.threshold:
+                call.frame = None
+                return
+            entry = self._record(call)
+        entry.update({
+            'qtime': call.qtime,
+            'decode_time': call.decode_time,
+            'build_time': call.build_time,
+            'total_time': call.wall_time + (call.decode_time or 0) + (call.build_time or 0),
+        })
+        call.frame = None
+
+    def _record(self, call):
+        body = call.body if isinstance(call.body, basestring) else None
+        query = call.path.split('?', 1)[1] if '?' in call.path else ''
+        if body and call.method == 'POST' and call.handler in _RESULT_HANDLERS:
+            # _select_post sends the parameters as a form
+            query = body
+        entry = {
+            'time': call.started,
+            'handler': call.handler,
+            'method': call.method,
+            'path': call.path,
+            'body': body[:self.max_body] if body else None,
+            'params': parse_qs(query, keep_blank_values=True),
+            'status': call.status,
+            'error': repr(call.error) if call.error is not None else None,
+            'attempts': call.attempts,
+            'bytes_in': call.bytes_in,
+            'bytes_out': call.bytes_out,
+            'wall_time': call.wall_time,
+            'qtime': call.qtime,
+            'decode_time': None,
+            'build_time': None,
+            'total_time': call.wall_time,
+            'stack': self._stack(call.frame),
+        }
+        profiled = getattr(self._local, 'profiled', None)
+        if profiled is not None:
+            profiled.append(entry)
+        call.slow_entry = entry
+        self.entries.append(entry)
+        self.slow += 1
+        log.warning("Slow Solr call: %s %s took %.3fs (%d bytes in)", call.method, call.path,
+                    call.wall_time, call.bytes_in)
+        return entry
+
+    def _stack(self, frame):
+        stack = traceback.extract_stack(frame)
+        # drop the frames of the client, except the one that was called
+        end = len(stack)
+        while end > 1 and os.path.dirname(os.path.abspath(stack[end - 1][0])) == _PACKAGE_DIR:
+            end -= 1
+        if end < len(stack):
+            end += 1
+        return stack[max(0, end - self.stack_limit):end]
+
+    @contextmanager
+    def profiling(self, sort='cumulative', limit=30):
+        """
+        Runs the block under cProfile and attaches the `limit` top functions
+        by `sort` to the entries of the slow calls made in it, as 'profile'.
+        """
+        import cProfile
+        import pstats
+        from cStringIO import StringIO
+        profiler = cProfile.Profile()
+        self._local.profiled = profiled = []
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self._local.profiled = None
+            if profiled:
+                stream = StringIO()
+                pstats.Stats(profiler, stream=stream).sort_stats(sort).print_stats(limit)
+                for entry in profiled:
+                    entry['profile'] = stream.getvalue()
+
+    def clear(self):
+        self.entries.clear()
@@ -110,25 +110,20 @@ with a 'rows' command.
 
 from urllib import urlencode
 from urlparse import urljoin, urlsplit
+from array import array
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, date
+from functools import partial
+from itertools import chain, izip
+import imp
+import logging
+import random
 import re
-
-try:
-    # for python 2.5
-    from xml.etree import cElementTree as ET
-except ImportError:
-    try:
-        # use etree from lxml if it is installed
-        from lxml import etree as ET
-    except ImportError:
-        try:
-            # use cElementTree if available
-            import cElementTree as ET
-        except ImportError:
-            try:
-                from elementtree import ElementTree as ET
-            except ImportError:
-                raise ImportError("No suitable ElementTree implementation was found.")
+import socket
+import threading
+import time
+import zlib
 
 try:
     # For Python < 2.6 or people using a newer version of simplejson
@@ -137,14 +132,20 @@ except ImportError:
     # For Python >= 2.6
     import json
 
+# httplib2 is desirable from a timeout perspective. It is only imported
+# when the first client is created, so only check it is there.
 try:
-    # Desirable from a timeout perspective.
-    from httplib2 import Http
+    imp.find_module('httplib2')
     TIMEOUTS_AVAILABLE = True
 except ImportError:
-    from httplib import HTTPConnection
     TIMEOUTS_AVAILABLE = False
 
+from httplib import HTTPConnection, HTTPSConnection, HTTPException
+
+from instrumentation import SolrCall
+from jsoncodec import default_codec, get_codec
+from throttle import default_throttle
+
 try:
     set
 except NameError:
@@ -157,26 +158,311 @@ __version__ = (2, 0, 9)
 def get_version():
     return "%s.%s.%s" % __version__
 
-DATETIME_REGEX = re.compile('^(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})T(?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2})(\.\d+)?Z$')
-ER_RE = re.compile ('<pre>(.|\n)*?</pre>')
+log = logging.getLogger('solr')
+
+class _LazyPattern(object):
+    """A regular expression only compiled when first used."""
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+        self.compiled = None
+
+    def __getattr__(self, name):
+        if self.compiled is None:
+            self.compiled = re.compile(self.pattern, self.flags)
+        attr = getattr(self.compiled, name)
+        # found directly from now on
+        setattr(self, name, attr)
+        return attr
+
+_etree = None
+
+def etree():
+    """The fastest ElementTree implementation available, imported on first use."""
+    global _etree
+    if _etree is None:
+        try:
+            # for python 2.5
+            from xml.etree import cElementTree as ET
+        except ImportError:
+            try:
+                # use etree from lxml if it is installed
+                from lxml import etree as ET
+            except ImportError:
+                try:
+                    # use cElementTree if available
+                    import cElementTree as ET
+                except ImportError:
+                    try:
+                        from elementtree import ElementTree as ET
+                    except ImportError:
+                        raise ImportError("No suitable ElementTree implementation was found.")
+        _etree = ET
+    return _etree
+
+DATETIME_REGEX = _LazyPattern('^(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})T(?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2})(\.\d+)?Z$')
+ER_RE = _LazyPattern('<pre>(.|\n)*?</pre>')
 
 class SolrError(Exception):
+    # the HTTP status of the response, None when there was none
+    status = None
+
+class SolrTimeoutError(SolrError):
+    """Raised when a request (or its deadline) runs out of time."""
+    pass
+
+class SolrCircuitOpenError(SolrError):
+    """Raised without contacting Solr while the circuit breaker is open."""
     pass
 
+class CompressionStats(object):
+    """
+    Running totals of update body sizes before (`raw_bytes`) and after
+    (`sent_bytes`) compression.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.compressed_requests = 0
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.lock = threading.Lock()
+
+    def record(self, raw_bytes, sent_bytes, compressed):
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            self.raw_bytes += raw_bytes
+            self.sent_bytes += sent_bytes
+            if compressed:
+                self.compressed_requests += 1
+        finally:
+            self.lock.release()
+
+    @property
+    def ratio(self):
+        """Raw bytes per byte sent, 1.0 when nothing was compressed."""
+        if not self.sent_bytes:
+            return 1.0
+        return float(self.raw_bytes) / self.sent_bytes
+
+class HttpPool(object):
+    """
+    A pool of httplib2 clients. httplib2 isn't thread safe, so each thread
+    takes a client for the duration of a request and gives it back, keeping
+    its connections alive for the next one. At most `maxsize` idle clients
+    are kept; there is no limit on how many are in use at once.
+    """
+    def __init__(self, maxsize=10, timeout=60, cache=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.cache = cache
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _create(self):
+        from httplib2 import Http
+        if self.cache:
+            return Http(cache=self.cache, timeout=self.timeout)
+        return Http(timeout=self.timeout)
+
+    def acquire(self):
+        self.lock.acquire()
+        try:
+            if self.idle:
+                # most recently used first, its connections are the most likely to still be open
+                return self.idle.pop()
+        finally:
+            self.lock.release()
+        return self._create()
+
+    def release(self, http):
+        self.lock.acquire()
+        try:
+            if len(self.idle) < self.maxsize:
+                self.idle.append(http)
+                return
+        finally:
+            self.lock.release()
+        self.discard(http)
+
+    def discard(self, http):
+        for conn in http.connections.values():
+            conn.close()
+        http.connections.clear()
+
+    @contextmanager
+    def connection(self):
+        http = self.acquire()
+        try:
+            yield http
+        except:
+            self.discard(http)
+            raise
+        self.release(http)
+
+class _MltDecoder(object):
+    """
+    Wraps a decoder for /mlt responses, which have a null `response` when
+    nothing matched the query, replacing it with an empty one.
+    """
+    def __init__(self, decoder):
+        self.decoder = decoder
+
+    def decode(self, data):
+        result = self.decoder.decode(data)
+        if result.get('response') is None:
+            result['response'] = {'docs': [], 'numFound': 0}
+        return result
+
+class _TimedDecoder(object):
+    """Wraps a decoder, keeping the time spent decoding and the last decoded value."""
+    def __init__(self, decoder):
+        self.decoder = decoder
+        self.elapsed = 0.0
+        self.decoded = None
+
+    def decode(self, response):
+        start = time.time()
+        self.decoded = self.decoder.decode(response)
+        self.elapsed += time.time() - start
+        return self.decoded
+
+def _httplib2_errors():
+    """The exceptions of httplib2 to handle like connection errors."""
+    if not TIMEOUTS_AVAILABLE:
+        return ()
+    from httplib2 import HttpLib2Error
+    return (HttpLib2Error,)
+
+# sentinel meaning "use the client's configured timeout"
+_DEFAULT_TIMEOUT = object()
+
+class Deadline(object):
+    """
+    An absolute point in time by which a call has to be finished. The same
+    deadline can be handed to several requests (retries, pages of a
+    paginator...) so that they share a single time budget.
+
+    A `timeout` of None means the deadline never expires.
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        if timeout is None:
+            self.expires = None
+        else:
+            self.expires = time.time() + timeout
+
+    @classmethod
+    def coerce(cls, value):
+        """Accepts a `Deadline`, a number of seconds or None."""
+        if value is None or isinstance(value, Deadline):
+            return value
+        return cls(value)
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.time())
+
+    def expired(self):
+        return self.expires is not None and time.time() >= self.expires
+
+class RetryPolicy(object):
+    """
+    Retries idempotent requests that failed with a connection error or one of
+    `retry_statuses`, sleeping with exponential backoff and full jitter
+    between attempts.
+    """
+    def __init__(self, max_retries=3, backoff=0.1, max_backoff=5.0,
+                 retry_statuses=(408, 429, 500, 502, 503, 504)):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = retry_statuses
+
+    def should_retry(self, attempt, status=None):
+        if attempt >= self.max_retries:
+            return False
+        return status is None or status in self.retry_statuses
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+class CircuitBreaker(object):
+    """
+    Fails fast while a core is unhealthy. After `failure_threshold`
+    consecutive failures the circuit opens and requests are rejected with
+    `SolrCircuitOpenError` for `reset_timeout` seconds. Then a single probe
+    request is let through: if it succeeds the circuit closes again, if it
+    fails the circuit stays open for another `reset_timeout`.
+
+    >>> breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+    >>> breaker.record_failure(); breaker.state
+    'closed'
+    >>> breaker.record_failure(); breaker.state
+    'open'
+    >>> breaker.allow(), breaker.state, breaker.allow()
+    (True, 'half-open', False)
+    >>> breaker.record_failure(); breaker.state
+    'open'
+    >>> breaker.allow(); breaker.record_success(); breaker.state
+    True
+    'closed'
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        self.lock.acquire()
+        try:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                # let one probe through
+                self.state = self.HALF_OPEN
+                return True
+            return False
+        finally:
+            self.lock.release()
+
+    def record_success(self):
+        self.lock.acquire()
+        try:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+        finally:
+            self.lock.release()
+
+    def record_failure(self):
+        self.lock.acquire()
+        try:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+        finally:
+            self.lock.release()
+
 def list2dict(data):
     # convert : [u'tf', 1, u'df', 2, u'tf-idf', 0.5]
-    # to a dict
-    stop = len(data)
-    keys = [data[i] for i in range(stop) if i%2==0]
-    values = [data[i] for i in range(stop) if i%2==1]
-    return dict(zip(keys,values))
+    # to a dict, in a single pass
+    pairs = iter(data)
+    return dict(izip(pairs, pairs))
 
 # Solr/Lucene special characters: + - ! ( ) { } [ ] ^ " ~ * ? : \
 # There are also operators && and ||, but we're just going to escape
 # the individual ampersand and pipe chars.
 # Also, we're not going to escape backslashes!
 # http://lucene.apache.org/java/2_9_1/queryparsersyntax.html#Escaping+Special+Characters
-ESCAPE_CHARS_RE = re.compile(r'(?<!\\)(?P<char>[&|+\-!(){}[\]^"~*?:])')
+ESCAPE_CHARS_RE = _LazyPattern(r'(?<!\\)(?P<char>[&|+\-!(){}[\]^"~*?:])')
 
 def solr_escape(value):
     r"""Escape un-escaped special characters and return escaped value.
@@ -190,41 +476,312 @@ def solr_escape(value):
     """
     return ESCAPE_CHARS_RE.sub(r'\\\g<char>', value)
 
+class FieldTermVectors(object):
+    """
+    The term vector of one field of one document, stored column-wise:
+    `terms[i]` has a term frequency of `tf[i]`, a document frequency of
+    `df[i]` and a tf-idf of `tf_idf[i]`. `positions` and `offsets` are only
+    filled in when Solr returned them (lists of ints, and of `(start, end)`
+    tuples, parallel to `terms`). Statistics Solr did not return are 0.
+    """
+    def __init__(self):
+        self.terms = []
+        self.tf = array('l')
+        self.df = array('l')
+        self.tf_idf = array('d')
+        self.positions = None
+        self.offsets = None
+        self._index = None
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __contains__(self, term):
+        return term in self.index
+
+    def __getitem__(self, term):
+        i = self.index[term]
+        return {'tf': self.tf[i], 'df': self.df[i], 'tf-idf': self.tf_idf[i]}
+
+    @property
+    def index(self):
+        """term -> position in the columns, built on first use."""
+        if self._index is None:
+            self._index = dict(izip(self.terms, xrange(len(self.terms))))
+        return self._index
+
+    def append(self, term, stats):
+        # stats is a flat NamedList: ['tf', 1, 'df', 2, 'tf-idf', 0.5, 'positions', [...]]
+        tf = df = 0
+        tf_idf = 0.0
+        positions = offsets = None
+        pairs = iter(stats)
+        for name, value in izip(pairs, pairs):
+            if name == 'tf':
+                tf = value
+            elif name == 'df':
+                df = value
+            elif name == 'tf-idf':
+                tf_idf = value
+            elif name == 'positions':
+                positions = value[1::2]
+            elif name == 'offsets':
+                offsets = zip(value[1::4], value[3::4])
+        if positions is not None:
+            if self.positions is None:
+                self.positions = [[] for i in xrange(len(self.terms))]
+            self.positions.append(positions)
+        elif self.positions is not None:
+            self.positions.append([])
+        if offsets is not None:
+            if self.offsets is None:
+                self.offsets = [[] for i in xrange(len(self.terms))]
+            self.offsets.append(offsets)
+        elif self.offsets is not None:
+            self.offsets.append([])
+        self.terms.append(term)
+        self.tf.append(tf)
+        self.df.append(df)
+        self.tf_idf.append(tf_idf)
+
+class DocumentTermVectors(object):
+    """
+    The term vectors of one document: `fields` maps field names to
+    `FieldTermVectors`. `key` is the document's uniqueKey value.
+    """
+    def __init__(self, key, fields):
+        self.key = key
+        self.fields = fields
+
+    def __getitem__(self, field):
+        return self.fields[field]
+
+    def __iter__(self):
+        return iter(self.fields)
+
+class SparseTermMatrix(object):
+    """
+    A documents x terms matrix in compressed sparse row form: the values of
+    row `i` (document `keys[i]`) are `data[indptr[i]:indptr[i+1]]`, in the
+    columns `indices[indptr[i]:indptr[i+1]]` of the `terms` vocabulary.
+    """
+    def __init__(self, keys, terms, indptr, indices, data):
+        self.keys = keys
+        self.terms = terms
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    @property
+    def shape(self):
+        return (len(self.keys), len(self.terms))
+
+    def to_scipy(self):
+        """Returns a `scipy.sparse.csr_matrix`; needs scipy installed."""
+        from scipy.sparse import csr_matrix
+        return csr_matrix((self.data, self.indices, self.indptr), shape=self.shape)
+
 class TermVectorResult(object):
+    """
+    Term vectors from /tvrh for every returned document, parsed in a single
+    pass into `documents` (a list of `DocumentTermVectors`, in response
+    order). `by_key` maps uniqueKey values to the same objects.
+    `warnings` has Solr's warnings (such as fields without term vectors),
+    if any.
+
+    `tv` still holds the first document's term vectors in the original
+    `{term: {'tf': .., 'df': .., 'tf-idf': .., 'field': ..}}` form.
+    """
     def __init__(self,field,response=None,decoder=None):
-        self.decoder = decoder or json.JSONDecoder()
+        self.decoder = decoder or default_codec
         result = self.decoder.decode(response)
+        self.field = field
+        self.unique_key_field = None
+        self.warnings = None
+        self.documents = []
+        self.by_key = {}
+        self._first = None
+        self._tv = None
     
-        # term vectors from /tvrh
-        if result.get('termVectors'):
-            tv = result['termVectors'][1]
-            tv = list2dict(tv)
-            
-            fields = tv.keys()
-            if 'uniqueKey' in fields:
-                fields.remove('uniqueKey')
-            self.tv = {}
-            for f in fields:
-                res = list2dict(tv[f])
-                res2 = {}
-                for k,v in res.iteritems():
-                    res3 = list2dict(v)
-                    res3['field'] = f
-                    res2[k] = res3
-                self.tv.update(res2)
+        # term vectors from /tvrh:
+        # ['doc-0', ['uniqueKey', '1', 'text', ['term', ['tf', 1, ...], ...]], ..., 'uniqueKeyFieldName', 'id']
+        entries = iter(result.get('termVectors') or [])
+        for name, entry in izip(entries, entries):
+            if name == 'uniqueKeyFieldName':
+                self.unique_key_field = entry
+                continue
+            if name == 'warnings':
+                # e.g. fields without stored term vectors, not a document
+                self.warnings = entry
+                continue
+            if self._first is None:
+                self._first = entry
+            self._add_document(entry)
                         
         self.docs = result['response']['docs']
 
+    def _add_document(self, entry):
+        key = None
+        fields = {}
+        pairs = iter(entry)
+        for name, value in izip(pairs, pairs):
+            if name == 'uniqueKey':
+                key = value
+                continue
+            vectors = FieldTermVectors()
+            terms = iter(value)
+            for term, stats in izip(terms, terms):
+                vectors.append(term, stats)
+            fields[name] = vectors
+        document = DocumentTermVectors(key, fields)
+        self.documents.append(document)
+        if key is not None:
+            self.by_key[key] = document
+
+    @property
+    def tv(self):
+        if self._tv is None:
+            self._tv = {}
+            if self._first is not None:
+                tv = list2dict(self._first)
+                tv.pop('uniqueKey', None)
+                for f, terms in tv.iteritems():
+                    for k, v in list2dict(terms).iteritems():
+                        res = list2dict(v)
+                        res['field'] = f
+                        self._tv[k] = res
+        return self._tv
+
+    def to_sparse_matrix(self, field, metric='tf'):
+        """
+        Builds a `SparseTermMatrix` of `metric` ('tf', 'df' or 'tf_idf')
+        for `field` across all documents.
+        """
+        vocabulary = {}
+        terms = []
+        indptr = array('l', [0])
+        indices = array('l')
+        data = array('d')
+        for document in self.documents:
+            vectors = document.fields.get(field)
+            if vectors is not None:
+                values = getattr(vectors, metric)
+                for term, value in izip(vectors.terms, values):
+                    column = vocabulary.get(term)
+                    if column is None:
+                        column = vocabulary[term] = len(terms)
+                        terms.append(term)
+                    indices.append(column)
+                    data.append(value)
+            indptr.append(len(indices))
+        keys = [document.key for document in self.documents]
+        return SparseTermMatrix(keys, terms, indptr, indices, data)
+
     def __len__(self):
         return len(self.docs)
 
     def __iter__(self):
         return iter(self.docs)
 
+class FacetField(object):
+    """
+    The counts of one facet.field as two parallel columns, `values` and
+    `counts`. Iterating yields `(value, count)` pairs.
+
+    >>> field = FacetField([u'poetry', 3, u'science', 1])
+    >>> list(field), field.counts
+    ([(u'poetry', 3), (u'science', 1)], array('l', [3, 1]))
+    """
+    def __init__(self, data):
+        if isinstance(data, dict):
+            # json.nl=map
+            self.values = data.keys()
+            self.counts = array('l', data.values())
+        elif data and isinstance(data[0], list):
+            # json.nl=arrarr
+            self.values = [value for value, count in data]
+            self.counts = array('l', [count for value, count in data])
+        else:
+            # json.nl=flat, the default
+            self.values = data[0::2]
+            self.counts = array('l', data[1::2])
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return izip(self.values, self.counts)
+
+    def as_dict(self):
+        return dict(izip(self.values, self.counts))
+
+class PivotNode(object):
+    """A node of a facet.pivot tree; `pivot` holds the next level down."""
+    def __init__(self, data):
+        self.field = data.get('field')
+        self.value = data.get('value')
+        self.count = data.get('count', 0)
+        self.pivot = [PivotNode(child) for child in data.get('pivot') or []]
+
+    def __iter__(self):
+        return iter(self.pivot)
+
+    def walk(self, path=()):
+        """Yields `(path, count)` for this node and every node below it, `path`
+        being the tuple of values from the root."""
+        path = path + (self.value,)
+        yield path, self.count
+        for child in self.pivot:
+            for item in child.walk(path):
+                yield item
+
+    def __repr__(self):
+        return "PivotNode(field=%r, value=%r, count=%r)" % (self.field, self.value, self.count)
+
+class FacetCounts(object):
+    """
+    A parsed `facet_counts` section. Fields are only parsed when accessed
+    through `field()` or `fields`.
+    """
+    def __init__(self, facet_counts=None):
+        self.raw = facet_counts or {}
+        self.queries = self.raw.get('facet_queries') or {}
+        self._fields = {}
+        self._pivots = None
+
+    def field(self, name):
+        """The `FacetField` for `name`."""
+        parsed = self._fields.get(name)
+        if parsed is None:
+            parsed = self._fields[name] = FacetField(self.raw.get('facet_fields', {}).get(name) or [])
+        return parsed
+
+    @property
+    def fields(self):
+        return dict((name, self.field(name)) for name in self.raw.get('facet_fields') or {})
+
+    @property
+    def pivots(self):
+        """Maps each facet.pivot ('cat,inStock') to its list of root `PivotNode`."""
+        if self._pivots is None:
+            self._pivots = {}
+            for name, roots in (self.raw.get('facet_pivot') or {}).iteritems():
+                self._pivots[name] = [PivotNode(root) for root in roots]
+        return self._pivots
+
 class Results(object):
-    def __init__(self, response=None,decoder=None):
-        self.decoder = decoder or json.JSONDecoder()
-        if not response:
+    """
+    A page of search results. Built from the raw `response`, or from an
+    already decoded `result` so that it isn't decoded twice.
+    """
+    def __init__(self, response=None,decoder=None,result=None):
+        self.decoder = decoder or default_codec
+        if result is not None:
+            self.result = result
+        elif not response:
             self.result = {}
         else:
             self.result =  self.decoder.decode(response)
@@ -257,6 +814,14 @@ class Results(object):
             self.hits = response['numFound']
         else:
             self.docs, self.hits = ([],0)
+        self._facet_counts = None
+
+    @property
+    def facet_counts(self):
+        """`facets` parsed into a `FacetCounts`, on first use."""
+        if self._facet_counts is None:
+            self._facet_counts = FacetCounts(self.facets)
+        return self._facet_counts
     
     def __len__(self):
         return len(self.docs)
@@ -264,24 +829,214 @@ class Results(object):
     def __iter__(self):
         return iter(self.docs)
 
+class Group(object):
+    """
+    One group of a group.field or group.func command: the group's `value`,
+    the number of documents in it (`hits`) and the documents returned for
+    it (`docs`, at most `group.limit` from `group.offset`).
+    """
+    def __init__(self, value, doclist):
+        self.value = value
+        self.hits = doclist.get('numFound', 0)
+        self.start = doclist.get('start', 0)
+        self.max_score = doclist.get('maxScore')
+        self.docs = doclist.get('docs', [])
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __iter__(self):
+        return iter(self.docs)
+
+    def __repr__(self):
+        return "Group(value=%r, hits=%r)" % (self.value, self.hits)
+
+class GroupCommand(object):
+    """
+    The result of one grouping command (a group.field, group.func or
+    group.query). `matches` is the number of documents matching the query
+    and `ngroups` the number of groups (only when `group.ngroups=true`).
+    Field and function commands have their `groups`; query commands and
+    `group.format=simple` have a single `docs` list with `hits` documents.
+    """
+    def __init__(self, name, result):
+        self.name = name
+        self.matches = result.get('matches', 0)
+        self.ngroups = result.get('ngroups')
+        self.groups = [Group(group.get('groupValue'), group.get('doclist', {}))
+                       for group in result.get('groups', [])]
+        doclist = result.get('doclist')
+        if doclist is not None:
+            self.hits = doclist.get('numFound', 0)
+            self.docs = doclist.get('docs', [])
+        else:
+            self.hits = self.matches
+            self.docs = [doc for group in self.groups for doc in group.docs]
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __iter__(self):
+        return iter(self.groups)
+
 class GroupedResults(object):
+    """
+    Results of a grouped search. `commands` maps each group.field,
+    group.func and group.query to its `GroupCommand`. `docs` maps the same
+    names to a `Results` holding the command's documents (for field and
+    function commands, the documents of all returned groups).
+    """
     def __init__(self, response=None,decoder=None):
-        self.decoder = decoder or json.JSONDecoder()
+        self.decoder = decoder or default_codec
         self.result = self.decoder.decode(response)
 
-        grouped_response = self.result.get('grouped')
+        grouped_response = self.result.get('grouped') or {}
+        self.commands = {}
         docs = {}
         for name,res in grouped_response.iteritems():
+            command = GroupCommand(name, res)
+            self.commands[name] = command
             r = Results()
-            r.docs = res.get('doclist',{}).get('docs')
-            r.hits = res.get('doclist',{}).get('numFound')
+            r.docs = command.docs
+            r.hits = command.hits
             docs[name] = r
                                        
         self.docs = docs
                     
+    def __getitem__(self, name):
+        return self.commands[name]
+
     def __iter__(self):
         return iter(self.docs)
 
+_DOCS_START = _LazyPattern(r'"docs"\s*:\s*\[')
+_SEPARATORS = _LazyPattern(r'[\s,]*')
+
+def _stream_docs(chunks, decoder=json.JSONDecoder()):
+    """
+    Yields the documents of the `docs` array of a JSON response given as an
+    iterable of string pieces, decoding each one as soon as it is complete.
+
+    >>> list(_stream_docs(['{"response":{"numFound":2,"do', 'cs":[{"id":"1"},', '{"id":"2"}]}}']))
+    [{u'id': u'1'}, {u'id': u'2'}]
+    """
+    buf = ''
+    pos = None
+    for chunk in chunks:
+        buf += chunk
+        if pos is None:
+            start = _DOCS_START.search(buf)
+            if start is None:
+                continue
+            pos = start.end()
+        while True:
+            pos = _SEPARATORS.match(buf, pos).end()
+            if pos == len(buf):
+                break
+            if buf[pos] == ']':
+                return
+            try:
+                doc, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # not all of the document is there yet
+                break
+            pos = end
+            yield doc
+        if pos > 64 * 1024:
+            buf = buf[pos:]
+            pos = 0
+    raise SolrError("Error: truncated export response")
+
+_record_classes = {}
+
+def _record_class(fields):
+    """A named tuple class for `fields`, cached since building one is slow."""
+    record = _record_classes.get(fields)
+    if record is None:
+        record = _record_classes[fields] = namedtuple('Record', fields, rename=True)
+    return record
+
+class OptimizeHandle(object):
+    """
+    An optimize (or expungeDeletes commit) running in the background. The
+    update request is sent from a thread of its own, without a timeout, so
+    no other thread waits on it. Meanwhile `progress()` asks the Luke
+    handler for the number of segments left, and `wait()` blocks until the
+    request returns or a deadline runs out::
+
+        handle = solr.optimize_async()
+        while not handle.done():
+            print handle.progress(), 'segments'
+            time.sleep(10)
+    """
+    def __init__(self, solr, params, target_segments=1, poll_interval=1.0):
+        self.solr = solr
+        # Solr wants 'true'/'false', not 'True'
+        self.params = dict((name, str(value).lower() if isinstance(value, bool) else value)
+                           for name, value in params.iteritems())
+        self.target_segments = target_segments
+        self.poll_interval = poll_interval
+        self.segments = None
+        self.response = None
+        self.error = None
+        self.finished = threading.Event()
+        self.started = time.time()
+        self.thread = threading.Thread(target=self._run)
+        # only waits on its socket, don't keep the process alive for it
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        path = '%s/update?%s' % (self.solr.path, urlencode(self.params))
+        try:
+            self.response = self.solr._send_request('GET', path, idempotent=False, timeout=None)
+        except Exception, e:
+            self.error = e
+        self.finished.set()
+
+    def done(self):
+        return self.finished.is_set()
+
+    def progress(self):
+        """Polls the current number of segments, also kept in `segments`."""
+        self.segments = self.solr.segment_count()
+        return self.segments
+
+    def wait(self, deadline=None):
+        """
+        Waits for the optimize to finish and returns Solr's response,
+        polling `progress()` every `poll_interval` seconds. Raises
+        `SolrTimeoutError` when `deadline` (seconds or a `Deadline`) runs out
+        first; the optimize carries on regardless.
+
+        If the update request itself failed (a proxy dropping the idle
+        connection, say) but the index is down to `target_segments`, the
+        optimize is considered done.
+        """
+        deadline = Deadline.coerce(deadline)
+        while not self.finished.is_set():
+            remaining = deadline and deadline.remaining()
+            if remaining is not None and remaining <= 0:
+                raise SolrTimeoutError("optimize of %s still running after %.1fs (%s segments)" % (
+                    self.solr.url, time.time() - self.started, self.segments))
+            wait = self.poll_interval if remaining is None else min(self.poll_interval, remaining)
+            if self.finished.wait(wait):
+                break
+            try:
+                self.progress()
+            except Exception, e:
+                log.warning("Could not poll the segment count of %s: %s", self.solr.url, e)
+        if self.error is not None:
+            try:
+                segments = self.progress()
+            except Exception:
+                segments = None
+            # an unknown segment count doesn't say the optimize is done
+            if self.target_segments is None or segments is None or segments > self.target_segments:
+                raise self.error
+            log.info("Optimize request to %s failed (%s) but the index is optimized", self.solr.url, self.error)
+        return self.response
+
 class Solr(object):
     """
     An object that makse http json requests to a Solr server.
@@ -289,9 +1044,54 @@ class Solr(object):
     If you have httplib2 installed we will cache the responses we get from
     Solr in a directory called '.cache'. The cache can also be an object that subclases httplib2.FileCache
     Not safe to use if multiple threads or processes are going to be running on the same cache.
+    A directory name is cached with an `AdmissionFileCache`, which leaves out
+    big and deep pages and expires empty results quickly.
+
+    Pass a `RetryPolicy` as `retry_policy` to retry failed reads, and a
+    `CircuitBreaker` as `circuit_breaker` to fail fast while the core is
+    unhealthy. Search methods accept a `deadline` keyword (seconds or a
+    `Deadline`) bounding the whole call, retries included.
+
+    `wt` selects the response format: 'json' (the default) or 'javabin',
+    which is smaller on the wire. With `compression` (the default) the
+    client asks for gzip/deflate encoded responses.
+
+    Update bodies of at least `update_compress_threshold` bytes are sent
+    gzip-compressed and streamed with chunked transfer encoding (None, the
+    default, never compresses). Solr has to be set up to inflate gzip
+    request bodies. Totals are kept in `update_stats`.
+
+    `instrumentation` (see the `instrumentation` module) is told about every
+    request and about the time spent turning responses into results.
+
+    Requests go through an `HttpPool` of httplib2 clients, so a `Solr` can be
+    shared by threads and keeps its connections alive between calls. Clients
+    talking to the same server can share one pool by passing `http_pool`.
+
+    With a `DocumentCache` (see the `cache` module) as `document_cache`,
+    `get` only fetches the documents that are not cached, and `add` and
+    `delete` drop the documents they change from the cache.
+
+    JSON is decoded and encoded with the fastest library installed, or the
+    one named by `json_codec` (see the `jsoncodec` module).
+
+    Document updates go through `update_throttle`, an `UpdateThrottle` (see
+    the `throttle` module), or the one shared by the process if True.
     """
-    def __init__(self, url, decoder=None, timeout=60,result_class=Results,use_cache=None,cache=None):
-        self.decoder = decoder or json.JSONDecoder()
+    # also used by instances built without __init__ to serialize updates
+    json_codec = default_codec
+
+    def __init__(self, url, decoder=None, timeout=60,result_class=Results,use_cache=None,cache=None,
+                 retry_policy=None, circuit_breaker=None, wt='json', compression=True,
+                 update_compress_threshold=None, instrumentation=None, http_pool=None, pool_size=10,
+                 document_cache=None, json_codec=None, update_throttle=None):
+        if decoder is None and wt == 'javabin':
+            from javabin import JavaBinDecoder
+            decoder = JavaBinDecoder()
+        self.json_codec = get_codec(json_codec)
+        self.decoder = decoder or self.json_codec
+        self.wt = wt
+        self.compression = compression
         self.url = url
         self.scheme, netloc, path, query, fragment = urlsplit(url)
         netloc = netloc.split(':')
@@ -303,65 +1103,377 @@ class Solr(object):
         self.path = path.rstrip('/')
         self.timeout = timeout
         self.result_class = result_class
-        if TIMEOUTS_AVAILABLE and use_cache:
-            self.http = Http(cache=cache or ".cache",timeout=self.timeout)
-        else:
-            self.http = Http(timeout=self.timeout)
+        self.retry_policy = retry_policy
+        self.circuit_breaker = circuit_breaker
+        self.update_compress_threshold = update_compress_threshold
+        self.update_stats = CompressionStats()
+        if update_throttle is True:
+            update_throttle = default_throttle()
+        self.update_throttle = update_throttle
+        self.instrumentation = instrumentation
+        self.document_cache = document_cache
+        self.use_cache = use_cache
+        self.cache = cache
+        if http_pool is None and TIMEOUTS_AVAILABLE:
+            if use_cache:
+                if cache is None or isinstance(cache, basestring):
+                    from cache import AdmissionFileCache
+                    cache = AdmissionFileCache(cache or ".cache")
+                http_pool = HttpPool(pool_size, self.timeout, cache=cache)
+            else:
+                http_pool = HttpPool(pool_size, self.timeout)
+        self.http_pool = http_pool
+        # the call being measured by the current thread
+        self._local = threading.local()
+        self._worker_pool = None
+        self._worker_pool_lock = threading.Lock()
+
+    @property
+    def http(self):
+        """
+        An idle httplib2 client from the pool, for inspection. Requests
+        should go through `http_pool.connection()`.
+        """
+        http_pool = self.http_pool
+        http = http_pool.acquire()
+        http_pool.release(http)
+        return http
             
-    def _send_request(self, method, path, body=None, headers=None):
+    def _send_request(self, method, path, body=None, headers=None, deadline=None, idempotent=None,
+                      timeout=_DEFAULT_TIMEOUT):
+        """
+        Sends a request to Solr and returns the response body.
+
+        Reads (`idempotent`, which defaults to True for GET requests) are
+        retried according to `self.retry_policy`. Every attempt is bounded by
+        the client timeout and by what is left of `deadline`. Pass `timeout`
+        to override the client timeout for this call only (None waits
+        forever).
+        """
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return self._send_with_retries(method, path, body, headers, deadline, idempotent, timeout)
+
+        call = SolrCall(self._handler_name(path), method, path, body)
+        if isinstance(body, basestring):
+            call.bytes_out = len(body)
+        elif body is not None:
+            body = self._count_bytes_out(body, call)
+        self._local.call = call
+        instrumentation.request_started(call)
+        try:
+            response = self._send_with_retries(method, path, body, headers, deadline, idempotent, timeout, call)
+        except Exception, e:
+            call.error = e
+            raise
+        else:
+            call.bytes_in = len(response)
+            return response
+        finally:
+            call.wall_time = time.time() - call.started
+            instrumentation.request_finished(call)
+
+    def _handler_name(self, path):
+        """'/solr/core/select/?q=x' -> 'select'"""
+        path = path.split('?', 1)[0]
+        if path.startswith(self.path):
+            path = path[len(self.path):]
+        return path.strip('/').split('/', 1)[0]
+
+    def _count_bytes_out(self, chunks, call):
+        for chunk in chunks:
+            call.bytes_out += len(chunk)
+            yield chunk
+
+    def _send_with_retries(self, method, path, body, headers, deadline, idempotent, timeout, call=None,
+                           send=None):
+        """
+        Retries stop when the deadline runs out:
+
+        >>> solr = Solr('http://localhost:8983/solr/core0',
+        ...             retry_policy=RetryPolicy(max_retries=1000, backoff=0.01, max_backoff=0.01))
+        >>> def refused(*args): raise socket.error('Connection refused')
+        >>> solr._send_once = refused
+        >>> started = time.time()
+        >>> try:
+        ...     solr._send_request('GET', '/solr/core0/select', deadline=0.2)
+        ... except SolrError:
+        ...     print time.time() - started < 0.5
+        True
+
+        Any error counts as a failure of the circuit breaker, so a failed
+        probe doesn't leave it half-open:
+
+        >>> breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        >>> solr = Solr('http://localhost:8983/solr/core0', circuit_breaker=breaker)
+        >>> def broken(*args): raise KeyError('status')
+        >>> solr._send_once = broken
+        >>> for i in range(2):
+        ...     try:
+        ...         solr._send_request('GET', '/solr/core0/select')
+        ...     except KeyError:
+        ...         print breaker.state
+        open
+        open
+        """
+        # `send` replaces _send_once, for requests that need their own connection
+        send = send or self._send_once
+        if idempotent is None:
+            idempotent = method in ('GET', 'HEAD')
+        if timeout is _DEFAULT_TIMEOUT:
+            timeout = self.timeout
+        deadline = Deadline.coerce(deadline)
+        breaker = self.circuit_breaker
+        attempt = 0
+        while True:
+            if breaker is not None and not breaker.allow():
+                raise SolrCircuitOpenError("Error: circuit open for %s, not sending request" % self.url)
+
+            attempt_timeout = timeout
+            if deadline is not None:
+                remaining = deadline.remaining()
+                if remaining is not None:
+                    if remaining <= 0:
+                        raise SolrTimeoutError("Error: deadline exceeded before sending request to %s" % path)
+                    if attempt_timeout is None or remaining < attempt_timeout:
+                        attempt_timeout = remaining
+
+            status = None
+            if call is not None:
+                call.attempts += 1
+            recorded = False
+            try:
+                try:
+                    status, response_headers, response = send(method, path, body, headers, attempt_timeout)
+                    if call is not None:
+                        call.status = status
+                except socket.timeout, e:
+                    error = SolrTimeoutError("Error: timed out after %ss: %s" % (attempt_timeout, e))
+                except (socket.error, HTTPException), e:
+                    error = SolrError("Error: %s" % e)
+                except _httplib2_errors(), e:
+                    # ServerNotFoundError, RedirectLimit...
+                    error = SolrError("Error: %s" % e)
+                else:
+                    if status in (200, 304):
+                        if breaker is not None:
+                            breaker.record_success()
+                            recorded = True
+                        return response
+                    error = SolrError(self._extract_error(response_headers, response))
+                    error.status = status
+
+                # client errors (bad query...) say nothing about the health of the core
+                if breaker is not None:
+                    if status is None or status >= 500 or status == 429:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                    recorded = True
+            finally:
+                if breaker is not None and not recorded:
+                    # any other exception still counts, and frees the half-open probe
+                    breaker.record_failure()
+
+            policy = self.retry_policy
+            if not (idempotent and policy is not None and policy.should_retry(attempt, status)):
+                raise error
+            delay = policy.delay(attempt)
+            if deadline is not None:
+                remaining = deadline.remaining()
+                if remaining is not None and delay >= remaining:
+                    raise error
+            time.sleep(delay)
+            attempt += 1
+
+    def _send_once(self, method, path, body, headers, timeout):
+        """
+        Performs a single HTTP request, returning `(status, headers, body)`.
+        """
+        headers = dict(headers or {})
+        if self.compression:
+            headers['Accept-Encoding'] = 'gzip, deflate'
+        else:
+            headers['Accept-Encoding'] = 'identity'
+
+        if body is not None and not isinstance(body, basestring):
+            return self._send_streaming(method, path, body, headers, timeout)
+
         if TIMEOUTS_AVAILABLE:
+            # httplib2 takes care of decompressing the response
             url = self.url.replace(self.path, '')
-            headers, response = self.http.request(urljoin(url, path), method=method, body=body, headers=headers)
-            
-            if int(headers['status']) not in (200,304):
-                raise SolrError(self._extract_error(headers, response))
-            
-            return response
+            http_pool = self.http_pool
+            http = http_pool.acquire()
+            try:
+                self._set_http_timeout(http, timeout)
+                headers, response = http.request(urljoin(url, path), method=method, body=body, headers=headers)
+            except:
+                # the connection may be half way through a response, don't reuse it
+                http_pool.discard(http)
+                raise
+            http_pool.release(http)
+            return int(headers['status']), headers, response
         else:
-            if headers is None:
-                headers = {}
-            
-            conn = HTTPConnection(self.host, self.port)
-            conn.request(method, path, body, headers)
+            conn = self._connection(timeout)
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                return response.status, dict(response.getheaders()), self._read_body(response)
+            finally:
+                conn.close()
+
+    def _connection(self, timeout):
+        if self.scheme == 'https':
+            return HTTPSConnection(self.host, self.port, timeout=timeout)
+        return HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def _send_streaming(self, method, path, chunks, headers, timeout):
+        """
+        Sends a body given as an iterable of strings with chunked transfer
+        encoding, so it never has to be held in memory in one piece.
+
+        httplib2 can't stream a request body, so this opens a connection of
+        its own outside of `http_pool`, which is not kept alive. It is still
+        called through `_send_with_retries`, with the circuit breaker and
+        instrumentation, but the chunks can only be sent once: a streamed
+        body is never retried.
+        """
+        conn = self._connection(timeout)
+        try:
+            conn.putrequest(method, path, skip_accept_encoding=True)
+            for name, value in headers.items():
+                conn.putheader(name, value)
+            conn.putheader('Transfer-Encoding', 'chunked')
+            conn.endheaders()
+            for chunk in chunks:
+                if chunk:
+                    conn.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+            conn.send('0\r\n\r\n')
             response = conn.getresponse()
-                        
-            if response.status != 200:
-                raise SolrError(self._extract_error(dict(response.getheaders()), response.read()))
-            
+            return response.status, dict(response.getheaders()), self._read_body(response)
+        finally:
+            conn.close()
+
+    def _read_body(self, response, chunk_size=64 * 1024):
+        """
+        Reads a response body, decompressing gzip/deflate content as it
+        comes in rather than after buffering the whole compressed body.
+
+        Only for the responses read with httplib: streamed updates,
+        `export`, and every request when httplib2 isn't installed. httplib2
+        buffers the compressed body and decompresses it in one go.
+        """
+        encoding = (response.getheader('content-encoding') or '').lower()
+        if encoding not in ('gzip', 'deflate'):
             return response.read()
+        return ''.join(self._iter_body(response, chunk_size))
+
+    def _iter_body(self, response, chunk_size=64 * 1024):
+        """Yields a response body piece by piece, decompressed."""
+        encoding = (response.getheader('content-encoding') or '').lower()
+        if encoding not in ('gzip', 'deflate'):
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+        if encoding == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            decompressor = zlib.decompressobj()
+        first = True
+        while True:
+            chunk = response.read(chunk_size)
+            if not chunk:
+                break
+            try:
+                yield decompressor.decompress(chunk)
+            except zlib.error:
+                if not (first and encoding == 'deflate'):
+                    raise
+                # some servers send raw deflate data without the zlib header
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                yield decompressor.decompress(chunk)
+            first = False
+        yield decompressor.flush()
+
+    def _set_http_timeout(self, http, timeout):
+        """
+        httplib2 only applies its timeout to new connections, so update the
+        ones it keeps alive as well.
+        """
+        if http.timeout == timeout:
+            return
+        http.timeout = timeout
+        for conn in http.connections.values():
+            conn.timeout = timeout
+            if getattr(conn, 'sock', None) is not None:
+                conn.sock.settimeout(timeout)
+
+    def _build_results(self, response, result_class=None, decoder=None):
+        """
+        Turns a response into a `result_class` (`self.result_class` by
+        default) instance, timing the decoding and the construction of the
+        results for the instrumentation.
 
-    def _select(self, params):
+        `result_class` is called with the response and a `decoder` keyword
+        (`self.decoder` unless given).
+        """
+        if result_class is None:
+            result_class = self.result_class
+        if decoder is None:
+            decoder = self.decoder
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return result_class(response, decoder=decoder)
+
+        call = getattr(self._local, 'call', None)
+        self._local.call = None
+        decoder = _TimedDecoder(decoder)
+        start = time.time()
+        results = result_class(response, decoder=decoder)
+        if call is not None:
+            call.decode_time = decoder.elapsed
+            call.build_time = time.time() - start - decoder.elapsed
+            header = isinstance(decoder.decoded, dict) and decoder.decoded.get('responseHeader') or {}
+            if header.get('QTime') is not None:
+                call.qtime = header['QTime'] / 1000.0
+            instrumentation.results_built(call)
+        return results
+
+    def _select(self, params, deadline=None):
         # encode the query as utf-8 so urlencode can handle it
         params['q'] = self._encode_q(params['q'])
-        params['wt'] = 'json' # specify json encoding of results
+        params['wt'] = self.wt # json or javabin encoding of results
         path = '%s/select/?%s' % (self.path, urlencode(params, True))
-        return self._send_request('GET', path)
+        return self._send_request('GET', path, deadline=deadline)
 
-    def _select_post(self,params):
+    def _select_post(self, params, deadline=None):
         """
         Send a query via HTTP POST. Useful when the query is long (> 1024 characters)
         """
         params['q'] = self._encode_q(params['q'])
-        params['wt'] = 'json' 
+        params['wt'] = self.wt
         path = '%s/select?' % (self.path,)
         
         headers = {"Content-type": "application/x-www-form-urlencoded"}
         body = urlencode(params, False)
-        return self._send_request('POST',path,body=body,headers=headers)
+        return self._send_request('POST', path, body=body, headers=headers, deadline=deadline, idempotent=True)
     
-    def _mlt(self, params):
+    def _mlt(self, params, deadline=None):
         # encode the query as utf-8 so urlencode can handle it
         params['q'] = self._encode_q(params['q'])
-        params['wt'] = 'json' # specify json encoding of results
+        params['wt'] = self.wt # json or javabin encoding of results
         path = '%s/mlt?%s' % (self.path, urlencode(params, True))
-        return self._send_request('GET', path)
+        return self._send_request('GET', path, deadline=deadline)
 
-    def _tvrh(self, params):
+    def _tvrh(self, params, deadline=None):
         # encode the query as utf-8 so urlencode can handle it
         params['q'] = self._encode_q(params['q'])
-        params['wt'] = 'json' # specify json encoding of results
+        params['wt'] = self.wt # json or javabin encoding of results
         path = '%s/tvrh?%s' % (self.path, urlencode(params, True))
-        return self._send_request('GET', path)
+        return self._send_request('GET', path, deadline=deadline)
 
     def _encode_q(self,qarg):
         if type(qarg) == list:
@@ -383,9 +1495,63 @@ class Solr(object):
         
         # Clean the message of ctrl characters.
         if clean_ctrl_chars:
-            message = sanitize(message)
+            if isinstance(message, basestring):
+                message = sanitize(message)
+            else:
+                message = (sanitize(chunk) for chunk in message)
         
-        return self._send_request('POST', path, message, {'Content-type': 'text/xml'})
+        return self._post_update(path, message, 'text/xml')
+
+    def _post_update(self, path, message, content_type):
+        """
+        Posts an update message, given as a string or as an iterable of
+        strings. Messages reaching `update_compress_threshold` bytes are
+        streamed gzip-compressed, smaller ones (commits, deletes...) are
+        sent as they are.
+        """
+        headers = {'Content-type': content_type}
+        if isinstance(message, basestring):
+            chunks = iter([message])
+        else:
+            chunks = iter(message)
+
+        threshold = self.update_compress_threshold
+        head = []
+        size = 0
+        if threshold is not None:
+            for chunk in chunks:
+                head.append(chunk)
+                size += len(chunk)
+                if size >= threshold:
+                    break
+        if threshold is None or size < threshold:
+            body = ''.join(chain(head, chunks))
+            self.update_stats.record(len(body), len(body), False)
+            if self.update_throttle is not None:
+                self.update_throttle.charge(nbytes=len(body))
+            return self._send_request('POST', path, body, headers)
+
+        headers['Content-Encoding'] = 'gzip'
+        body = self._gzip_chunks(chain(head, chunks))
+        return self._send_request('POST', path, body, headers)
+
+    def _gzip_chunks(self, chunks):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        raw_bytes = sent_bytes = 0
+        for chunk in chunks:
+            raw_bytes += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                sent_bytes += len(data)
+                yield data
+        data = compressor.flush()
+        sent_bytes += len(data)
+        yield data
+        self.update_stats.record(raw_bytes, sent_bytes, True)
+        if self.update_throttle is not None:
+            self.update_throttle.charge(nbytes=raw_bytes)
+        log.debug("Solr: compressed update body from %d to %d bytes (ratio %.2f)",
+                  raw_bytes, sent_bytes, float(raw_bytes) / max(sent_bytes, 1))
 
     def _extract_error(self, headers, response):
         """
@@ -473,14 +1639,15 @@ class Solr(object):
             conn.search(["ipod","category_id:1"],facet="on", 
                 **{'facet.field':['text','tags','cat','manufacturer'],'rows':10})
         """
+        deadline = kwargs.pop('deadline', None)
         params = {'q': q}
         params.update(kwargs)
         if len(q) < 1024:
-            response = self._select(params)
+            response = self._select(params, deadline=deadline)
         else:
-            response = self._select_post(params)
+            response = self._select_post(params, deadline=deadline)
         
-        return self.result_class(response,decoder=self.decoder)
+        return self._build_results(response)
         
     
     def more_like_this(self, q, mltfl, **kwargs):
@@ -489,38 +1656,310 @@ class Solr(object):
         
         Requires Solr 1.3+.
         """
+        deadline = kwargs.pop('deadline', None)
         params = {
             'q': q,
             'mlt.fl': mltfl,
         }
         params.update(kwargs)
-        response = self._mlt(params)
-        result = self.decoder.decode(response)
-        
-        if result['response'] is None:
-            result['response'] = {
-                'docs': [],
-                'numFound': 0,
-            }
-            
-        return self.result_class(response,decoder=self.decoder)
+        response = self._mlt(params, deadline=deadline)
+        return self._build_results(response, decoder=_MltDecoder(self.decoder))
+
+    def more_like_this_many(self, seeds, mltfl, id_field='id', mode='mlt', max_workers=4, **kwargs):
+        """
+        Finds the documents similar to each of the documents whose ids are
+        `seeds`, and returns one `Results` per seed, in the same order.
+
+        In 'mlt' mode there is one /mlt request per seed, up to `max_workers`
+        at a time. In 'select' mode a single select request asks the
+        MoreLikeThis search component for all the seeds at once (use
+        `mlt.count` for the number of similar documents per seed); `hits` is
+        then 0 for seeds that weren't found.
+        """
+        seeds = list(seeds)
+        deadline = kwargs.pop('deadline', None)
+        if mode == 'select':
+            return self._more_like_this_select(seeds, mltfl, id_field, deadline, kwargs)
+        if mode != 'mlt':
+            raise ValueError("Unknown more_like_this_many mode %r" % mode)
+
+        def similar(seed):
+            return self.more_like_this(self._ids_query(id_field, [seed]), mltfl, deadline=deadline, **kwargs)
+        if len(seeds) > 1 and max_workers > 1:
+            return self._workers(max_workers).map(similar, seeds)
+        return map(similar, seeds)
+
+    def _more_like_this_select(self, seeds, mltfl, id_field, deadline, kwargs):
+        # fl also shapes the similar documents: leave it to the caller, as with /mlt
+        params = {'q': self._ids_query(id_field, seeds), 'mlt': 'true', 'mlt.fl': mltfl,
+                  'rows': len(seeds)}
+        params.update(kwargs)
+        if len(params['q']) < 1024:
+            response = self._select(params, deadline=deadline)
+        else:
+            response = self._select_post(params, deadline=deadline)
+        result = self._build_results(response).result
+
+        similar = result.get('moreLikeThis') or {}
+        if isinstance(similar, list):
+            # json.nl=flat
+            similar = dict(izip(similar[0::2], similar[1::2]))
+        header = result.get('responseHeader')
+        results = []
+        for seed in seeds:
+            response = similar.get(unicode(seed)) or {'docs': [], 'numFound': 0}
+            results.append(self.result_class(decoder=self.decoder, result={'responseHeader': header,
+                                                                           'response': response}))
+        return results
 
     def term_vectors(self,q,field=None,**kwargs):
+        deadline = kwargs.pop('deadline', None)
         params = {'q': q or '','tv.all':'true' }
         if field:
             params['tv.fl'] = field
         params.update(kwargs)
 
-        response = self._tvrh(params)
-        return TermVectorResult(field,response)
+        response = self._tvrh(params, deadline=deadline)
+        return self._build_results(response, partial(TermVectorResult, field))
+
+    def term_vectors_many(self, ids, field=None, id_field='id', chunk_size=100, **kwargs):
+        """
+        Fetches the term vectors of many documents by id, `chunk_size` ids
+        per /tvrh request. Returns a list of `DocumentTermVectors` in the
+        order of `ids`, with None for ids that were not found.
+        """
+        ids = list(ids)
+        found = {}
+        for i in xrange(0, len(ids), chunk_size):
+            chunk = ids[i:i + chunk_size]
+            params = dict(kwargs)
+            params['rows'] = len(chunk)
+            result = self.term_vectors(self._ids_query(id_field, chunk), field, **params)
+            found.update(result.by_key)
+        return [found.get(unicode(id)) for id in ids]
+
+    def _ids_query(self, id_field, ids):
+        """Builds a query matching any of `ids` in `id_field`."""
+        quoted = []
+        for id in ids:
+            id = unicode(id).replace('\\', '\\\\').replace('"', '\\"')
+            quoted.append(u'"%s"' % id)
+        return u'%s:(%s)' % (id_field, u' OR '.join(quoted))
+
+    def get(self, ids, fl=None, id_field='id', chunk_size=100, max_workers=4, deadline=None, **kwargs):
+        """
+        Fetches documents by id from the real-time get handler (/get), which
+        skips the query parser and also sees documents that are not
+        committed yet. Returns a list in the order of `ids`, with None for
+        ids that were not found.
+
+        `ids` are sent `chunk_size` per request, up to `max_workers` requests
+        at a time. When `fl` is a list of field names, each document is
+        returned as a compact record, a named tuple of those fields in that
+        order (missing fields are None); otherwise documents are dicts. A
+        wildcard (`*`, `attr_*`) in `fl` fetches whole documents, as dicts.
+
+        Documents in the `document_cache` are not fetched again, unless other
+        keywords (`fq`...) are given.
+        """
+        keys = [unicode(id) for id in ids]
+        deadline = Deadline.coerce(deadline)
+        records = isinstance(fl, (list, tuple))
+        if records:
+            fields = tuple(fl)
+        elif fl is not None:
+            fields = tuple(field.strip() for field in fl.split(','))
+        if fl is None or any('*' in field for field in fields):
+            # can't tell the fields of the records
+            records = False
+            fields = fetch_fields = None
+        else:
+            fetch_fields = fields if id_field in fields else fields + (id_field,)
+
+        cache = self.document_cache
+        if cache is not None and not kwargs:
+            unique = list(OrderedDict.fromkeys(keys))
+            found = cache.lookup(unique, fetch_fields)
+            missing = [key for key in unique if key not in found]
+        else:
+            cache = None
+            found = {}
+            missing = keys
+        if missing:
+            fetched = self._get_docs(missing, fetch_fields, id_field, chunk_size, max_workers, deadline, kwargs)
+            if cache is not None:
+                cache.store_docs(fetched, fetch_fields)
+            found.update(fetched)
+
+        if records:
+            record = _record_class(fields)
+            found = dict((key, record(*[doc.get(field) for field in fields])) for key, doc in found.iteritems())
+        elif fields is not None and cache is not None:
+            # cached documents can have more fields than asked for
+            found = dict((key, dict((field, doc[field]) for field in fields if field in doc))
+                         for key, doc in found.iteritems())
+        return [found.get(key) for key in keys]
+
+    def _get_docs(self, ids, fields, id_field, chunk_size, max_workers, deadline, params):
+        """Fetches `ids` from /get, returns the documents found by unicode id."""
+        params = dict(params)
+        params['wt'] = self.wt
+        if fields is not None:
+            params['fl'] = ','.join(fields)
+        chunks = [ids[i:i + chunk_size] for i in xrange(0, len(ids), chunk_size)]
+        fetch = partial(self._get_chunk, params, deadline)
+        if len(chunks) > 1 and max_workers > 1:
+            pages = self._workers(max_workers).map(fetch, chunks)
+        else:
+            pages = map(fetch, chunks)
+        found = {}
+        for docs in pages:
+            for doc in docs:
+                found[unicode(doc.get(id_field))] = doc
+        return found
+
+    def _get_chunk(self, params, deadline, ids):
+        params = dict(params)
+        params['id'] = [unicode(id).encode('utf-8') for id in ids]
+        path = '%s/get?%s' % (self.path, urlencode(params, True))
+        results = self._build_results(self._send_request('GET', path, deadline=deadline))
+        if not results.docs and results.result.get('doc'):
+            # a single id is answered with a bare document
+            return [results.result['doc']]
+        return results.docs
+
+    def _workers(self, max_workers):
+        """A thread pool for concurrent requests, created on first use and kept."""
+        self._worker_pool_lock.acquire()
+        try:
+            if self._worker_pool is None or self._worker_pool._processes < max_workers:
+                if self._worker_pool is not None:
+                    # lets the threads finish what they are doing, then exit
+                    self._worker_pool.close()
+                from multiprocessing.pool import ThreadPool
+                self._worker_pool = ThreadPool(max_workers)
+            return self._worker_pool
+        finally:
+            self._worker_pool_lock.release()
+
+    def export(self, q, fl, sort, cursor_rows=1000, fallback=True, unique_key='id', **kwargs):
+        """
+        Streams every document matching `q` from the export handler
+        (/export), as one tuple of the `fl` fields per document, in `sort`
+        order. The whole result set comes in a single response that is
+        parsed as it arrives, so memory use doesn't grow with its size.
+
+        The response is read from a connection of its own, outside of
+        `http_pool`. Opening it goes through the retry policy and the circuit
+        breaker like other requests, but it is not reported to
+        `instrumentation`, and nothing is retried once documents arrive.
+
+        /export only works on fields with docValues. When Solr refuses the
+        request for that reason and `fallback` is true, the documents are
+        paged with cursorMark instead, `cursor_rows` at a time (`unique_key`
+        is added to the sort, as cursors require).
+        """
+        if isinstance(fl, basestring):
+            fields = tuple(field.strip() for field in fl.split(','))
+        else:
+            fields = tuple(fl)
+        params = dict(kwargs)
+        params.update({'q': self._encode_q(q), 'fl': ','.join(fields), 'sort': sort, 'wt': 'json'})
+        path = '%s/export?%s' % (self.path, urlencode(params, True))
+        headers = {'Accept-Encoding': 'gzip, deflate' if self.compression else 'identity'}
+
+        connections = []
+        def open_export(method, path, body, headers, timeout):
+            conn = self._connection(timeout)
+            streaming = False
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                if response.status != 200:
+                    return response.status, dict(response.getheaders()), self._read_body(response)
+                streaming = True
+            finally:
+                if not streaming:
+                    conn.close()
+            # left open for the documents to be read from it
+            connections.append(conn)
+            return response.status, dict(response.getheaders()), response
+
+        try:
+            try:
+                response = self._send_with_retries('GET', path, None, headers, None, True, _DEFAULT_TIMEOUT,
+                                                   send=open_export)
+            except SolrError, e:
+                if not (fallback and 'docvalues' in str(e).lower()):
+                    raise
+                log.info("Can't export from %s, paging with a cursor instead: %s", self.url, e)
+            else:
+                docs = _stream_docs(self._iter_body(response))
+                try:
+                    first = docs.next()
+                except StopIteration:
+                    return
+                error = first.get('EXCEPTION')
+                if error is None:
+                    yield tuple([first.get(field) for field in fields])
+                    for doc in docs:
+                        if 'EXCEPTION' in doc:
+                            raise SolrError("Error: %s" % doc['EXCEPTION'])
+                        yield tuple([doc.get(field) for field in fields])
+                    return
+                # errors found before any document are sent as a document
+                if not (fallback and 'docvalues' in error.lower()):
+                    raise SolrError("Error: %s" % error)
+                log.info("Can't export from %s, paging with a cursor instead: %s", self.url, error)
+        finally:
+            for conn in connections:
+                conn.close()
+
+        for doc in self._cursor_docs(q, fields, sort, cursor_rows, unique_key, kwargs):
+            yield tuple([doc.get(field) for field in fields])
+
+    def _cursor_docs(self, q, fields, sort, rows, unique_key, params):
+        if unique_key not in [clause.split()[0] for clause in sort.split(',') if clause.strip()]:
+            sort = '%s,%s asc' % (sort, unique_key)
+        params = dict(params)
+        params.update({'fl': ','.join(fields), 'sort': sort, 'rows': rows})
+        for mark, results in self._cursor_pages(q, params):
+            for doc in results.docs:
+                yield doc
+
+    def _cursor_pages(self, q, params, mark='*'):
+        """
+        Pages through `q` with cursorMark, from `mark` on, yielding the mark
+        of each page and its `Results`. The sort of `params` must end on the
+        unique key.
+        """
+        while True:
+            results = self.search(q, cursorMark=mark, **params)
+            yield mark, results
+            next_mark = results.result.get('nextCursorMark')
+            if next_mark is None or next_mark == mark:
+                return
+            mark = next_mark
 
     def group(self,q,**kwargs):
+        """
+        Performs a grouped search and returns `GroupedResults`. Pass the
+        grouping parameters as keywords, e.g.::
+
+            conn.group('ipod', **{'group.field': 'manu', 'group.limit': 3, 'group.ngroups': 'true'})
+
+        Like `search`, long queries are sent with a POST.
+        """
+        deadline = kwargs.pop('deadline', None)
         params = {'q': q or '',
                   'group':'true' }
         
         params.update(kwargs)
-        response = self._select(params)
-        return GroupedResults(response)
+        if len(params['q']) < 1024:
+            response = self._select(params, deadline=deadline)
+        else:
+            response = self._select_post(params, deadline=deadline)
+        return self._build_results(response, GroupedResults)
 
 #######################################################
       
@@ -529,7 +1968,30 @@ class Solr(object):
         """Adds or updates documents. For now, docs is a list of dictionaies
         where each key is the field name and each value is the value to index.
         """
-        message = ET.Element('add')
+        cache = self.document_cache
+        if cache is not None:
+            keys = []
+            docs = self._invalidating(docs, keys)
+        try:
+            with self._throttled():
+                response = self._update(self._add_message(self._counting(docs)))
+        finally:
+            if cache is not None:
+                # again, in case a concurrent `get` cached old versions meanwhile
+                cache.invalidate(keys)
+        # TODO: Supposedly, we can put a <commit /> element in the same post body
+        # as the add element. That isn't working for some reason, and it would save us
+        # an extra trip to the server. This works for now.
+        if commit:
+            self.commit()
+
+    def _add_message(self, docs):
+        """
+        Yields the <add> message for `docs` one document at a time, so large
+        batches can be streamed.
+        """
+        ET = etree()
+        yield '<add>'
         for doc in docs:
             d = ET.Element('doc')
             for key, value in doc.items():
@@ -544,12 +2006,21 @@ class Solr(object):
                     f = ET.Element('field', name=key)
                     f.text = self._from_python(value)
                     d.append(f)
-            message.append(d)
-        m = ET.tostring(message)
-        response = self._update(m)
-        # TODO: Supposedly, we can put a <commit /> element in the same post body
-        # as the add element. That isn't working for some reason, and it would save us
-        # an extra trip to the server. This works for now.
+            yield ET.tostring(d)
+        yield '</add>'
+
+    def _serialize_add(self, docs):
+        """
+        The body of the add request for `docs`, to be sent with
+        `_add_serialized`. Needs no state from the client, so it can run in
+        another process on an uninitialized instance.
+        """
+        return sanitize(''.join(self._add_message(docs)))
+
+    def _add_serialized(self, body, commit=True, docs=0):
+        """Sends a body built by `_serialize_add` for `docs` documents."""
+        with self._throttled(docs):
+            response = self._update(body, clean_ctrl_chars=False)
         if commit:
             self.commit()
 
@@ -564,6 +2035,7 @@ class Solr(object):
         elif q is not None:
             m = '<delete><query>%s</query></delete>' % q
         response = self._update(m)
+        self._invalidate(id, q)
         # TODO: Supposedly, we can put a <commit /> element in the same post body
         # as the delete element. That isn't working for some reason, and it would save us
         # an extra trip to the server. This works for now.
@@ -573,22 +2045,93 @@ class Solr(object):
     def commit(self):
         response = self._update('<commit />')
 
+    @contextmanager
+    def _throttled(self, docs=0):
+        """Holds a slot of the update throttle, if any, while sending `docs` documents."""
+        throttle = self.update_throttle
+        if throttle is None:
+            yield
+            return
+        with throttle.request():
+            yield
+        throttle.charge(docs=docs)
+
+    def _counting(self, docs):
+        """Charges the documents to the update throttle as they are sent."""
+        throttle = self.update_throttle
+        if throttle is None:
+            return docs
+        if isinstance(docs, (list, tuple)):
+            throttle.charge(docs=len(docs))
+            return docs
+        return self._counting_iter(docs, throttle)
+
+    def _counting_iter(self, docs, throttle):
+        count = 0
+        try:
+            for doc in docs:
+                count += 1
+                yield doc
+        finally:
+            throttle.charge(docs=count)
+
+    def _invalidating(self, docs, keys):
+        """Drops `docs` from the document cache as they are sent, collecting their keys."""
+        cache = self.document_cache
+        unique_key = cache.unique_key
+        for doc in docs:
+            key = doc.get(unique_key)
+            if key is not None:
+                keys.append(key)
+                cache.invalidate([key])
+            yield doc
+
+    def _invalidate(self, id, q):
+        cache = self.document_cache
+        if cache is not None:
+            if id is not None:
+                cache.invalidate([id])
+            else:
+                # can't tell which documents matched
+                cache.clear()
+
     def optimize(self,waitFlush=False,waitSearcher=False,block=False):
         """
         Optimize index and optionally wait for the call to be completed before returning with `block=True`. Default
         is `False`
         """
-        params = {'waitFlush':str(waitFlush).lower(),'waitSearcher':str(waitSearcher).lower(),'optimize':str(True).lower()}
+        waitFlush, waitSearcher = str(waitFlush).lower(), str(waitSearcher).lower()
         if block:
-            import urllib
-            import socket
-            socket.setdefaulttimeout(None) # block until we get a response
-            path = '/update?%s' % (urlencode(params))
-            print self.url+path
-            return urllib.urlopen(self.url+path).read()
-        
+            return self.optimize_async(waitFlush=waitFlush,waitSearcher=waitSearcher).wait()
+        params = {'waitFlush':waitFlush,'waitSearcher':waitSearcher,'optimize':str(True).lower()}
         path = '%s/update?%s' % (self.path,urlencode(params))
-        return self._send_request('GET',path)
+        return self._send_request('GET', path, idempotent=False)
+
+    def optimize_async(self, maxSegments=None, poll_interval=1.0, **params):
+        """
+        Starts an optimize and returns at once with an `OptimizeHandle` to
+        follow it. Other keywords (waitFlush, waitSearcher...) are sent as
+        update parameters.
+        """
+        params['optimize'] = 'true'
+        if maxSegments is not None:
+            params['maxSegments'] = maxSegments
+        return OptimizeHandle(self, params, target_segments=maxSegments or 1, poll_interval=poll_interval)
+
+    def expunge_deletes_async(self, poll_interval=1.0, **params):
+        """
+        Starts a commit with expungeDeletes, merging away the segments with
+        deleted documents, and returns an `OptimizeHandle`.
+        """
+        params['commit'] = 'true'
+        params['expungeDeletes'] = 'true'
+        return OptimizeHandle(self, params, target_segments=None, poll_interval=poll_interval)
+
+    def segment_count(self, deadline=None):
+        """The number of segments of the index, from the Luke handler."""
+        path = '%s/admin/luke?%s' % (self.path, urlencode({'numTerms': 0, 'wt': 'json'}))
+        index = json.loads(self._send_request('GET', path, deadline=deadline))['index']
+        return index.get('segmentCount')
         
 # Using two-tuples to preserve order.
 REPLACEMENTS = (
@@ -647,13 +2190,41 @@ class SolrJson(Solr):
         """
         path = '%s/update/json' % self.path
         
-        return self._send_request('POST', path, message, {'Content-type': 'application/json'})
+        return self._post_update(path, message, 'application/json')
 
     def add(self, docs, commit=True):
-        message = json.dumps(docs)
-        response = self._update(message)
+        cache = self.document_cache
+        if cache is not None:
+            keys = []
+            docs = self._invalidating(docs, keys)
+        try:
+            with self._throttled():
+                response = self._update(self._add_message(self._counting(docs)))
+        finally:
+            if cache is not None:
+                cache.invalidate(keys)
         return response
 
+    def _add_message(self, docs):
+        """
+        Yields the JSON array for `docs` one document at a time, so large
+        batches can be streamed.
+        """
+        encode = self.json_codec.encode
+        yield '['
+        separator = ''
+        for doc in docs:
+            yield separator + encode(doc)
+            separator = ','
+        yield ']'
+
+    def _serialize_add(self, docs):
+        return ''.join(self._add_message(docs))
+
+    def _add_serialized(self, body, commit=True, docs=0):
+        with self._throttled(docs):
+            return self._update(body)
+
     def delete(self, id=None, q=None, commit=True, fromPending=True, fromCommitted=True):
         """Deletes documents."""
         if id is None and q is None:
@@ -666,29 +2237,13 @@ class SolrJson(Solr):
             m = json.dumps({"delete":{"query":"%s" % q }}) 
             
         response = self._update(m)
+        self._invalidate(id, q)
         if commit:
             self.commit()
 
     def commit(self):
         response = self._update('{"commit":{}}')
 
-    def optimize(self,waitFlush=False,waitSearcher=False,block=False):
-        """
-        Optimize index and optionally wait for the call to be completed before returning with `block=True`. Default
-        is `False`
-        """
-        params = {'waitFlush':str(waitFlush).lower(),'waitSearcher':str(waitSearcher).lower(),'optimize':str(True).lower()}
-        if block:
-            import urllib
-            import socket
-            socket.setdefaulttimeout(None) # block until we get a response
-            path = '/update?%s' % (urlencode(params))
-            print self.url+path
-            return urllib.urlopen(self.url+path).read()
-        
-        path = '%s/update?%s' % (self.path,urlencode(params))
-        return self._send_request('GET',path)
-
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
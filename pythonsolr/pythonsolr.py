@@ -1,5 +1,10 @@
 from pysolr import *
-import socket
+from pysolr import Deadline, SolrTimeoutError
+from jsoncodec import get_codec
+from collections import deque
+import sys
+import threading
+import Queue
 import logging
 log = logging.getLogger('solr')
 from contextlib import contextmanager
@@ -7,13 +12,36 @@ from contextlib import contextmanager
 class SolrResultsPaginator(object):
     """Offers an iterator on Solr results.  You simply provide a
     configured pysolr `Solr` instance, a query, and the default parameters.
-    This class takes care of the rest.  Example use:
+    This class takes care of the rest.  Example use::
 
-        >>> results = SolrResultsPaginator(Solr(SOLR_URL))
-        >>> assert len(results) == len([result for result in results])
+        results = SolrResultsPaginator(Solr(SOLR_URL))
+        assert len(results) == len([result for result in results])
+
+    `deadline` (seconds or a `Deadline`) bounds the whole iteration: every
+    page request only gets the time that is left of it.
+
+    A page that fails raises its error rather than ending the iteration:
+
+        >>> from pysolr import SolrError
+        >>> class Page(object):
+        ...     def __init__(self, docs, hits):
+        ...         self.docs, self.hits = docs, hits
+        >>> class FlakySolr(object):
+        ...     def search(self, q, start=0, **params):
+        ...         if start >= 2:
+        ...             raise SolrError("Error: timed out")
+        ...         return Page([start, start + 1], 5)
+        >>> docs = []
+        >>> for doc in SolrResultsPaginator(FlakySolr()):
+        ...     docs.append(doc)
+        Traceback (most recent call last):
+        ...
+        SolrError: Error: timed out
+        >>> docs
+        [0, 1]
     """
 
-    def __init__(self, solr, query="*:*", default_params=None, max_index=None):
+    def __init__(self, solr, query="*:*", default_params=None, max_index=None, deadline=None):
         # store solr instance and query so that we can re-query for future pages
         self.solr = solr
         self.query = query
@@ -27,6 +55,7 @@ class SolrResultsPaginator(object):
         self.exhausted = False
         self.index = 0
         self.max_index = max_index
+        self.deadline = Deadline.coerce(deadline)
 
     def _init_if_needed(self):
         if not self.initialized:
@@ -42,7 +71,7 @@ class SolrResultsPaginator(object):
     def __iter__(self):
         if self.exhausted:
             # reset
-            return SolrResultsPaginator(self.solr, self.query, self.default_params)
+            return self.__class__(self.solr, self.query, self.default_params, deadline=self.deadline)
         return self
 
     def __len__(self):
@@ -60,24 +89,25 @@ class SolrResultsPaginator(object):
         return self.cursor
 
     def _next(self):
-        try:
-            # advance the cursor forward
-            self.cursor = self.item_iter.next()
-        except StopIteration:
-            # we are either at the end of the page or the result set
+        while True:
             try:
-                # attempt to move to the next page
-                self.move_to_next_page()
-                # if we are at the end of the result set, page will come back empty
-                assert len(self.page.docs) != 0
-            except:
-                # end of result set, so we stop the iteration
+                # advance the cursor forward
+                self.cursor = self.item_iter.next()
+                return self.cursor
+            except StopIteration:
+                pass
+            # end of the page: stop at the end of the result set (an empty page, or
+            # all of numFound seen), otherwise fetch the next page. Errors fetching
+            # it are raised, a failed page must not look like the end of the results.
+            total = self._total()
+            if not self.page_items or (total is not None and self.index >= total):
                 self.exhausted = True
                 raise StopIteration()
-            # page has advanced successfully, so let's re-call next()
-            self.cursor = self._next()
-        # cursor has advanced, so we advance the index #
-        return self.cursor
+            self.move_to_next_page()
+
+    def _total(self):
+        """The number of items to page through, None if unknown."""
+        return self.page.hits
 
     def move_to_next_page(self):
         # use default parameters, and then overwrite "start" with the one calculated
@@ -85,10 +115,13 @@ class SolrResultsPaginator(object):
         query_params = dict(self.default_params)
         # if first page, index is 0, otherwise we attempt to get the first doc on next page
         query_params["start"] = self.index
+        if self.deadline is not None:
+            query_params["deadline"] = self.deadline
         # fire the solr search
         self.page = self.solr.search(self.query, **query_params)
         # use a generator that will yield each of the items in docs
-        self.item_iter = (item for item in self.page.docs)
+        self.page_items = self.page.docs
+        self.item_iter = (item for item in self.page_items)
 
     def __unicode__(self):
         fmt = u"SolrResultsPaginator(hits={hits}, solr={solr}, query={query}, default_params={default_params})"
@@ -97,26 +130,206 @@ class SolrResultsPaginator(object):
     __repr__ = __unicode__
 
 
+class SolrGroupPaginator(SolrResultsPaginator):
+    """Streams the groups of a grouped search, one `Group` at a time, paging
+    through them with `start`/`rows` instead of fetching every group at once.
+    The grouping command is given in `default_params`::
+
+        groups = SolrGroupPaginator(solr, "*:*", {"group.field": "publisher", "group.limit": 5})
+        for group in groups:
+            print group.value, group.hits, len(group.docs)
+
+    `rows` is the number of groups per page (100 by default), `group.limit`
+    and `group.offset` select the documents returned inside each group.
+    `len()` is the total number of groups.
+    """
+
+    def __init__(self, solr, query="*:*", default_params=None, max_index=None, deadline=None):
+        default_params = dict(default_params or {})
+        default_params.setdefault("rows", 100)
+        default_params.setdefault("group.ngroups", "true")
+        super(SolrGroupPaginator, self).__init__(solr, query, default_params, max_index, deadline)
+        command = default_params.get("group.field") or default_params.get("group.func")
+        if isinstance(command, (list, tuple)):
+            command = command[0]
+        if command is None:
+            raise ValueError("SolrGroupPaginator needs a group.field or group.func")
+        self.command = command
+
+    def __len__(self):
+        self._init_if_needed()
+        if self.page.ngroups is None:
+            raise TypeError("the number of groups is unknown without group.ngroups=true")
+        return self.page.ngroups
+
+    def _total(self):
+        return self.page.ngroups
+
+    def move_to_next_page(self):
+        query_params = dict(self.default_params)
+        # start and rows count groups, not documents
+        query_params["start"] = self.index
+        if self.deadline is not None:
+            query_params["deadline"] = self.deadline
+        self.page = self.solr.group(self.query, **query_params)[self.command]
+        self.page_items = self.page.groups
+        self.item_iter = iter(self.page_items)
+
+    def __unicode__(self):
+        fmt = u"SolrGroupPaginator(command={command}, solr={solr}, query={query}, default_params={default_params})"
+        return fmt.format(**vars(self))
+
+    __repr__ = __unicode__
+
+
+class SolrFacetPaginator(object):
+    """Iterates over all the values of a facet.field as `(value, count)` pairs,
+    `page_size` values per request (with `facet.offset`/`facet.limit`), so a
+    high-cardinality field never has to be downloaded in one response::
+
+        for value, count in SolrFacetPaginator(solr, "*:*", "tags", page_size=5000):
+            cloud[value] = count
+
+    Values come in index order by default (`sort="count"` for the most
+    frequent first) and only values with at least `mincount` documents are
+    returned. `prefix` restricts the values to those starting with it.
+    """
+
+    def __init__(self, solr, query="*:*", field=None, default_params=None, page_size=1000,
+                 prefix=None, sort="index", mincount=1, deadline=None):
+        if field is None:
+            raise ValueError("SolrFacetPaginator needs a field")
+        self.solr = solr
+        self.query = query
+        self.field = field
+        self.default_params = dict(default_params or {})
+        self.page_size = page_size
+        self.prefix = prefix
+        self.sort = sort
+        self.mincount = mincount
+        self.deadline = Deadline.coerce(deadline)
+
+    def _fetch(self, offset):
+        params = dict(self.default_params)
+        params.update({
+            "rows": 0,
+            "facet": "true",
+            "facet.field": self.field,
+            "facet.offset": offset,
+            "facet.limit": self.page_size,
+            "facet.sort": self.sort,
+            "facet.mincount": self.mincount,
+        })
+        if self.prefix is not None:
+            params["facet.prefix"] = self.prefix
+        if self.deadline is not None:
+            params["deadline"] = self.deadline
+        return self.solr.search(self.query, **params).facet_counts.field(self.field)
+
+    def pages(self):
+        """Yields one `FacetField` per request."""
+        offset = 0
+        while True:
+            page = self._fetch(offset)
+            if len(page):
+                yield page
+            if len(page) < self.page_size:
+                return
+            offset += self.page_size
+
+    def __iter__(self):
+        for page in self.pages():
+            for item in page:
+                yield item
+
+    def __unicode__(self):
+        fmt = u"SolrFacetPaginator(field={field}, prefix={prefix}, solr={solr}, query={query})"
+        return fmt.format(**vars(self))
+
+    __repr__ = __unicode__
+
+
+def parallel_facet_values(solr, query="*:*", field=None, prefixes=(), max_workers=4, max_pending_pages=8, **kwargs):
+    """Like iterating a `SolrFacetPaginator` for each of `prefixes` (which
+    should partition the field's values, e.g. one per leading character), but
+    with `max_workers` partitions fetched concurrently. Pairs come out in no
+    particular order. At most `max_pending_pages` pages are buffered, so a
+    slow consumer holds back the workers. Other keywords are passed to
+    `SolrFacetPaginator`.
+    """
+    todo = Queue.Queue()
+    for prefix in prefixes:
+        todo.put(prefix)
+    pages = Queue.Queue(max_pending_pages)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def work():
+        error = None
+        try:
+            while not stopped.is_set():
+                try:
+                    prefix = todo.get_nowait()
+                except Queue.Empty:
+                    break
+                paginator = SolrFacetPaginator(solr, query, field, prefix=prefix, **kwargs)
+                for page in paginator.pages():
+                    put(page)
+        except Exception:
+            error = sys.exc_info()
+        put((done, error))
+
+    # not daemons: once stopped they finish their current request and exit
+    workers = [threading.Thread(target=work) for i in range(min(max_workers, len(prefixes)))]
+    for worker in workers:
+        worker.start()
+    try:
+        running = len(workers)
+        while running:
+            page = pages.get()
+            if isinstance(page, tuple) and page[0] is done:
+                running -= 1
+                if page[1] is not None:
+                    raise page[1][0], page[1][1], page[1][2]
+                continue
+            for item in page:
+                yield item
+    finally:
+        stopped.set()
+
+
 class PythonSolr(Solr):
     def __init__(self, url='http://127.0.0.1:8983/solr/', decoder=None, timeout=60):
         super(PythonSolr, self).__init__(url, decoder, timeout)
         
     def search(self, q, **kwargs):
-        results = super(PythonSolr, self).search(q, **kwargs)
+        deadline = Deadline.coerce(kwargs.pop('deadline', None))
+        results = super(PythonSolr, self).search(q, deadline=deadline, **kwargs)
         # replace results paginator with our custom paginator
-        results.paginator = PythonSolrResults(self, query=q, default_params=kwargs)
+        results.paginator = PythonSolrResults(self, query=q, default_params=kwargs, deadline=deadline)
         log.debug(u"ParselySolr: starting Solr search with query={query} and params={params}".format(
             query=q, params=kwargs)) 
         return results
 
 class PythonSolrResults(SolrResultsPaginator):
-    def __init__(self, solr=Solr('http://127.0.0.1:8983/solr/'), query="*:*", default_params=None, max_index=None):
+    def __init__(self, solr=None, query="*:*", default_params=None, max_index=None,
+                 deadline=None):
+        if solr is None:
+            solr = Solr('http://127.0.0.1:8983/solr/')
         if default_params is None:
             default_params = {"rows": "100"} 
         else:
             if "rows" not in default_params:
                 default_params["rows"] = 100
-        super(PythonSolrResults, self).__init__(solr, query, default_params, max_index)
+        super(PythonSolrResults, self).__init__(solr, query, default_params, max_index, deadline)
 
     def move_to_next_page(self):
         index = 0
@@ -137,11 +350,11 @@ class PythonSolrResults(SolrResultsPaginator):
     __repr__ = __unicode__
 
 @contextmanager
-def solr_batch_adder(solr, batch_size=500, auto_commit=False):
+def solr_batch_adder(solr, batch_size=500, auto_commit=False, processes=None, compact=False, unique_key='id'):
     """Meant to be used with a `with_statement`, so that you don't forget to flush the 
-    `SolrBatchAdder` after adding a bunch of documents to it.  Example use:
+    `SolrBatchAdder` after adding a bunch of documents to it.  Example use::
 
-    >>> with solr_batch_add(solr) as batcher:
+        with solr_batch_adder(solr) as batcher:
             for document in documents:
                 del document['unnecessary']
                 batcher.add_one(document)
@@ -149,16 +362,155 @@ def solr_batch_adder(solr, batch_size=500, auto_commit=False):
     The result of this will be one call of `batcher.add_one()` for each document, and, at the end,
     a call to `batcher.flush()` and `batcher.commit()`.  Since this context manager automatically
     commits at the end, we have `auto_commit` to false in our kwargs.
+
+    With `processes`, a `ParallelSolrBatchAdder` serializes the batches on that
+    many processes. `compact` and `unique_key` are passed to the adder.
     """
-    batcher = SolrBatchAdder(solr, batch_size, auto_commit)
+    if processes:
+        batcher = ParallelSolrBatchAdder(solr, batch_size, auto_commit, processes=processes,
+                                         compact=compact, unique_key=unique_key)
+    else:
+        batcher = SolrBatchAdder(solr, batch_size, auto_commit, compact=compact, unique_key=unique_key)
     try:
         yield batcher
     finally:
         log.info("solr_batch_adder: flushing last few items in batch")
         batcher.flush()
+        if processes:
+            batcher.close()
         
+def _values(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+def _apply_op(doc, field, op, value):
+    """Applies an atomic update op to the full document `doc`; False if it can't."""
+    if op == 'set':
+        if value is None:
+            doc.pop(field, None)
+        else:
+            doc[field] = value
+    elif op == 'add':
+        doc[field] = _values(doc.get(field)) + _values(value)
+    elif op == 'remove':
+        removed = _values(value)
+        doc[field] = [v for v in _values(doc.get(field)) if v not in removed]
+    elif op == 'inc':
+        # Solr increments a missing field from 0; anything else isn't folded
+        base = doc.get(field)
+        if base is None:
+            base = 0
+        if not (_is_number(base) and _is_number(value)):
+            return False
+        doc[field] = base + value
+    else:
+        # removeregex...
+        return False
+    return True
+
+def _fold_ops(old, new):
+    """Two successive `(op, value)` updates of a field as one, or None."""
+    op, value = new
+    if op == 'set':
+        return new
+    if old[0] == 'set':
+        doc = {'f': old[1]}
+        if _apply_op(doc, 'f', op, value):
+            return ('set', doc.get('f'))
+        return None
+    if old[0] == op == 'inc':
+        if not (_is_number(old[1]) and _is_number(value)):
+            return None
+        return ('inc', old[1] + value)
+    if old[0] == op == 'add':
+        return ('add', _values(old[1]) + _values(value))
+    if old[0] == op == 'remove':
+        return ('remove', _values(old[1]) + [v for v in _values(value) if v not in _values(old[1])])
+    return None
+
+def _is_atomic(doc):
+    for value in doc.itervalues():
+        if isinstance(value, dict):
+            return True
+    return False
+
+def _field_ops(doc, unique_key):
+    # in an atomic update, plain values are set
+    ops = {}
+    for field, value in doc.iteritems():
+        if field == unique_key:
+            continue
+        if isinstance(value, dict):
+            if len(value) != 1:
+                return None
+            ops[field] = value.items()[0]
+        else:
+            ops[field] = ('set', value)
+    return ops
+
+def compact_docs(old, new, unique_key='id'):
+    """
+    Folds two versions of a document, `old` then `new`, into the one that
+    has the same effect when sent alone; None if they can't be folded. A
+    full document replaces whatever came before it, and atomic updates
+    ({'field': {'set'|'add'|'remove'|'inc': value}}) are applied to a
+    previous full document or merged with a previous atomic update.
+
+    >>> compact_docs({'id': 1, 'n': 1}, {'id': 1, 'n': {'inc': 2}})
+    {'id': 1, 'n': 3}
+    >>> sorted(compact_docs({'id': 1, 'n': {'inc': 1}}, {'id': 1, 'n': {'inc': 2}, 't': 'x'}).items())
+    [('id', 1), ('n', {'inc': 3}), ('t', {'set': 'x'})]
+    >>> compact_docs({'id': 1, 'n': {'inc': 1}}, {'id': 1, 'n': {'set': None}})
+    {'id': 1, 'n': {'set': None}}
+    >>> compact_docs({'id': 1, 'n': {'set': None}}, {'id': 1, 'n': {'inc': 2}})
+    {'id': 1, 'n': {'set': 2}}
+
+    Updates that can't be folded exactly stay separate:
+
+    >>> print compact_docs({'id': 1, 'n': 'x'}, {'id': 1, 'n': {'inc': 2}})
+    None
+    >>> print compact_docs({'id': 1, 'n': {'set': [1, 2]}}, {'id': 1, 'n': {'inc': 2}})
+    None
+    >>> print compact_docs({'id': 1, 'n': [1]}, {'id': 1, 'n': {'inc': 2}})
+    None
+    """
+    if '_version_' in old or '_version_' in new:
+        # optimistic concurrency: each version has to be checked by Solr
+        return None
+    if not _is_atomic(new):
+        return new
+    new_ops = _field_ops(new, unique_key)
+    if new_ops is None:
+        return None
+    if not _is_atomic(old):
+        doc = dict(old)
+        for field, (op, value) in new_ops.iteritems():
+            if not _apply_op(doc, field, op, value):
+                return None
+        return doc
+    ops = _field_ops(old, unique_key)
+    if ops is None:
+        return None
+    for field, new_op in new_ops.iteritems():
+        if field in ops:
+            folded = _fold_ops(ops[field], new_op)
+            if folded is None:
+                return None
+            ops[field] = folded
+        else:
+            ops[field] = new_op
+    doc = dict((field, {op: value}) for field, (op, value) in ops.iteritems())
+    doc[unique_key] = new[unique_key]
+    return doc
+
 class SolrBatchAdder(object):
-    def __init__(self, solr, batch_size=100, auto_commit=True):
+    def __init__(self, solr, batch_size=100, auto_commit=True, compact=False, unique_key='id'):
         """Provides an abstraction for batching commits to the Solr index when processing
         documents with pysolr.  `SolrBatchAdder` maintains an internal "batch" list, and
         when it reaches `batch_size`, it will commit the batch to Solr.  This allows for
@@ -166,12 +518,27 @@ class SolrBatchAdder(object):
 
         `batch_size` is 100 by default; different values may yield different performance 
         characteristics, and this of course depends upon your average document size and 
-        Solr schema.  But 100 seems to improve performance significantly over single commits."""
+        Solr schema.  But 100 seems to improve performance significantly over single commits.
+
+        With `compact`, a document whose `unique_key` is already in the pending batch is folded
+        into the pending version (see `compact_docs`) instead of being sent as well: only the last
+        version of a document is indexed, and successive atomic updates become one. `elided`
+        counts the documents that were folded away."""
         self.solr = solr
-        self.batch = list()
-        self.batch_len = 0
         self.batch_size = batch_size
         self.auto_commit = auto_commit
+        self.compact = compact
+        self.unique_key = unique_key
+        self.elided = 0
+        # documents the one-by-one fallback could not add
+        self.failed = []
+        self._new_batch()
+
+    def _new_batch(self):
+        self.batch = list()
+        self.batch_len = 0
+        # position in the batch of the last version of each document, when compacting
+        self.positions = {}
 
     def add_one(self, doc):
         """Adds a single document to the batch adder, committing only if we've reached batch_size."""
@@ -186,7 +553,8 @@ class SolrBatchAdder(object):
 
     def flush(self):
         """Flushes the batch queue of the batch adder; necessary after 
-        successive calls to `add_one` or `add_multi`."""
+        successive calls to `add_one` or `add_multi`. Returns the documents
+        that could not be added since the previous flush."""
         batch_len = len(self.batch)
         auto_commit = self.auto_commit
         log.debug("SolrBatchAdder: flushing {batch_len} articles to Solr (auto_commit={auto_commit})".format(
@@ -195,32 +563,58 @@ class SolrBatchAdder(object):
             self.solr.add(self.batch, commit=auto_commit)
         except:
             log.exception("Exception encountered when committing batch, falling back on one-by-one commit")
-            # one by one fall-back
-            for item in self.batch:
-                try:
-                    self.solr.add([item], commit=False)
-                except:
-                    log.error(u"Could not add item to solr index")
-                    log.exception(u"Exception stack trace for adding item")
-            if auto_commit:
-                self.commit()
+            self._add_one_by_one(self.batch)
 
-        self.batch = list()
-        self.batch_len = 0
+        self._new_batch()
+        failed, self.failed = self.failed, []
+        return failed
+
+    def _add_one_by_one(self, batch):
+        for item in batch:
+            try:
+                self.solr.add([item], commit=False)
+            except:
+                log.error(u"Could not add item to solr index")
+                log.exception(u"Exception stack trace for adding item")
+                self.failed.append(item)
+        if self.auto_commit:
+            self.commit()
 
     def commit(self):
         try:
             self.solr.commit()
-        except socket.timeout:
+        except SolrTimeoutError:
             log.warning("SolrBatchAdder timed out when committing, but it's safe to ignore")
+            # still, Solr is struggling: slow the writers down
+            throttle = getattr(self.solr, 'update_throttle', None)
+            if throttle is not None:
+                throttle.congested()
 
     def _append_commit(self, doc):
+        if self.compact and self._fold(doc):
+            return
         if self.batch_len == self.batch_size:
             # flush first, because we are at our batch size
             self.flush()
         self._add_to_batch(doc)
 
+    def _fold(self, doc):
+        """Folds `doc` into its pending version, if there is one it can be folded into."""
+        position = self.positions.get(doc.get(self.unique_key))
+        if position is None:
+            return False
+        folded = compact_docs(self.batch[position], doc, self.unique_key)
+        if folded is None:
+            return False
+        self.batch[position] = folded
+        self.elided += 1
+        return True
+
     def _add_to_batch(self, doc):
+        if self.compact:
+            key = doc.get(self.unique_key)
+            if key is not None:
+                self.positions[key] = len(self.batch)
         self.batch.append(doc)
         self.batch_len += 1
 
@@ -228,4 +622,81 @@ class SolrBatchAdder(object):
         fmt = "SolrBatchAdder(batch_size={batch_size}, batch_len={batch_len}, solr={solr}"
         return fmt.format(**vars(self))
 
- 
+
+def _serialize_batch(solr_class, codec_name, docs):
+    # runs in a pool process: _serialize_add needs no client state but the
+    # JSON codec, which is passed by name
+    solr = object.__new__(solr_class)
+    solr.json_codec = get_codec(codec_name)
+    return solr._serialize_add(docs)
+
+class ParallelSolrBatchAdder(SolrBatchAdder):
+    def __init__(self, solr, batch_size=100, auto_commit=True, processes=None, max_pending=None, pool=None,
+                 compact=False, unique_key='id'):
+        """A `SolrBatchAdder` that turns batches into update bodies on a pool of
+        `processes` processes (one per CPU by default), so serialization isn't
+        held to one core by the GIL. This process only sends the ready bodies.
+        The workers encode with the client's `json_codec`, looked up by name.
+
+        Full batches are handed to the pool as they fill up and sent in order;
+        at most `max_pending` (twice the number of processes by default) are
+        in flight. `flush()` and `commit()` wait for all of them. A batch that
+        fails to serialize or to be sent falls back on adding its documents
+        one by one, like `SolrBatchAdder`.
+
+        Call `close()` when done to stop the pool (unless it was given as `pool`)."""
+        super(ParallelSolrBatchAdder, self).__init__(solr, batch_size, auto_commit, compact, unique_key)
+        import multiprocessing
+        self.own_pool = pool is None
+        self.pool = pool or multiprocessing.Pool(processes)
+        self.max_pending = max_pending or 2 * (processes or multiprocessing.cpu_count())
+        self.pending = deque()
+
+    def _append_commit(self, doc):
+        if self.compact and self._fold(doc):
+            return
+        if self.batch_len == self.batch_size:
+            self._submit()
+        self._add_to_batch(doc)
+
+    def _submit(self):
+        if self.batch:
+            result = self.pool.apply_async(_serialize_batch, (type(self.solr), self.solr.json_codec.name,
+                                                              self.batch))
+            self.pending.append((result, self.batch))
+            self._new_batch()
+        while len(self.pending) > self.max_pending:
+            self._send_oldest()
+
+    def _send_oldest(self):
+        result, batch = self.pending.popleft()
+        log.debug("ParallelSolrBatchAdder: sending {batch_len} articles to Solr (auto_commit={auto_commit})".format(
+            batch_len=len(batch), auto_commit=self.auto_commit))
+        try:
+            self.solr._add_serialized(result.get(), commit=self.auto_commit, docs=len(batch))
+        except:
+            log.exception("Exception encountered when committing batch, falling back on one-by-one commit")
+            self._add_one_by_one(batch)
+            return
+        cache = self.solr.document_cache
+        if cache is not None:
+            cache.invalidate([doc[cache.unique_key] for doc in batch if cache.unique_key in doc])
+
+    def flush(self):
+        """Sends the current batch and every batch still in flight. Returns
+        the documents that could not be added."""
+        self._submit()
+        while self.pending:
+            self._send_oldest()
+        failed, self.failed = self.failed, []
+        return failed
+
+    def commit(self):
+        self.flush()
+        super(ParallelSolrBatchAdder, self).commit()
+
+    def close(self):
+        self.flush()
+        if self.own_pool:
+            self.pool.close()
+            self.pool.join()
@@ -0,0 +1,232 @@
+"""
+Copies documents from one Solr core to another, optionally transforming
+them on the way::
+
+    def migrate(doc):
+        doc['title_s'] = doc.pop('title')
+        return doc
+
+    reindex(Solr(OLD_URL), Solr(NEW_URL), transform=migrate, checkpoint='migrate.json')
+
+The copy is a pipeline of three stages joined by bounded queues, so a slow
+stage holds back the others instead of piling documents up in memory:
+
+* a reader thread pages through the source with cursorMark, sorted on the
+  unique key so the order is stable between runs and deep pages are as
+  cheap as the first,
+* `max_workers` threads apply `transform` (returning None drops the
+  document),
+* the calling thread writes to the target through a `SolrBatchAdder`.
+
+With `checkpoint`, the number of source documents whose batch has been
+written, and the cursor mark of the page they end in, are saved to that
+file (as JSON) after every batch. Running the same reindex again resumes
+from there. Documents are written with their unique key, so the few that
+are copied twice after a resume simply overwrite themselves. A document
+that can't be written holds the checkpoint back, so that the next run
+tries it again. The file is only removed once every one of the source's
+numFound documents was copied or dropped.
+
+The fields in `exclude_fields` are removed from every document after
+`transform`. By default that is `_version_`: Solr takes a positive
+`_version_` on an add as an optimistic concurrency check, which fails
+with a version conflict in any other core. Add the copyField
+destinations of the target schema, which Solr fills again itself, so
+that their values aren't doubled::
+
+    reindex(source, target, exclude_fields=('_version_', 'text', 'title_sort'))
+"""
+
+from collections import deque
+import json
+import logging
+import os
+import sys
+import threading
+import Queue
+
+from pythonsolr import SolrBatchAdder
+
+__all__ = ['reindex']
+
+log = logging.getLogger('solr')
+
+def _load_checkpoint(path, query):
+    """Returns the position to resume at, and the cursor mark and position of its page."""
+    if not path or not os.path.exists(path):
+        return 0, '*', 0
+    f = open(path)
+    try:
+        state = json.load(f)
+    finally:
+        f.close()
+    if state.get('query') != query:
+        raise ValueError("checkpoint %s is for query %r, not %r" % (path, state.get('query'), query))
+    # checkpoints without a mark read from the start, skipping what was written
+    return state['position'], state.get('mark', '*'), state.get('mark_position', 0)
+
+def _save_checkpoint(path, query, position, written, marks):
+    mark_position, mark = _page_of(marks, position)
+    # write then rename, so a crash never leaves a truncated checkpoint
+    tmp = path + '.tmp'
+    f = open(tmp, 'w')
+    try:
+        json.dump({'query': query, 'position': position, 'written': written, 'mark': mark,
+                   'mark_position': mark_position}, f)
+    finally:
+        f.close()
+    os.rename(tmp, path)
+
+def reindex(source_solr, target_solr, query='*:*', transform=None, fl='*', unique_key='id', rows=500,
+            batch_size=500, max_workers=4, max_pending=2000, checkpoint=None, commit=True,
+            exclude_fields=('_version_',), **params):
+    """
+    Copies the documents matching `query` from `source_solr` to
+    `target_solr`, through `transform` if given. `rows` documents are read
+    per request and `batch_size` are written per update. The
+    `exclude_fields` are not copied. Other keywords are passed to the
+    source searches.
+
+    Returns a dict counting the documents 'read', 'written', 'dropped' by
+    the transform and 'failed' to be written in this run, the final
+    'position' and the source's numFound as 'total'.
+    """
+    start, mark, mark_position = _load_checkpoint(checkpoint, query)
+    if start:
+        log.info("reindex: resuming at document %s", start)
+    default_params = dict(params)
+    default_params.update({'rows': rows, 'fl': fl, 'sort': '%s asc' % unique_key})
+    # (position, cursor mark) of the pages read and not yet behind the checkpoint
+    marks = deque()
+    found = {'total': None}
+
+    read = Queue.Queue(max_pending)
+    transformed = Queue.Queue(max_pending)
+    stopped = threading.Event()
+    done = object()
+
+    def put(queue, item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def read_docs():
+        error = None
+        try:
+            seq = mark_position
+            for page_mark, results in source_solr._cursor_pages(query, default_params, mark):
+                if stopped.is_set():
+                    break
+                found['total'] = results.hits
+                marks.append((seq, page_mark))
+                for doc in results.docs:
+                    # the start of the page was written before
+                    if seq >= start:
+                        put(read, (seq, doc))
+                    seq += 1
+        except Exception:
+            error = sys.exc_info()
+        for i in range(len(workers)):
+            put(read, (done, None))
+        put(transformed, (done, error))
+
+    def transform_docs():
+        error = None
+        try:
+            while not stopped.is_set():
+                try:
+                    seq, doc = read.get(timeout=0.1)
+                except Queue.Empty:
+                    continue
+                if seq is done:
+                    break
+                if transform is not None:
+                    doc = transform(doc)
+                if doc is not None:
+                    for field in exclude_fields:
+                        doc.pop(field, None)
+                put(transformed, (seq, doc))
+        except Exception:
+            error = sys.exc_info()
+        put(transformed, (done, error))
+
+    # not daemons: once stopped they finish their current item and exit
+    workers = [threading.Thread(target=transform_docs) for i in range(max(1, max_workers))]
+    reader = threading.Thread(target=read_docs)
+    for thread in workers + [reader]:
+        thread.start()
+
+    batcher = SolrBatchAdder(target_solr, batch_size, auto_commit=False)
+    stats = {'read': 0, 'written': 0, 'dropped': 0, 'failed': 0, 'position': start, 'total': None}
+    # documents come out of the workers in any order: the checkpoint is the
+    # end of the longest run of sequence numbers that have all been written
+    # or dropped. A document that failed is never seen, and holds it back.
+    seen = set()
+    batched = []
+    position = start
+
+    def flush():
+        failed = set(id(doc) for doc in batcher.flush())
+        for seq, doc in batched:
+            if id(doc) in failed:
+                stats['failed'] += 1
+            else:
+                stats['written'] += 1
+                seen.add(seq)
+        del batched[:]
+        return _advance(seen, position)
+
+    running = len(workers) + 1
+    try:
+        while running:
+            seq, doc = transformed.get()
+            if seq is done:
+                running -= 1
+                if doc is not None:
+                    raise doc[0], doc[1], doc[2]
+                continue
+            stats['read'] += 1
+            if doc is None:
+                stats['dropped'] += 1
+                seen.add(seq)
+            else:
+                batcher.add_one(doc)
+                batched.append((seq, doc))
+            if batcher.batch_len >= batch_size:
+                position = flush()
+                if checkpoint:
+                    _save_checkpoint(checkpoint, query, position, stats['written'], marks)
+        position = flush()
+        if commit:
+            batcher.commit()
+    finally:
+        stopped.set()
+        for thread in workers + [reader]:
+            thread.join()
+        stats['position'] = position
+        stats['total'] = found['total']
+        if checkpoint and position > start:
+            _save_checkpoint(checkpoint, query, position, stats['written'], marks)
+    if checkpoint and os.path.exists(checkpoint):
+        if position == found['total']:
+            os.remove(checkpoint)
+        else:
+            log.warning("reindex: %s of %s documents copied, keeping checkpoint %s", position,
+                        found['total'], checkpoint)
+    log.info("reindex: read {read}, wrote {written}, dropped {dropped}, failed {failed}".format(**stats))
+    return stats
+
+def _page_of(marks, position):
+    """The (position, cursor mark) of the page holding `position`, dropping the pages before it."""
+    while len(marks) > 1 and marks[1][0] <= position:
+        marks.popleft()
+    return marks[0]
+
+def _advance(seen, position):
+    while position in seen:
+        seen.remove(position)
+        position += 1
+    return position
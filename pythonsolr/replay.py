@@ -0,0 +1,405 @@
+"""
+Replays a log of searches against a Solr core, to measure how it holds up
+under a real mix of queries::
+
+    python -m pythonsolr.replay --url http://127.0.0.1:8983/solr/core0 --rate 50 --duration 60 queries.log
+    python -m pythonsolr.replay --dry-run --concurrency 8 queries.log
+
+The log has one request per line, in any of these forms:
+
+* a Solr request log line (`path=/select params={q=ipod&rows=10} ...`),
+* a URL or path with a query string (`/solr/core0/select?q=ipod&rows=10`),
+* a bare query string (`q=ipod&rows=10`),
+* a JSON object with a `params` dict, as in `SlowQueryLog` entries.
+
+Select requests are sent with `Solr.search` (or paged through with a
+`SolrResultsPaginator` with `--paginate`); other handlers are skipped.
+
+In closed-loop mode (the default) `--concurrency` workers each send a
+request as soon as their previous one is answered. That measures the
+throughput a core can sustain. In open-loop mode (`--rate`), requests are
+started at the given rate whether or not earlier ones are done, the way
+independent users send them. Their latency is counted from when they were
+due, so a backlog shows up in the percentiles instead of slowing the load
+down. Requests still waiting for a worker when the run ends are counted as
+abandoned.
+
+The report has the throughput and latency percentiles of each query
+shape. A shape is the handler, the query with its values blanked out
+(`title:? AND ?`), the names of the other parameters and the number of
+rows. The report is printed on stderr and written as JSON to `--output`
+(stdout by default).
+
+With `--dry-run` the requests go to an in-process `MockSolrServer`, to try
+a log or the client itself without a Solr.
+"""
+
+from optparse import OptionParser
+from urlparse import parse_qs
+import itertools
+import random
+import re
+import sys
+import threading
+import time
+import Queue
+
+from pysolr import Solr, json
+from pythonsolr import SolrResultsPaginator
+
+__all__ = ['parse_line', 'read_log', 'query_shape', 'Replayer', 'main']
+
+_LOG_LINE = re.compile(r'path=(\S+)\s+params=\{(.*)\}(?:\s+(?:hits|status|QTime)=|\s*$)')
+
+# parameters that say nothing about the cost of a query
+_IGNORED_PARAMS = ('wt', 'start', 'version', 'indent', 'json.nl', '_')
+
+def parse_line(line):
+    """
+    The `(handler, params)` of a request log line, or None if it can't be
+    read. `params` maps names to lists of unicode values.
+
+    >>> parse_line('INFO: [core0] webapp=/solr path=/select params={q=ipod&rows=10} hits=3 status=0 QTime=1')
+    ('select', {'q': [u'ipod'], 'rows': [u'10']})
+    >>> parse_line('/solr/core0/mlt?q=caf%C3%A9')
+    ('mlt', {'q': [u'caf\\xe9']})
+    >>> parse_line('{"handler": "select", "params": {"q": "\\u00e9t\\u00e9", "rows": 10}}')
+    ('select', {'q': [u'\\xe9t\\xe9'], 'rows': [u'10']})
+    """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    if line.startswith('{'):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return None
+        params = {}
+        for name, value in (entry.get('params') or {}).iteritems():
+            if not isinstance(value, list):
+                value = [value]
+            params[name.encode('utf-8')] = [unicode(v) for v in value]
+        return (entry.get('handler') or 'select').encode('utf-8'), params
+    match = _LOG_LINE.search(line)
+    if match:
+        path, query = match.groups()
+    elif '?' in line:
+        path, query = line.split('?', 1)
+    elif '=' in line:
+        path, query = '/select', line
+    else:
+        return None
+    handler = path.rstrip('/').rsplit('/', 1)[-1] or 'select'
+    params = parse_qs(query, keep_blank_values=True)
+    for name, values in params.iteritems():
+        params[name] = [value.decode('utf-8', 'replace') for value in values]
+    return handler, params
+
+def _search_args(params):
+    """
+    The `q` and keywords to pass to `Solr.search` for parsed `params`:
+    `q` stays unicode (search encodes it), the other values are encoded to
+    UTF-8, which urlencode would otherwise replace with '?'.
+
+    >>> _search_args({'q': [u'caf\\xe9'], 'fq': [u'city:M\\xfcnchen'], 'facet.field': [u'a', u'b'], 'wt': [u'json']})
+    (u'caf\\xe9', {'fq': 'city:M\\xc3\\xbcnchen', 'facet.field': ['a', 'b']})
+    """
+    args = {}
+    for name, values in params.iteritems():
+        if name == 'wt':
+            continue
+        if name != 'q':
+            values = [value.encode('utf-8') for value in values]
+        args[name] = values if len(values) > 1 else values[0]
+    q = args.pop('q', u'*:*')
+    return q, args
+
+def read_log(lines):
+    """The readable `(handler, params)` requests of `lines`."""
+    requests = []
+    for line in lines:
+        request = parse_line(line)
+        if request is not None:
+            requests.append(request)
+    return requests
+
+_PHRASE = re.compile(r'"[^"]*"')
+_FIELD_VALUE = re.compile(r'(?<=:)(?<!\*:)(\[[^\]]*\]|\{[^}]*\}|[^\s()]+)')
+_TERM = re.compile(r'(?<![\w:?.*])(?!(?:AND|OR|NOT|TO)\b)[^\s():"]+(?![\w:])')
+
+def _blank(query):
+    """
+    >>> _blank('title:"ipod nano" AND (apple OR price:[10 TO 20])')
+    'title:? AND (? OR price:?)'
+    """
+    query = _PHRASE.sub('?', query)
+    query = _FIELD_VALUE.sub('?', query)
+    return _TERM.sub('?', query)
+
+def query_shape(handler, params):
+    """
+    >>> query_shape('select', {'q': ['title:ipod'], 'fq': ['cat:1'], 'rows': ['10'], 'wt': ['json']})
+    'select title:? [fq] rows=10'
+    """
+    names = sorted(name for name in params if name not in _IGNORED_PARAMS and name not in ('q', 'rows'))
+    shape = '%s %s' % (handler, _blank((params.get('q') or ['*:*'])[0]))
+    if names:
+        shape += ' [%s]' % ','.join(names)
+    return '%s rows=%s' % (shape, (params.get('rows') or ['10'])[0])
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100.0))]
+
+class Replayer(object):
+    """
+    Sends the select `requests` (see `read_log`) through `solr`, in a
+    closed loop on `concurrency` threads, or in an open loop at `rate`
+    requests per second (with `arrivals` 'uniform' or 'poisson') on up to
+    `concurrency` threads. Stops after `max_requests` requests or
+    `duration` seconds, cycling through the requests if needed; goes
+    through them once when neither is given. With `paginate`, each request
+    pages through up to that many documents.
+    """
+    def __init__(self, solr, requests, concurrency=4, rate=None, arrivals='uniform', max_requests=None,
+                 duration=None, paginate=None, seed=None):
+        self.solr = solr
+        self.requests = [(handler, params) for handler, params in requests if handler == 'select']
+        self.skipped = len(requests) - len(self.requests)
+        if not self.requests:
+            raise ValueError("No select requests to replay")
+        self.concurrency = concurrency
+        self.rate = rate
+        self.arrivals = arrivals
+        self.duration = duration
+        if max_requests is None and duration is None:
+            max_requests = len(self.requests)
+        self.max_requests = max_requests
+        self.paginate = paginate
+        self.random = random.Random(seed)
+        # (shape, latency, lateness, error) of every request, appended by the workers
+        self.samples = []
+        self.abandoned = 0
+
+    def _schedule(self):
+        """The requests to send, cycling through the log."""
+        requests = itertools.cycle(self.requests)
+        if self.max_requests is not None:
+            requests = itertools.islice(requests, self.max_requests)
+        return requests
+
+    def _send(self, handler, params):
+        q, params = _search_args(params)
+        if self.paginate:
+            for doc in SolrResultsPaginator(self.solr, q, params, max_index=self.paginate - 1):
+                pass
+        else:
+            self.solr.search(q, **params)
+
+    def _run_one(self, request, due):
+        handler, params = request
+        started = time.time()
+        error = None
+        try:
+            self._send(handler, params)
+        except Exception, e:
+            error = e.__class__.__name__
+        finished = time.time()
+        self.samples.append((query_shape(handler, params), finished - (due or started),
+                             started - due if due else 0.0, error))
+
+    def run(self):
+        """Replays the requests and returns the report."""
+        self.started = time.time()
+        self.deadline = self.started + self.duration if self.duration else None
+        if self.rate:
+            self._open_loop()
+        else:
+            self._closed_loop()
+        self.elapsed = time.time() - self.started
+        return self.report()
+
+    def _expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def _closed_loop(self):
+        requests = self._schedule()
+        lock = threading.Lock()
+
+        def work():
+            while not self._expired():
+                lock.acquire()
+                try:
+                    request = next(requests, None)
+                finally:
+                    lock.release()
+                if request is None:
+                    return
+                self._run_one(request, None)
+        self._join([threading.Thread(target=work) for i in xrange(self.concurrency)])
+
+    def _open_loop(self):
+        due_requests = Queue.Queue()
+        stop = object()
+
+        def work():
+            while True:
+                item = due_requests.get()
+                if item is stop:
+                    return
+                self._run_one(*item)
+        threads = [threading.Thread(target=work) for i in xrange(self.concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            due = self.started
+            for request in self._schedule():
+                if self.arrivals == 'poisson':
+                    due += self.random.expovariate(self.rate)
+                else:
+                    due += 1.0 / self.rate
+                if self.deadline is not None and due >= self.deadline:
+                    break
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                due_requests.put((request, due))
+        finally:
+            # a backlog left at the end is reported, not worked through
+            while True:
+                try:
+                    due_requests.get_nowait()
+                except Queue.Empty:
+                    break
+                self.abandoned += 1
+            for thread in threads:
+                due_requests.put(stop)
+            for thread in threads:
+                thread.join()
+
+    def _join(self, threads):
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def report(self):
+        by_shape = {}
+        for shape, latency, lateness, error in self.samples:
+            by_shape.setdefault(shape, []).append((latency, lateness, error))
+        elapsed = self.elapsed or 1e-9
+
+        def summary(samples):
+            latencies = sorted(latency for latency, lateness, error in samples)
+            lateness = sorted(lateness for latency, lateness, error in samples)
+            errors = {}
+            for latency, late, error in samples:
+                if error is not None:
+                    errors[error] = errors.get(error, 0) + 1
+            return {
+                'requests': len(samples),
+                'errors': errors,
+                'per_second': len(samples) / elapsed,
+                'p50': _percentile(latencies, 50),
+                'p90': _percentile(latencies, 90),
+                'p99': _percentile(latencies, 99),
+                'max': latencies[-1] if latencies else None,
+                'lateness_p99': _percentile(lateness, 99),
+            }
+        return {
+            'mode': 'open' if self.rate else 'closed',
+            'rate': self.rate,
+            'concurrency': self.concurrency,
+            'seconds': self.elapsed,
+            'skipped': self.skipped,
+            'abandoned': self.abandoned,
+            'total': summary([sample[1:] for sample in self.samples]),
+            'shapes': dict((shape, summary(samples)) for shape, samples in by_shape.iteritems()),
+        }
+
+def _print_report(report, out):
+    total = report['total']
+    out.write("%s loop, %d requests in %.1fs: %.1f/s, p50 %s p99 %s, %d errors, %d skipped, %d abandoned\n" % (
+        report['mode'], total['requests'], report['seconds'], total['per_second'], _ms(total['p50']),
+        _ms(total['p99']), sum(total['errors'].values()), report['skipped'], report['abandoned']))
+    out.write("%8s %8s %9s %9s %9s %7s  %s\n" % ('requests', 'per_sec', 'p50', 'p90', 'p99', 'errors', 'shape'))
+    for shape, summary in sorted(report['shapes'].items(), key=lambda item: -item[1]['requests']):
+        out.write("%8d %8.1f %9s %9s %9s %7d  %s\n" % (
+            summary['requests'], summary['per_second'], _ms(summary['p50']), _ms(summary['p90']),
+            _ms(summary['p99']), sum(summary['errors'].values()), shape))
+
+def _ms(seconds):
+    if seconds is None:
+        return '-'
+    return '%.1fms' % (seconds * 1000)
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] LOG [LOG...] (- for stdin)")
+    parser.add_option("--url", help="the core to replay against")
+    parser.add_option("--concurrency", type="int", default=4, help="worker threads (default 4)")
+    parser.add_option("--rate", type="float", default=None,
+                      help="requests per second, open loop (default: closed loop)")
+    parser.add_option("--arrivals", choices=('uniform', 'poisson'), default='uniform',
+                      help="spacing of open loop requests: uniform or poisson")
+    parser.add_option("--requests", type="int", default=None, help="stop after this many requests")
+    parser.add_option("--duration", type="float", default=None, help="stop after this many seconds")
+    parser.add_option("--paginate", type="int", default=None,
+                      help="page through up to this many documents per request")
+    parser.add_option("--timeout", type="float", default=60, help="request timeout in seconds")
+    parser.add_option("--wt", choices=('json', 'javabin'), default='json', help="response format")
+    parser.add_option("--seed", type="int", default=None, help="random seed of the poisson arrivals")
+    parser.add_option("--dry-run", dest="dry_run", action="store_true", default=False,
+                      help="replay against an in-process mock server")
+    parser.add_option("--mock-docs", dest="mock_docs", type="int", default=1000, help="documents of the mock server")
+    parser.add_option("--mock-latency", dest="mock_latency", type="float", default=0.0,
+                      help="seconds added by the mock server to every request")
+    parser.add_option("--output", default=None, help="file for the JSON report (default stdout)")
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error("no log to replay")
+    if not options.url and not options.dry_run:
+        parser.error("give the --url of a core, or --dry-run")
+
+    requests = []
+    for path in args:
+        if path == '-':
+            requests.extend(read_log(sys.stdin))
+        else:
+            f = open(path)
+            try:
+                requests.extend(read_log(f))
+            finally:
+                f.close()
+
+    server = None
+    url = options.url
+    if options.dry_run:
+        from mocksolr import MockSolrServer
+        server = MockSolrServer(num_docs=options.mock_docs, latency=options.mock_latency).start()
+        url = server.url
+    try:
+        solr = Solr(url, timeout=options.timeout, wt=options.wt, pool_size=max(10, options.concurrency))
+        replayer = Replayer(solr, requests, options.concurrency, options.rate, options.arrivals,
+                            options.requests, options.duration, options.paginate, options.seed)
+        report = replayer.run()
+    except ValueError, e:
+        parser.error(str(e))
+    finally:
+        if server is not None:
+            server.stop()
+    report['url'] = options.url if not options.dry_run else 'mock'
+    _print_report(report, sys.stderr)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(output)
+        f.close()
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
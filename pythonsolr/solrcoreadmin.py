@@ -1,73 +1,354 @@
-from pysolr import Solr
+from pysolr import Solr, SolrError, Results, FacetField, HttpPool, TIMEOUTS_AVAILABLE, json
+from fnmatch import fnmatchcase
+from urlparse import urlsplit
+import heapq
+import inspect
+import threading
+import time
 import urllib
-import json
 
 class CoreNotStartedException(Exception): pass
 
+class _SortKey(object):
+    """
+    Orders documents by a Solr sort spec, a list of `(field, descending)`
+    pairs. Documents missing a field sort after the others, as in Solr.
+    """
+    __slots__ = ('values', 'sort')
+
+    def __init__(self, doc, sort):
+        self.values = [doc.get(field) for field, descending in sort]
+        self.sort = sort
+
+    def __lt__(self, other):
+        for (field, descending), a, b in zip(self.sort, self.values, other.values):
+            if a == b:
+                continue
+            if a is None:
+                return False
+            if b is None:
+                return True
+            return a > b if descending else a < b
+        return False
+
+def parse_sort(sort):
+    """
+    >>> parse_sort('price desc, id asc')
+    [('price', True), ('id', False)]
+    """
+    spec = []
+    for clause in sort.split(','):
+        parts = clause.split()
+        if parts:
+            spec.append((parts[0], len(parts) > 1 and parts[1].lower() == 'desc'))
+    return spec
+
+def _selected(field, fl):
+    """Whether the field list `fl` returns `field`; score has to be named."""
+    if field in fl:
+        return True
+    return field != 'score' and any(fnmatchcase(field, pattern) for pattern in fl)
+
+def merge_docs(doc_lists, sort, start, rows):
+    """
+    k-way merges lists of documents each already ordered by `sort`, and
+    returns the `rows` documents from `start` on.
+
+    >>> merge_docs([[{'n': 5}, {'n': 1}], [{'n': 4}, {'n': 3}]], [('n', True)], 1, 2)
+    [{'n': 4}, {'n': 3}]
+    """
+    heap = []
+    for i, docs in enumerate(doc_lists):
+        if docs:
+            heap.append((_SortKey(docs[0], sort), i, 0))
+    heapq.heapify(heap)
+    merged = []
+    while heap and len(merged) < start + rows:
+        key, i, pos = heap[0]
+        merged.append(doc_lists[i][pos])
+        pos += 1
+        if pos < len(doc_lists[i]):
+            heapq.heapreplace(heap, (_SortKey(doc_lists[i][pos], sort), i, pos))
+        else:
+            heapq.heappop(heap)
+    return merged[start:]
+
+def merge_facets(facet_list, params):
+    """Sums the facet query and facet field counts of several responses."""
+    queries = {}
+    fields = {}
+    for facets in facet_list:
+        for query, count in (facets.get('facet_queries') or {}).iteritems():
+            queries[query] = queries.get(query, 0) + count
+        for name, data in (facets.get('facet_fields') or {}).iteritems():
+            counts = fields.setdefault(name, {})
+            for value, count in FacetField(data):
+                counts[value] = counts.get(value, 0) + count
+    limit = int(params.get('facet.limit', 100))
+    for name, counts in fields.items():
+        if params.get('facet.sort') in ('index', 'false'):
+            items = sorted(counts.items())
+        else:
+            items = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        if limit >= 0:
+            items = items[:limit]
+        flat = []
+        for value, count in items:
+            flat.extend((value, count))
+        fields[name] = flat
+    return {'facet_queries': queries, 'facet_fields': fields}
+
+def _accepts(cls, name):
+    """Whether the constructor of `cls` takes a `name` keyword."""
+    try:
+        args, varargs, keywords, defaults = inspect.getargspec(cls.__init__)
+    except TypeError:
+        return False
+    return name in args or keywords is not None
+
 class SolrCoreAdminException(Exception):
     def __init__(self,http_code):
         self.http_code = http_code
     def __str__(self):
-        return self(self.http_code)
+        return "Solr core admin returned status %s" % self.http_code
 
 ### multicore commands
 class SolrCoreAdmin(object):
     """
     Class to support Solr's multicore admin commands
+
+    The admin keeps a registry of the cores: the status of every core is
+    fetched in one STATUS call and cached for `status_ttl` seconds, and each
+    core gets a single long-lived client, created on first use. All of the
+    clients share one `HttpPool` so connections to the server are reused
+    whatever the core, if `solr_class` takes an `http_pool`. `client_kwargs`
+    are passed on to `solr_class`.
+
+    Bulk operations (`create_cores`, `unload_cores`, `map_cores`) run on up
+    to `max_workers` threads.
     """
-    def __init__(self,url='http://127.0.0.1:8983/solr/',solr_class=Solr):
+    def __init__(self,url='http://127.0.0.1:8983/solr/',solr_class=Solr,status_ttl=30,max_workers=8,
+                 pool_size=10,**client_kwargs):
         self.url = url
         self.core_admin_url = self.url + 'admin/cores?'
         self.solr_class = solr_class
-        
-    def list_cores(self,name=None):
-        if name:
-            status_cmd = self.core_admin_url + urllib.urlencode({'action':'status','core':name,'wt':'json'})
-        else:
-            status_cmd = self.core_admin_url + urllib.urlencode({'action':'status','wt':'json'})
-        
-        res =  urllib.urlopen(status_cmd)
-        data = json.loads(res.read())
+        self.status_ttl = status_ttl
+        self.max_workers = max_workers
+        http_pool = client_kwargs.pop('http_pool', None)
+        if http_pool is None and TIMEOUTS_AVAILABLE:
+            http_pool = HttpPool(pool_size, client_kwargs.get('timeout', 60))
+        self.http_pool = http_pool
+        if http_pool is not None and _accepts(solr_class, 'http_pool'):
+            client_kwargs['http_pool'] = http_pool
+        self.client_kwargs = client_kwargs
+        self._clients = {}
+        self._worker_pool = None
+        self._status = None
+        self._status_time = 0
+        self.lock = threading.RLock()
 
+    def _admin(self,params):
+        params = dict(params, wt='json')
+        admin_cmd = self.core_admin_url + urllib.urlencode(params)
+        if self.http_pool is None:
+            response = urllib.urlopen(admin_cmd)
+            status, body = response.getcode(), response.read()
+        else:
+            with self.http_pool.connection() as http:
+                headers, body = http.request(admin_cmd)
+            status = headers.status
+        if status != 200:
+            raise SolrError("Solr core admin returned HTTP status %s: %s" % (status, body[:200]))
+        data = json.loads(body)
         http_code = data['responseHeader']['status']
         if http_code != 0: raise SolrCoreAdminException(http_code)
-        
-        st = data['status']
+        return data
+
+    def status(self,name=None,refresh=False):
+        """
+        The STATUS of all cores as a dict keyed by core name, or the status
+        of core `name` (None if there is no such core). Cached for
+        `status_ttl` seconds unless `refresh` is true.
+        """
+        self.lock.acquire()
+        try:
+            if refresh or self._status is None or time.time() - self._status_time > self.status_ttl:
+                self._status = self._admin({'action':'status'})['status']
+                self._status_time = time.time()
+                # forget the clients of cores that went away
+                for core_name in self._clients.keys():
+                    if core_name not in self._status:
+                        del self._clients[core_name]
+            status = self._status
+        finally:
+            self.lock.release()
+        if name is None:
+            return status
+        return status.get(name) or None
+
+    def invalidate(self):
+        """Forgets the cached status, the next call fetches it again."""
+        self.lock.acquire()
+        try:
+            self._status = None
+        finally:
+            self.lock.release()
+
+    def client(self,name):
+        """The client of core `name`, created once and then reused."""
+        self.lock.acquire()
+        try:
+            core = self._clients.get(name)
+            if core is None:
+                url = "%s%s" %(self.url ,name)
+                core = self._clients[name] = self.solr_class(url=url,**self.client_kwargs)
+            return core
+        finally:
+            self.lock.release()
+
+    def list_cores(self,name=None,refresh=False):
         if name:
-            if not st.get(name): return []
-        cores = []
-        for core_name in st:
-            url = "%s%s" %(self.url ,core_name)
-            core = self.solr_class(url=url)
-            cores.append(core)
-        return cores
-    
+            if not self.status(name,refresh): return []
+            return [self.client(name)]
+        return [self.client(core_name) for core_name in self.status(refresh=refresh)]
+
     def create_core(self,name):
         """Create a core. If it already exists, do nothing """
-        core = self.list_cores(name)
-        if len(core)>0: return
+        if self.status(name): return
+
+        self._admin({'action':'create','name':name,'loadOnStart':'false', 'instanceDir':'.','schema':'schema.xml'})
+        self.invalidate()
 
-        create_cmd = self.core_admin_url + urllib.urlencode({'action':'create','name':name,'loadOnStart':'false', 'instanceDir':'.','schema':'schema.xml'})
-        res =  urllib.urlopen(create_cmd)
-               
     def get_core(self,name):
         cores = self.list_cores(name)
         assert len(cores) == 1
         return cores[0]
-        
-    def is_core_active(self,name): 
+
+    def is_core_active(self,name):
         core = self.list_cores(name)
         return len(core) == 1
 
     def unload_core(self,name,delete_index=False):
         core = self.get_core(name)
-        params = {'action':'unload','core':name,'wt':'json'}
+        params = {'action':'unload','core':name}
         if delete_index:
             params['deleteIndex'] = 'true'
-        unload_cmd = self.core_admin_url + urllib.urlencode(params)
-        res =  urllib.urlopen(unload_cmd)
-        
+        try:
+            self._admin(params)
+        finally:
+            self.invalidate()
+            self.lock.acquire()
+            try:
+                self._clients.pop(name, None)
+            finally:
+                self.lock.release()
+
         return True
 
     def delete_core(self,name):
         return self.unload_core(name,delete_index=True)
+
+    ### bulk commands
+    def _map(self,func,items):
+        items = list(items)
+        if len(items) <= 1 or self.max_workers <= 1:
+            return map(func,items)
+        return self._workers().map(func,items)
+
+    def _workers(self):
+        """The thread pool of the bulk commands, created on first use and kept."""
+        self.lock.acquire()
+        try:
+            if self._worker_pool is None:
+                from multiprocessing.pool import ThreadPool
+                self._worker_pool = ThreadPool(self.max_workers)
+            return self._worker_pool
+        finally:
+            self.lock.release()
+
+    def map_cores(self,func,names=None):
+        """
+        Calls `func(client)` for the client of each core in `names` (all
+        cores by default), in parallel. Returns a dict of the results keyed
+        by core name.
+        """
+        if names is None:
+            names = self.status().keys()
+        names = list(names)
+        return dict(zip(names, self._map(lambda name: func(self.client(name)), names)))
+
+    def create_cores(self,names):
+        """Create several cores in parallel, skipping the existing ones."""
+        existing = self.status()
+        self._map(self.create_core,[name for name in names if name not in existing])
+
+    def unload_cores(self,names,delete_index=False):
+        """Unload several cores in parallel."""
+        self._map(lambda name: self.unload_core(name,delete_index),names)
+        return True
+
+    def delete_cores(self,names):
+        return self.unload_cores(names,delete_index=True)
+
+    ### search
+    def search_all(self,q,cores=None,mode='merge',sort=None,start=0,rows=10,**params):
+        """
+        Searches several cores (all of them by default) and returns one
+        `Results`.
+
+        In 'merge' mode the cores are queried in parallel, each for its first
+        `start + rows` documents, and the lists are merged by `sort` (score
+        by default). The sort fields are added to `fl` (a string or a list)
+        when it doesn't return them, and removed from the merged documents
+        afterwards. `hits` and facet counts are
+        summed; facet field counts are only exact when `facet.limit` is
+        large enough for every core to return all of its values.
+        `hits_by_core` has the hits of each core.
+
+        In 'shards' mode a single distributed request is sent to the first
+        core with `shards=` listing all of them, and Solr does the merge.
+        """
+        if cores is None:
+            cores = sorted(self.status())
+        cores = list(cores)
+        if sort:
+            params['sort'] = sort
+        if mode == 'shards':
+            shards = []
+            for name in cores:
+                scheme, netloc, path = urlsplit("%s%s" % (self.url, name))[:3]
+                shards.append(netloc + path)
+            params['shards'] = ','.join(shards)
+            return self.client(cores[0]).search(q,start=start,rows=rows,**params)
+        if mode != 'merge':
+            raise ValueError("Unknown search_all mode %r" % mode)
+
+        if sort:
+            sort_spec = parse_sort(sort)
+        else:
+            sort_spec = [('score', True)]
+        fl = params.get('fl') or '*'
+        if not isinstance(fl, basestring):
+            fl = ','.join(fl)
+        fields = [field for field in fl.replace(' ', ',').split(',') if field]
+        # the merge needs the sort values of every document
+        added = [field for field, descending in sort_spec if not _selected(field, fields)]
+        params['fl'] = ','.join(fields + added)
+        params['start'] = 0
+        params['rows'] = start + rows
+        responses = self.map_cores(lambda core: core.search(q,**params),cores)
+
+        results = Results()
+        results.docs = merge_docs([responses[name].docs for name in cores],sort_spec,start,rows)
+        for doc in results.docs:
+            for field in added:
+                doc.pop(field, None)
+        results.hits_by_core = dict((name, responses[name].hits) for name in cores)
+        results.hits = sum(results.hits_by_core.values())
+        facets = [responses[name].facets for name in cores if responses[name].facets]
+        if facets:
+            results.facets = merge_facets(facets,params)
+        results.result = {'response': {'numFound': results.hits, 'start': start, 'docs': results.docs}}
+        if facets:
+            results.result['facet_counts'] = results.facets
+        return results
@@ -0,0 +1,340 @@
+"""
+Type-ahead suggestions from Solr's suggest (or terms) handler, with a client
+side cache of the prefixes already asked for::
+
+    suggester = Suggester(solr, handler='suggest', dictionary='titles')
+    suggester.suggest(u'app')   # [u'apple', u'application', ...]
+
+Every answer is kept in a prefix trie. When "ap" came back with fewer than
+`limit` suggestions it holds every suggestion starting with "ap", so "app"
+and "appl" are answered by filtering it, without a request. When it was cut
+at `limit`, the suggestions that still match "app" are the best ones for
+"app" too: if there are at least `limit` of them they are the answer. Only
+prefixes that can't be answered that way go to Solr. This assumes the
+suggester matches on prefixes; for infix or fuzzy suggesters pass
+`narrow=False` so that only prefixes asked for before are served locally.
+
+The 'suggest' handler is queried with the parameters of both the
+SuggestComponent (`suggest.q`, Solr 4.7+) and the older spellcheck based
+Suggester (`q`, `spellcheck.count`), and either response is read. With
+handler='terms' the TermsComponent lists the indexed terms of `field`.
+
+A `SuggestSession` follows one input box: `update` is called on every
+keystroke, requests wait for the typing to pause for `delay` seconds, and
+answers to prefixes the user has typed past are dropped rather than passed
+to the callback::
+
+    session = suggester.session(show_suggestions, delay=0.05)
+    session.update(u'a'); session.update(u'ap')   # one request, for u'ap'
+"""
+
+from collections import OrderedDict
+from urllib import urlencode
+import logging
+import threading
+import time
+
+__all__ = ['Suggester', 'SuggestSession', 'PrefixCache']
+
+log = logging.getLogger('solr')
+
+class _Node(object):
+    __slots__ = ('children', 'entry')
+
+    def __init__(self):
+        self.children = {}
+        self.entry = None
+
+class PrefixCache(object):
+    """
+    Suggestions by prefix in a trie, so that the cached prefixes of a prefix
+    are found in a single walk down from the root. An entry is
+    `(suggestions, complete, time)`; `complete` is true when the
+    suggestions are all there is for the prefix. Keeps the `maxsize` most
+    recently used prefixes, each for at most `ttl` seconds (None for ever).
+
+    >>> cache = PrefixCache()
+    >>> cache.put(u'ap', [u'apple', u'apricot'], True)
+    >>> cache.lookup(u'apr')
+    (None, (u'ap', [u'apple', u'apricot'], True))
+    """
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.root = _Node()
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.lru)
+
+    def lookup(self, prefix):
+        """
+        Returns the entry for `prefix` and `(prefix, suggestions, complete)`
+        of its longest cached proper prefix, each None when not cached.
+        """
+        now = time.time()
+        exact = closest = None
+        self.lock.acquire()
+        try:
+            node = self.root
+            depth = 0
+            while True:
+                entry = node.entry
+                if entry is not None:
+                    if self.ttl is not None and now - entry[2] > self.ttl:
+                        self._remove(prefix[:depth])
+                    elif depth == len(prefix):
+                        exact = entry
+                        self.lru[prefix] = self.lru.pop(prefix)
+                    else:
+                        closest = (prefix[:depth], entry[0], entry[1])
+                if depth == len(prefix):
+                    break
+                node = node.children.get(prefix[depth])
+                if node is None:
+                    break
+                depth += 1
+        finally:
+            self.lock.release()
+        return exact, closest
+
+    def put(self, prefix, suggestions, complete):
+        self.lock.acquire()
+        try:
+            node = self.root
+            for char in prefix:
+                child = node.children.get(char)
+                if child is None:
+                    child = node.children[char] = _Node()
+                node = child
+            node.entry = (suggestions, complete, time.time())
+            self.lru.pop(prefix, None)
+            self.lru[prefix] = None
+            while len(self.lru) > self.maxsize:
+                self._remove(self.lru.iterkeys().next())
+        finally:
+            self.lock.release()
+
+    def _remove(self, prefix):
+        # the lock is held; prunes the branches left empty
+        self.lru.pop(prefix, None)
+        path = [self.root]
+        for char in prefix:
+            node = path[-1].children.get(char)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].entry = None
+        for depth in xrange(len(prefix), 0, -1):
+            node = path[depth]
+            if node.entry is not None or node.children:
+                break
+            del path[depth - 1].children[prefix[depth - 1]]
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.root = _Node()
+            self.lru.clear()
+        finally:
+            self.lock.release()
+
+def _lower(text):
+    return text.lower()
+
+def _same(text):
+    return text
+
+class Suggester(object):
+    """
+    Suggestions for prefixes from `handler` ('suggest', or 'terms' for the
+    TermsComponent on `field`) of a `Solr` client, at most `limit` per
+    prefix. `dictionary` names the suggester dictionary to use. Other
+    keywords are added to every request.
+
+    Prefixes and suggestions are compared through `normalize`, lower casing
+    by default for the suggest handler and nothing for terms (whose
+    prefixes are case sensitive). Prefixes shorter than `min_chars`
+    characters get no suggestions.
+
+    `requests`, `hits` (prefixes asked for before) and `narrowed`
+    (answered from a shorter prefix) count how prefixes were answered.
+    """
+    def __init__(self, solr, handler='suggest', field=None, dictionary=None, limit=10, min_chars=1,
+                 cache_size=10000, ttl=300, narrow=True, normalize=None, **params):
+        if handler == 'terms' and not field:
+            raise ValueError("The terms handler needs a field")
+        self.solr = solr
+        self.handler = handler
+        self.field = field
+        self.dictionary = dictionary
+        self.limit = limit
+        self.min_chars = min_chars
+        self.narrow = narrow
+        if normalize is None:
+            normalize = _same if handler == 'terms' else _lower
+        self.normalize = normalize
+        self.params = params
+        self.cache = PrefixCache(cache_size, ttl)
+        self.requests = 0
+        self.hits = 0
+        self.narrowed = 0
+
+    def suggest(self, prefix, deadline=None):
+        """The suggestions for `prefix`, best first."""
+        suggestions = self.cached(prefix)
+        if suggestions is None:
+            suggestions = self._fetch(prefix, deadline)
+        return suggestions
+
+    def cached(self, prefix):
+        """
+        The suggestions for `prefix` if they can be worked out from the
+        cache, otherwise None.
+        """
+        if len(prefix) < self.min_chars:
+            return []
+        key = self.normalize(prefix)
+        exact, closest = self.cache.lookup(key)
+        if exact is not None:
+            self.hits += 1
+            return exact[0]
+        if closest is None or not self.narrow:
+            return None
+        shorter, suggestions, complete = closest
+        normalize = self.normalize
+        matching = [suggestion for suggestion in suggestions if normalize(suggestion).startswith(key)]
+        if not complete:
+            if len(matching) < self.limit:
+                return None
+            matching = matching[:self.limit]
+        self.narrowed += 1
+        self.cache.put(key, matching, complete)
+        return matching
+
+    def _fetch(self, prefix, deadline=None):
+        self.requests += 1
+        params = {'wt': 'json'}
+        if self.handler == 'terms':
+            params.update({'terms': 'true', 'terms.fl': self.field, 'terms.prefix': prefix,
+                           'terms.limit': self.limit})
+        else:
+            params.update({'q': prefix, 'spellcheck.count': self.limit,
+                           'suggest.q': prefix, 'suggest.count': self.limit})
+            if self.dictionary:
+                params['suggest.dictionary'] = params['spellcheck.dictionary'] = self.dictionary
+        params.update(self.params)
+        for name, value in params.items():
+            if isinstance(value, unicode):
+                params[name] = value.encode('utf-8')
+        solr = self.solr
+        path = '%s/%s?%s' % (solr.path, self.handler, urlencode(params, True))
+        result = solr.json_codec.decode(solr._send_request('GET', path, deadline=deadline))
+        suggestions = self._parse(result, prefix)[:self.limit]
+        self.cache.put(self.normalize(prefix), suggestions, len(suggestions) < self.limit)
+        return suggestions
+
+    def _parse(self, result, prefix):
+        if 'terms' in result:
+            terms = result['terms']
+            if isinstance(terms, list):
+                # json.nl=flat
+                terms = dict(zip(terms[0::2], terms[1::2]))
+            return (terms.get(self.field) or [])[0::2]
+        if 'suggest' in result:
+            # SuggestComponent: {dictionary: {prefix: {numFound, suggestions: [{term, weight}]}}}
+            suggestions = []
+            for by_prefix in result['suggest'].itervalues():
+                for found in by_prefix.itervalues():
+                    suggestions.extend(suggestion['term'] for suggestion in found.get('suggestions') or ())
+            return suggestions
+        # spellcheck based Suggester: ["prefix", {numFound, suggestion: [...]}, ...]
+        entries = (result.get('spellcheck') or {}).get('suggestions') or []
+        if isinstance(entries, dict):
+            entries = [item for pair in entries.iteritems() for item in pair]
+        for name, value in zip(entries[0::2], entries[1::2]):
+            if isinstance(value, dict) and 'suggestion' in value:
+                return [suggestion if isinstance(suggestion, basestring) else suggestion['word']
+                        for suggestion in value['suggestion']]
+        return []
+
+    def session(self, callback, delay=0.05, on_error=None):
+        """A `SuggestSession` calling `callback(prefix, suggestions)`."""
+        return SuggestSession(self, callback, delay, on_error)
+
+class SuggestSession(object):
+    """
+    Suggestions for one input box. `update(prefix)` is called with the text
+    typed so far. Prefixes the cache can answer are passed to `callback`
+    straight away, in the calling thread; the others are requested from a
+    timer thread once `update` hasn't been called for `delay` seconds.
+
+    An answer is only passed on if no other prefix was typed in the
+    meantime. A stale request that was already sent is left to finish, so
+    that its answer still fills the cache, but is not reported. Errors go
+    to `on_error(prefix, exception)`, or are logged.
+    """
+    def __init__(self, suggester, callback, delay=0.05, on_error=None):
+        self.suggester = suggester
+        self.callback = callback
+        self.delay = delay
+        self.on_error = on_error
+        self.generation = 0
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def update(self, prefix):
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            generation = self.generation
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        finally:
+            self.lock.release()
+        suggestions = self.suggester.cached(prefix)
+        if suggestions is not None:
+            self.callback(prefix, suggestions)
+            return
+        timer = threading.Timer(self.delay, self._request, (prefix, generation))
+        timer.daemon = True
+        self.lock.acquire()
+        try:
+            if generation != self.generation:
+                return
+            self.timer = timer
+        finally:
+            self.lock.release()
+        timer.start()
+
+    def _current(self, generation):
+        return generation == self.generation
+
+    def _request(self, prefix, generation):
+        if not self._current(generation):
+            return
+        try:
+            suggestions = self.suggester.suggest(prefix)
+        except Exception, e:
+            if not self._current(generation):
+                return
+            if self.on_error is not None:
+                self.on_error(prefix, e)
+            else:
+                log.exception("Suggestions for %r failed", prefix)
+            return
+        if self._current(generation):
+            self.callback(prefix, suggestions)
+
+    def close(self):
+        """Cancels the pending request; answers still in flight are dropped."""
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        finally:
+            self.lock.release()
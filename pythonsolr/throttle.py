@@ -0,0 +1,252 @@
+"""
+Flow control for indexing, so that writers back off when Solr falls behind
+instead of piling more work on it::
+
+    solr = Solr(url, update_throttle=True)   # the throttle shared by the process
+    adder = SolrBatchAdder(solr, batch_size=500)
+
+An `UpdateThrottle` combines two limits on the requests that add documents:
+
+* an `AIMDLimiter` on the number of concurrent updates. It grows by one
+  slot per round of fast updates and halves when an update can't get
+  through (connection errors, 5xx, 429), times out or takes more than
+  `tolerance` times the usual latency, the way TCP congestion control
+  does. Rejected documents (a 400) don't count. Merges that fall behind show up as slower
+  updates, so writers slow down before requests start timing out.
+* optional `TokenBucket` caps in documents and bytes per second.
+
+Every client created with `update_throttle=True` (and so every adder
+writing through one) uses `default_throttle()`, which is shared by the
+whole process: the limits hold for all of the indexing traffic together.
+"""
+
+from contextlib import contextmanager
+import socket
+import threading
+import time
+
+__all__ = ['AIMDLimiter', 'TokenBucket', 'UpdateThrottle', 'default_throttle', 'set_default_throttle',
+           'congestion']
+
+class AIMDLimiter(object):
+    """
+    Limits concurrent requests to `limit`, between `min_limit` and
+    `max_limit`: additive increase (one more slot once `limit` requests in
+    a row were fine), multiplicative decrease (times `backoff`) when a
+    request fails or is slow.
+
+    A request is slow when it takes more than `target_latency` seconds or,
+    when that is None, more than `tolerance` times the baseline latency.
+    The baseline is the fastest latency of the previous `window` successful
+    requests (or faster), so it follows a change of batch size without
+    drifting up with a slowly growing load. Requests that were already in
+    flight when the limit was cut don't cut it again.
+    """
+    def __init__(self, initial=2, min_limit=1, max_limit=32, target_latency=None, tolerance=2.0, backoff=0.5,
+                 window=100):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.window = window
+        self.baseline = None
+        self._window_min = None
+        self._window_count = 0
+        self.in_flight = 0
+        self.decreases = 0
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Waits for a free slot; returns the time the request starts."""
+        self.condition.acquire()
+        try:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            return time.time()
+        finally:
+            self.condition.release()
+
+    def release(self, started, failed=False):
+        latency = time.time() - started
+        self.condition.acquire()
+        try:
+            self.in_flight -= 1
+            if failed or self._slow(latency):
+                if started >= self.last_decrease:
+                    self._decrease()
+            else:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            if not failed:
+                self._sample(latency)
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def _sample(self, latency):
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        if self._window_min is None or latency < self._window_min:
+            self._window_min = latency
+        self._window_count += 1
+        if self._window_count >= self.window:
+            self.baseline = self._window_min
+            self._window_min = None
+            self._window_count = 0
+
+    def decrease(self):
+        """Cuts the limit, for congestion seen outside of the limited requests."""
+        self.condition.acquire()
+        try:
+            self._decrease()
+        finally:
+            self.condition.release()
+
+    def _decrease(self):
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        self.last_decrease = time.time()
+        self.decreases += 1
+
+    def _slow(self, latency):
+        if self.target_latency is not None:
+            return latency > self.target_latency
+        return self.baseline is not None and latency > self.tolerance * self.baseline
+
+class TokenBucket(object):
+    """
+    A rate of `rate` units per second with bursts of up to `burst` units
+    (one second's worth by default). Units are charged once known, after
+    the fact, which can leave the bucket in debt: `delay()` is how long to
+    wait before it is back to zero.
+
+    >>> bucket = TokenBucket(100)
+    >>> bucket.charge(150)
+    >>> 0.4 < bucket.delay() <= 0.5
+    True
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def charge(self, amount):
+        self.lock.acquire()
+        try:
+            self._refill()
+            self.tokens -= amount
+        finally:
+            self.lock.release()
+
+    def delay(self):
+        self.lock.acquire()
+        try:
+            self._refill()
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+        finally:
+            self.lock.release()
+
+class UpdateThrottle(object):
+    """
+    An `AIMDLimiter` (`limiter`, a default one if None) on concurrent
+    updates, and caps of `docs_per_second` and `bytes_per_second` (None for
+    no cap). `waited` totals the seconds spent waiting for the caps.
+    """
+    def __init__(self, limiter=None, docs_per_second=None, bytes_per_second=None):
+        self.limiter = limiter or AIMDLimiter()
+        self.docs = TokenBucket(docs_per_second) if docs_per_second else None
+        self.bytes = TokenBucket(bytes_per_second) if bytes_per_second else None
+        self.waited = 0.0
+
+    @contextmanager
+    def request(self):
+        """
+        Holds a concurrency slot for one update, once the rate caps allow
+        it. An exception from the block counts as a failed update when it
+        is a sign of congestion (see `congestion`); a rejected document
+        says nothing about the load.
+        """
+        for bucket in (self.docs, self.bytes):
+            if bucket is not None:
+                delay = bucket.delay()
+                if delay:
+                    condition = self.limiter.condition
+                    condition.acquire()
+                    try:
+                        self.waited += delay
+                    finally:
+                        condition.release()
+                    time.sleep(delay)
+        started = self.limiter.acquire()
+        try:
+            yield
+        except Exception, e:
+            self.limiter.release(started, failed=congestion(e))
+            raise
+        except:
+            self.limiter.release(started)
+            raise
+        self.limiter.release(started)
+
+    def charge(self, docs=0, nbytes=0):
+        """Counts documents and bytes sent against the caps."""
+        if docs and self.docs is not None:
+            self.docs.charge(docs)
+        if nbytes and self.bytes is not None:
+            self.bytes.charge(nbytes)
+
+    def congested(self):
+        """Reports trouble seen outside of `request`, such as a commit timing out."""
+        self.limiter.decrease()
+
+def congestion(error):
+    """
+    Whether an update that failed with `error` says Solr is overloaded: a
+    connection error, a timeout, or a 5xx or 429 response. Errors of the
+    client carry the status of the response, None when there was none.
+
+    >>> from pysolr import SolrError
+    >>> rejected = SolrError('Document is missing mandatory uniqueKey field'); rejected.status = 400
+    >>> congestion(rejected), congestion(SolrError('timed out')), congestion(ValueError())
+    (False, True, False)
+    """
+    if isinstance(error, (socket.error, socket.timeout)):
+        return True
+    if not hasattr(error, 'status'):
+        return False
+    status = error.status
+    return status is None or status >= 500 or status == 429
+
+_default = None
+_default_lock = threading.Lock()
+
+def default_throttle():
+    """The throttle shared by the process, created on first use."""
+    global _default
+    _default_lock.acquire()
+    try:
+        if _default is None:
+            _default = UpdateThrottle()
+        return _default
+    finally:
+        _default_lock.release()
+
+def set_default_throttle(throttle):
+    """Replaces the shared throttle, e.g. with one that has rate caps."""
+    global _default
+    _default_lock.acquire()
+    try:
+        _default = throttle
+    finally:
+        _default_lock.release()
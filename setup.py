@@ -23,5 +23,8 @@ setup(
     'Topic :: Internet :: WWW/HTTP :: Indexing/Search'
     ],
     url = 'http://bitbucket.org/cogtree/python-solr/',
-    install_requires = ['httplib2',]
+    install_requires = ['httplib2',],
+    entry_points = {
+        'console_scripts': ['pythonsolr-replay = pythonsolr.replay:main'],
+    },
     )